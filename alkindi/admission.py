@@ -0,0 +1,137 @@
+"""
+Admission control: per-view concurrency limits shared by all workers.
+
+The limits are configured in redis as a JSON object that maps API
+view names to the maximum number of concurrent requests, for example:
+
+    {"start": 20, "create_attempt": 20, "answer": 40, "get_hint": 40}
+
+Views that are not listed (refresh, read_workspace_revision, ...) are
+not limited.  A request to a limited view waits (up to admission_wait
+seconds) for a slot, and is answered with 429 Too Many Requests and a
+Retry-After header if none becomes available.
+
+Admission is decided by a tween placed above the transaction tween,
+before traversal, so that a waiting request holds neither a database
+connection nor a transaction.  The view is therefore named from the
+path: the last element of API paths (POST /api/attempts/12/start is
+start).  Only API views are limited, pages such as GET /start are
+never refused.
+
+Each view has a semaphore in redis, a sorted set of lease tokens
+scored by their expiry time, so that slots held by a killed worker are
+eventually reclaimed.
+"""
+
+import random
+import time
+import uuid
+
+from pyramid.httpexceptions import HTTPTooManyRequests
+
+from alkindi.deadlines import DEFAULT_BUDGET, remaining
+from alkindi.globals import app
+
+
+# Default time (in seconds) a request waits for a slot, and the value
+# of the Retry-After header returned when it does not get one.
+DEFAULT_WAIT = 2
+DEFAULT_RETRY_AFTER = 5
+
+# Delay between attempts to acquire a slot, in seconds.
+POLL_INTERVAL = 0.05
+
+# KEYS[1] semaphore, ARGV: token, limit, now, lease expiry
+ACQUIRE_SCRIPT = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[3])
+if redis.call('ZCARD', KEYS[1]) < tonumber(ARGV[2]) then
+    redis.call('ZADD', KEYS[1], ARGV[4], ARGV[1])
+    return 1
+end
+return 0
+"""
+
+_acquire_script = None
+
+
+def includeme(config):
+    config.add_tween(
+        'alkindi.admission.admission_tween_factory',
+        under='alkindi.backend.deadline_tween_factory',
+        over='alkindi.backend.transaction_manager_tween_factory')
+
+
+def admission_tween_factory(handler, registry):
+
+    def tween(request):
+        name = get_view_key(request)
+        if name is None:
+            return handler(request)
+        limits = app.get_json('admission_limits', {})
+        limit = limits.get(name)
+        if limit is None:
+            return handler(request)
+        token = acquire_slot(name, limit)
+        if token is None:
+            print("admission: rejected {} (limit {})".format(name, limit))
+            retry_after = int(
+                app.get('admission_retry_after', DEFAULT_RETRY_AFTER))
+            return HTTPTooManyRequests(
+                headers={'Retry-After': str(retry_after)})
+        try:
+            return handler(request)
+        finally:
+            release_slot(name, token)
+
+    return tween
+
+
+def get_view_key(request):
+    """ Return the name used to look up the request's limit: the last
+        element of API paths (API views are POSTed), or None for
+        other requests, which are not limited.
+    """
+    if request.method != 'POST':
+        return None
+    elements = [element for element in request.path_info.split('/')
+                if element]
+    if len(elements) < 2 or elements[0] != 'api':
+        return None
+    return elements[-1]
+
+
+def semaphore_key(name):
+    return 'admission:{}'.format(name)
+
+
+def acquire_slot(name, limit):
+    """ Wait for a slot in the named semaphore and return its token,
+        or return None if no slot became available in time.
+    """
+    global _acquire_script
+    if _acquire_script is None:
+        _acquire_script = app.redis.register_script(ACQUIRE_SCRIPT)
+    token = str(uuid.uuid4())
+    # A slot is held for at most the request's budget.
+    lease = float(app.get('request_deadline', DEFAULT_BUDGET)) + 5
+    wait = float(app.get('admission_wait', DEFAULT_WAIT))
+    left = remaining()
+    if left is not None:
+        wait = min(wait, left)
+    give_up_at = time.monotonic() + wait
+    while True:
+        now = time.time()
+        acquired = _acquire_script(
+            keys=[semaphore_key(name)],
+            args=[token, limit, now, now + lease])
+        if acquired:
+            return token
+        if time.monotonic() >= give_up_at:
+            return None
+        # Jitter the polling so that waiting workers do not retry in
+        # lock step.
+        time.sleep(POLL_INTERVAL * (0.5 + random.random()))
+
+
+def release_slot(name, token):
+    app.redis.zrem(semaphore_key(name), token)
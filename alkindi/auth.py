@@ -1,29 +1,53 @@
 
 from datetime import datetime
+import hashlib
+import json
 import time
 import uuid
 
-from oauthlib import oauth2
 from pyramid.authorization import ACLAuthorizationPolicy
-from pyramid.authentication import SessionAuthenticationPolicy
 from pyramid.httpexceptions import HTTPSeeOther
 from pyramid.security import remember, forget
-import requests
+from redis.exceptions import LockError
 
+from alkindi import http_client
+from alkindi.deadlines import http_timeout
 from alkindi.globals import app
+from alkindi.idp_profiles import (
+    load_profile_entry, is_fresh, conditional_headers, store_profile,
+    renew_profile_entry, is_profile_synced, mark_profile_synced)
+from alkindi.principals import get_cached_principals, cache_principals
+from alkindi.tokens import (
+    TokenAuthenticationPolicy, issue_token, reissue_token)
 from alkindi.model.users import (
     find_user_by_foreign_id, import_user, update_user,
     get_user_principals)
 from alkindi.model.team_members import (get_team_creator)
 from alkindi.model.participations import (
-    find_participation_by_code,
-    load_participation,
+    lookup_participation_code,
     mark_participation_code_entered
 )
+from alkindi.throttling import check_limits, count_events, get_client_ip
 
 
 ADMIN_GROUP = 'g:admin'
 
+# A token refresh holds its lock for at most REFRESH_LOCK_TIMEOUT
+# seconds; requests wait up to REFRESH_WAIT seconds for it, and reuse
+# its result for REFRESH_RESULT_TTL seconds (long enough for the
+# requests that waited, after which the session holds the new token).
+REFRESH_LOCK_TIMEOUT = 30
+REFRESH_WAIT = 10
+REFRESH_RESULT_TTL = REFRESH_WAIT + 5
+
+# Fields of a refreshed token that are shared with the waiting requests.
+REFRESH_SHARED_FIELDS = ('access_token', 'refresh_token')
+
+# Default limit on participation code logins: failed attempts per
+# client address in a window of the given length (in seconds).  Only
+# failures count, as a whole classroom may log in from one address.
+CODE_LOGIN_LIMITS = {'window': 300, 'ip_failures': 50}
+
 
 #
 # Pyramid routes and views
@@ -58,7 +82,7 @@ def set_authorization_policy(config):
 
 
 def set_authentication_policy(config):
-    authentication_policy = SessionAuthenticationPolicy(
+    authentication_policy = TokenAuthenticationPolicy(
         callback=authentication_callback)
     config.set_authentication_policy(authentication_policy)
 
@@ -87,8 +111,10 @@ def oauth_callback_view(request):
     user_id = find_user_by_foreign_id(request.db, profile['idUser'])
     if user_id is None:
         user_id = import_user(request.db, profile, now=datetime.utcnow())
-    else:
+        mark_profile_synced(request.db, profile)
+    elif not is_profile_synced(profile):
         update_user(request.db, user_id, profile)
+        mark_profile_synced(request.db, profile)
     request.db.commit()
     # Clear the user's cached principals to force them to be refreshed.
     reset_user_principals(request)
@@ -101,6 +127,7 @@ def oauth_callback_view(request):
     return {
         'user_id': user_id,
         'csrf_token': request.session.get_csrf_token(),
+        'token': issue_token(request, user_id),
         'origin': request.headers.get('Origin')
     }
 
@@ -132,7 +159,14 @@ def get_user_profile(request, foreign_id=None, refresh=True):
         Set refresh to False to disable automatic access token refresh.
         If the query fails or if the access token has expired and cannot
         be refreshed, None is returned.
+        Profiles requested by foreign_id are served from the cache (see
+        alkindi.idp_profiles) while they are fresh.
     """
+    entry = None
+    if foreign_id is not None:
+        entry = load_profile_entry(foreign_id)
+        if entry is not None and is_fresh(entry):
+            return entry['profile']
     access_token = get_oauth2_token(request, refresh)
     idp_uri = app['identity_provider_uri']
     params = {}
@@ -142,26 +176,45 @@ def get_user_profile(request, foreign_id=None, refresh=True):
         'Accept': 'application/json',
         'Authorization': 'Bearer {}'.format(access_token)
     }
-    req = requests.get(
-        idp_uri, headers=headers, verify='/etc/ssl/certs/ca-certificates.crt')
+    headers.update(conditional_headers(entry))
+    req = http_client.get(idp_uri, headers=headers)
+    if req.status_code == 304 and entry is not None:
+        renew_profile_entry(entry)
+        return entry['profile']
     req.raise_for_status()
     profile = req.json()
     if 'idUser' not in profile:
         raise RuntimeError('profile object has no idUser key')
+    store_profile(
+        profile, etag=req.headers.get('ETag'),
+        last_modified=req.headers.get('Last-Modified'))
     return profile
 
 
 def authentication_callback(userid, request):
-    principals = request.session.get('principals')
+    claims = request.token_claims
+    if claims is not None and not claims['stale']:
+        return claims['principals']
+    cached = getattr(request, 'user_principals', None)
+    if cached is not None and cached[0] == userid:
+        return cached[1]
+    principals = get_cached_principals(userid)
     if principals is None:
         principals = get_user_principals(request.db, userid)
         print("get_user_principals({}) = {}".format(userid, principals))
-        request.session['principals'] = principals
+        cache_principals(request, userid, principals)
+    request.user_principals = (userid, principals)
+    if claims is not None:
+        # Give the client a token with the current principals.
+        reissue_token(request)
     return principals
 
 
 def reset_user_principals(request):
-    request.session['principals'] = None
+    # The shared cache is invalidated by the model, only forget the
+    # principals looked up during this request.
+    request.user_principals = None
+    reissue_token(request)
 
 
 def get_by_admin(request):
@@ -204,7 +257,45 @@ def get_oauth2_token(request, refresh=True):
         del session['access_token']
         forget(request)
         raise AuthenticationError('access token has expired')
-    # Refresh the token.
+    token = refresh_oauth2_token(refresh_token)
+    return accept_oauth2_token(session, token)
+
+
+def refresh_oauth2_token(refresh_token):
+    """ Exchange a refresh token for a new token and return it.
+        Requests from the same session expire together; only one of
+        them posts the refresh token (which the identity provider
+        rotates), the others wait for and reuse its result.  Only a
+        successful result is shared, and only the fields that the
+        waiting requests store in the session.
+    """
+    key = 'oauth_refresh:{}'.format(
+        hashlib.sha256(refresh_token.encode('utf-8')).hexdigest())
+    result_key = key + ':result'
+    result = app.redis.get(result_key)
+    if result is not None:
+        return load_shared_token(result)
+    lock = app.redis.lock(key + ':lock', timeout=REFRESH_LOCK_TIMEOUT)
+    if not lock.acquire(blocking_timeout=http_timeout(REFRESH_WAIT)):
+        raise AuthenticationError('token refresh timed out')
+    try:
+        # The refresh may have completed while we waited for the lock.
+        result = app.redis.get(result_key)
+        if result is not None:
+            return load_shared_token(result)
+        token = post_refresh_token(refresh_token)
+        app.redis.setex(
+            result_key, REFRESH_RESULT_TTL, dump_shared_token(token))
+        return token
+    finally:
+        try:
+            lock.release()
+        except LockError:
+            # The lock has expired.
+            pass
+
+
+def post_refresh_token(refresh_token):
     refresh_uri = app['oauth_refresh_uri']
     headers = {
         'Accept': 'application/json',
@@ -217,11 +308,31 @@ def get_oauth2_token(request, refresh=True):
     body = get_oauth_client().prepare_refresh_body(
         client_id=client_id, client_secret=client_secret,
         refresh_token=refresh_token)
-    req = requests.post(
-        refresh_uri, headers=headers, data=body,
-        verify='/etc/ssl/certs/ca-certificates.crt')
+    req = http_client.post(refresh_uri, headers=headers, data=body)
+    if not 200 <= req.status_code < 300:
+        raise AuthenticationError(
+            'token refresh failed ({})'.format(req.status_code))
     token = req.json()
-    return accept_oauth2_token(session, token)
+    if 'error' in token:
+        raise AuthenticationError(format_error_value(token))
+    if token.get('access_token') is None or token.get('expires_in') is None:
+        raise AuthenticationError('invalid refreshed token')
+    return token
+
+
+def dump_shared_token(token):
+    shared = {
+        key: token[key] for key in REFRESH_SHARED_FIELDS if key in token
+    }
+    # The expiry is shared as a time, as the waiters use it later.
+    shared['expires_at'] = time.time() + int(token['expires_in'])
+    return json.dumps(shared)
+
+
+def load_shared_token(value):
+    token = json.loads(value.decode('utf-8'))
+    token['expires_in'] = int(token.pop('expires_at') - time.time())
+    return token
 
 
 def oauth2_provider_uri(request):
@@ -280,6 +391,8 @@ def accept_oauth2_token(session, token):
 
 
 def get_oauth_client():
+    # Only needed to log in and refresh tokens.
+    from oauthlib import oauth2
     client_id = app['oauth_client_id']
     return oauth2.WebApplicationClient(client_id)
 
@@ -302,10 +415,7 @@ def exchange_code_for_token(request, code, state, **kwargs):
         'Accept': 'application/json',
         'Content-Type': 'application/x-www-form-urlencoded'
     }
-    # XXX path to CA bundle should be pulled from configuration
-    req = requests.post(
-        token_uri, data=body, headers=headers,
-        verify='/etc/ssl/certs/ca-certificates.crt')
+    req = http_client.post(token_uri, data=body, headers=headers)
     req.raise_for_status()
     return req.json()
 
@@ -318,11 +428,17 @@ def login_with_participation_code(request):
     code = json_request.get('code')
     if code is None:
         return {'error': 'missing code'}
-    participation_id = find_participation_by_code(request.db, code)
-    if participation_id is None:
+    if not isinstance(code, str):
+        return {'error': 'invalid code'}
+    code = code.strip().lower()
+    counters, window = get_code_login_limits(request)
+    check_limits('code_login', counters, window)
+    found = lookup_participation_code(request.db, code)
+    if found is None:
+        count_events(
+            'code_login', [counter for counter, _ in counters], window)
         return {'error': 'no such participation'}
-    participation = load_participation(request.db, participation_id)
-    team_id = participation['team_id']
+    participation_id, team_id = found
     user_id = get_team_creator(request.db, team_id)
     mark_participation_code_entered(request.db, participation_id, now)
     request.db.commit()
@@ -334,5 +450,19 @@ def login_with_participation_code(request):
     return {
         'success': True,
         'user_id': user_id,
-        'csrf_token': request.session.get_csrf_token()
+        'csrf_token': request.session.get_csrf_token(),
+        'token': issue_token(request, user_id)
     }
+
+
+def get_code_login_limits(request):
+    """ Return the counters that limit guessing of participation codes
+        (failed attempts by client address), as (counter, limit) pairs,
+        and the length of their window.
+    """
+    limits = dict(CODE_LOGIN_LIMITS)
+    limits.update(app.get_json('code_login_limits', {}))
+    counters = [
+        ('ip:{}'.format(get_client_ip(request)), limits['ip_failures'])
+    ]
+    return counters, limits['window']
@@ -4,31 +4,54 @@ The Paster application entry point.
 
 from datetime import datetime, date
 import decimal
+import importlib
 import json
 import os
 import sys
+import time
 import traceback
 
 from pyramid.events import BeforeRender
 from pyramid.config import Configurator
 from pyramid.renderers import JSON
 from pyramid.renderers import render
+from pyramid.settings import asbool
 from pyramid.tweens import EXCVIEW
 
 from alkindi import helpers
 from alkindi.globals import app
+from alkindi.deadlines import DEFAULT_BUDGET, start_deadline, clear_deadline
 from alkindi.errors import ApplicationError
 from alkindi.database_adapters import MysqlAdapter
 
 
+# Modules that are imported on first use by the workers, but up front
+# when the application is preloaded, so that they are loaded once in
+# the master.
+LAZY_MODULES = ['ua_parser.user_agent_parser', 'oauthlib.oauth2', 'babel.dates']
+
+
 def application(_global_config, **settings):
     """ Returns the Pyramid WSGI application.
+        With gunicorn's preload_app setting, this runs once in the
+        master process and the workers fork from a ready application;
+        set alkindi.preload = true in the [app:main] section to also
+        import the lazily loaded modules in the master.
     """
 
+    started = time.perf_counter()
     print(
         "=== {}Z worker {} starting".format(
             datetime.utcnow().isoformat(), os.getpid()))
 
+    # Load the configuration and warm up the query compiler before
+    # the workers fork.
+    app.warm_up()
+    MysqlAdapter.warm_up()
+    if asbool(settings.get('alkindi.preload')):
+        for name in LAZY_MODULES:
+            importlib.import_module(name)
+
     config = Configurator(settings=settings)
     # config.include('pyramid_debugtoolbar')
     config.include(set_session_factory)
@@ -39,30 +62,40 @@ def application(_global_config, **settings):
 
     config.add_subscriber(log_api_failure, BeforeRender)
     config.add_subscriber(set_renderer_context, BeforeRender)
-    config.add_tween('alkindi.backend.transaction_manager_tween_factory',
+    config.add_tween('alkindi.backend.deadline_tween_factory',
                      under=EXCVIEW)
+    config.add_tween('alkindi.backend.transaction_manager_tween_factory',
+                     under='alkindi.backend.deadline_tween_factory')
 
     # Set up a json renderer that handles datetime objects.
     config.include(add_json_renderer)
 
     config.include('.contexts')
     config.include('.auth')
+    config.include('.tokens')
     config.include('.index')
     config.include('.misc')
+    config.include('.profiling')
+    config.include('.admission')
+    config.include('.http_client')
 
-    return config.make_wsgi_app()
-
+    # Start the process pool of the built-in task modules, if enabled.
+    from alkindi import task_runtime
+    task_runtime.warm_up()
 
-def get_redis(request, **kwargs):
-    return app.redis
+    wsgi_app = config.make_wsgi_app()
+    app.ready()
+    print(
+        "=== worker {} ready in {:.0f} ms".format(
+            os.getpid(), (time.perf_counter() - started) * 1000))
+    return wsgi_app
 
 
 def set_session_factory(config):
-    from pyramid_redis_sessions import RedisSessionFactory
-    settings = json.loads(app.get('session_settings', '{}'))
+    from alkindi.sessions import HashSessionFactory
+    settings = dict(app.get_json('session_settings', {}))
     settings['secret'] = app['session_secret']
-    settings['client_callable'] = get_redis
-    session_factory = RedisSessionFactory(**settings)
+    session_factory = HashSessionFactory(**settings)
     config.set_session_factory(session_factory)
 
 
@@ -149,6 +182,21 @@ def add_json_renderer(config):
     config.add_renderer('json', json_renderer)
 
 
+def deadline_tween_factory(handler, registry):
+
+    def tween(request):
+        # The DB adapter and the outbound HTTP calls made while handling
+        # the request consult the deadline (see alkindi.deadlines).
+        budget = float(app.get('request_deadline', DEFAULT_BUDGET))
+        start_deadline(budget)
+        try:
+            return handler(request)
+        finally:
+            clear_deadline()
+
+    return tween
+
+
 def transaction_manager_tween_factory(handler, registry):
 
     def tween(request):
@@ -173,5 +221,4 @@ def transaction_manager_tween_factory(handler, registry):
 
 
 def add_request_db(request):
-    mysql_connection = json.loads(app['mysql_connection'])
-    return MysqlAdapter(**mysql_connection)
+    return MysqlAdapter(**app.get_json('mysql_connection'))
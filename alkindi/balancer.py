@@ -0,0 +1,115 @@
+"""
+Load balancing across the endpoints of a task backend.
+
+tasks.backend_url may list several endpoints separated by whitespace,
+for example "http://10.0.0.1:8014/ http://10.0.0.2:8014/".  Each call
+goes to the healthy endpoint with the fewest outstanding requests,
+counted across all workers in redis (a sorted set of leases per
+endpoint, so that leases held by a killed worker expire).  An endpoint
+that fails to answer is taken out of rotation for `eject_for` seconds.
+
+The latencies of the calls to each task backend are also tracked in
+the worker, to decide when to send a hedged request (see tasks.py).
+"""
+
+from collections import defaultdict, deque
+import random
+import time
+import uuid
+
+from alkindi.globals import app
+
+
+# Number of recent latencies kept per (task, action), and the number of
+# samples needed to estimate the 95th percentile.
+LATENCY_SAMPLES = 200
+MIN_LATENCY_SAMPLES = 20
+
+# KEYS: load sets of the n endpoints, then their down keys;
+# ARGV: now, lease expiry, token, index of an endpoint to exclude (or 0).
+# Returns the (1-based) index of the selected endpoint.
+ACQUIRE_SCRIPT = """
+local n = #KEYS / 2
+local best, best_load, best_down = nil, nil, nil
+for i = 1, n do
+    if i ~= tonumber(ARGV[4]) then
+        redis.call('ZREMRANGEBYSCORE', KEYS[i], '-inf', ARGV[1])
+        local load = redis.call('ZCARD', KEYS[i])
+        local down = redis.call('EXISTS', KEYS[n + i])
+        if best == nil or down < best_down or
+                (down == best_down and load < best_load) then
+            best, best_load, best_down = i, load, down
+        end
+    end
+end
+if best == nil then
+    return 0
+end
+redis.call('ZADD', KEYS[best], ARGV[2], ARGV[3])
+return best
+"""
+
+_acquire_script = None
+_latencies = defaultdict(lambda: deque(maxlen=LATENCY_SAMPLES))
+
+
+def get_endpoints(task):
+    return task['backend_url'].split()
+
+
+def acquire_endpoint(endpoints, lease, exclude=None):
+    """ Select an endpoint and count a request to it.  Return the pair
+        (endpoint, token) to pass to release_endpoint, or None if no
+        endpoint is available (exclude is the only one).
+        Endpoints that are down are only selected if all are down.
+    """
+    global _acquire_script
+    if _acquire_script is None:
+        _acquire_script = app.redis.register_script(ACQUIRE_SCRIPT)
+    # Shuffle the endpoints to spread the load between equally loaded
+    # endpoints.
+    endpoints = list(endpoints)
+    random.shuffle(endpoints)
+    exclude_index = 0
+    if exclude in endpoints:
+        exclude_index = endpoints.index(exclude) + 1
+    token = str(uuid.uuid4())
+    now = time.time()
+    keys = [load_key(endpoint) for endpoint in endpoints] + \
+        [down_key(endpoint) for endpoint in endpoints]
+    index = _acquire_script(
+        keys=keys, args=[now, now + lease, token, exclude_index])
+    if index == 0:
+        return None
+    return endpoints[index - 1], token
+
+
+def release_endpoint(endpoint, token):
+    app.redis.zrem(load_key(endpoint), token)
+
+
+def mark_down(endpoint, seconds):
+    print("balancer: {} is down".format(endpoint))
+    app.redis.set(down_key(endpoint), 1, ex=max(1, int(seconds)))
+
+
+def record_latency(task_id, action, seconds):
+    _latencies[(task_id, action)].append(seconds)
+
+
+def get_latency_percentile(task_id, action, percentile=0.95):
+    """ Return the latency percentile of the recent calls made by this
+        worker, or None if there are too few of them.
+    """
+    samples = sorted(_latencies[(task_id, action)])
+    if len(samples) < MIN_LATENCY_SAMPLES:
+        return None
+    return samples[int(percentile * (len(samples) - 1))]
+
+
+def load_key(endpoint):
+    return 'backend_load:{}'.format(endpoint)
+
+
+def down_key(endpoint):
+    return 'backend_down:{}'.format(endpoint)
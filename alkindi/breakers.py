@@ -0,0 +1,145 @@
+"""
+Circuit breakers for the task backends, one per task, shared by all
+workers through redis.
+
+A breaker is closed while the backend answers.  It trips (opens) when,
+within a window of `window` seconds, at least `min_requests` calls were
+made and the fraction that failed reached `error_rate`.  While open,
+calls fail immediately with a ModelError.  After `open_for` seconds the
+breaker is half-open: a single call is let through as a probe, and
+closes the breaker if it succeeds or opens it again if it fails.
+
+The settings and the backend timeouts are configured in redis (key
+task_backends), with per-task overrides:
+
+    {"connect": 3.05, "read": 20, "tasks": {"3": {"read": 60}}}
+"""
+
+import time
+
+from alkindi.errors import ModelError
+from alkindi.globals import app
+
+
+DEFAULT_SETTINGS = {
+    # Timeouts (in seconds) of the calls to the backend.
+    'connect': 3.05,
+    'read': 20,
+    # Version of the backend protocol (see alkindi.tasks.post_referenced).
+    'protocol': 1,
+    # Tripping condition.
+    'window': 30,
+    'min_requests': 5,
+    'error_rate': 0.5,
+    # Time (in seconds) the breaker stays open before a probe.
+    'open_for': 30,
+    # Time (in seconds) a failing endpoint is taken out of rotation
+    # (see alkindi.balancer).
+    'eject_for': 10,
+    # Hedging of idempotent calls (see alkindi.tasks): a second request
+    # is sent after the 95th percentile of the latency, no sooner than
+    # hedge_min_delay, or after hedge_delay until it is known.
+    'hedge': True,
+    'hedge_delay': 2,
+    'hedge_min_delay': 0.2,
+}
+
+
+def get_settings(task_id):
+    config = app.get_json('task_backends', {})
+    settings = dict(DEFAULT_SETTINGS)
+    for key in DEFAULT_SETTINGS:
+        if key in config:
+            settings[key] = config[key]
+    settings.update(config.get('tasks', {}).get(str(task_id), {}))
+    return settings
+
+
+def before_call(task_id, settings):
+    """ Raise ModelError if the task's breaker is open.  Return True if
+        the call is a probe (the breaker is half-open).
+    """
+    redis = app.redis
+    is_open, is_tripped = redis.mget(
+        [open_key(task_id), tripped_key(task_id)])
+    if is_open is not None:
+        raise ModelError('task backend unavailable')
+    if is_tripped is None:
+        return False
+    # Half-open: let a single call through.
+    probe_ttl = int(settings['connect'] + settings['read']) + 5
+    if not redis.set(probe_key(task_id), 1, nx=True, ex=probe_ttl):
+        raise ModelError('task backend unavailable')
+    return True
+
+
+def record_success(task_id, settings, is_probe):
+    redis = app.redis
+    if is_probe:
+        print("breaker: task {} backend recovered".format(task_id))
+        redis.delete(
+            tripped_key(task_id), probe_key(task_id),
+            counters_key(task_id, settings))
+        return
+    record_call(task_id, settings, 'ok')
+
+
+def record_failure(task_id, settings, is_probe):
+    redis = app.redis
+    if is_probe:
+        trip(task_id, settings)
+        redis.delete(probe_key(task_id))
+        return
+    counts = record_call(task_id, settings, 'failed')
+    total = sum(counts.values())
+    failed = counts.get('failed', 0)
+    if total >= settings['min_requests'] and \
+            failed >= settings['error_rate'] * total:
+        trip(task_id, settings)
+
+
+#
+# Private definitions
+#
+
+
+def record_call(task_id, settings, outcome):
+    """ Count the call in the current window and return the counts of
+        the window.
+    """
+    key = counters_key(task_id, settings)
+    with app.redis.pipeline(transaction=False) as pipe:
+        pipe.hincrby(key, outcome, 1)
+        pipe.expire(key, int(settings['window']) * 2)
+        pipe.hgetall(key)
+        results = pipe.execute()
+    return {
+        name.decode('ascii'): int(value)
+        for name, value in results[2].items()
+    }
+
+
+def trip(task_id, settings):
+    print("breaker: task {} backend tripped".format(task_id))
+    with app.redis.pipeline(transaction=False) as pipe:
+        pipe.set(open_key(task_id), 1, ex=int(settings['open_for']))
+        pipe.set(tripped_key(task_id), 1)
+        pipe.delete(counters_key(task_id, settings))
+        pipe.execute()
+
+
+def open_key(task_id):
+    return 'breaker:{}:open'.format(task_id)
+
+
+def tripped_key(task_id):
+    return 'breaker:{}:tripped'.format(task_id)
+
+
+def probe_key(task_id):
+    return 'breaker:{}:probe'.format(task_id)
+
+
+def counters_key(task_id, settings):
+    window_index = int(time.time() // settings['window'])
+    return 'breaker:{}:{}'.format(task_id, window_index)
@@ -3,21 +3,81 @@ import mysql.connector as mysql
 from sqlbuilder.smartsql import Q, T, Query, Result
 from sqlbuilder.smartsql.compilers.mysql import compile as mysql_compile
 import json
-from alkindi.errors import ModelError
+import math
+import time
+from alkindi.deadlines import check_deadline, is_expired, remaining
+from alkindi.errors import DeadlineError, ModelError
+
+
+# MySQL errors that indicate that a statement ran out of time:
+# ER_LOCK_WAIT_TIMEOUT and ER_QUERY_TIMEOUT (MAX_EXECUTION_TIME).
+TIMEOUT_ERRNOS = (1205, 3024)
 
 
 class MysqlAdapter:
 
     tables = T
 
+    @classmethod
+    def warm_up(cls):
+        """ Compile a few representative queries, so that sqlbuilder's
+            compiler dispatch is populated before the workers fork
+            rather than on the first request of every worker.
+            A failure is logged, the queries are then compiled on
+            first use as usual.
+        """
+        try:
+            cls.compile_sample_queries()
+        except Exception as ex:
+            print("sqlbuilder warm-up failed: {!r}".format(ex))
+
+    @classmethod
+    def compile_sample_queries(cls):
+        result = Result(mysql_compile)
+        users = T.users
+        team_members = T.team_members
+        query = Q(
+            users & team_members.on(team_members.user_id == users.id),
+            result=result)
+        query = query \
+            .fields(users.id, team_members.team_id) \
+            .where(users.id == 0) \
+            .order_by(users.created_at.desc())
+        query[0:1].select(for_update=True)
+        query.count()
+        query = Q(users, result=result)
+        query.insert({users.team_id: None})
+        query.where(users.id.in_([0])).update({users.team_id: 0})
+        query.where(users.id == 0).delete()
+
     def __init__(self, **kwargs):
+        # Bound the connection attempt and socket reads by the request
+        # deadline.
+        check_deadline('database')
+        left = remaining()
+        if left is not None:
+            kwargs.setdefault('connection_timeout', max(1, math.ceil(left)))
         self.db = mysql.connect(**kwargs)
         self.result = Result(mysql_compile)
         self.log = True
         self.connected = False
+        self.commit_callbacks = []
+        self.rollback_callbacks = []
+        # Time at which the current transaction's snapshot was taken.
+        self.started_at = None
 
 
     def start_transaction(self):
+        left = remaining()
+        if left is not None:
+            # Row and table lock waits cannot outlast the request.
+            cursor = self.db.cursor()
+            cursor.execute(
+                'SET SESSION innodb_lock_wait_timeout = %s, '
+                'lock_wait_timeout = %s',
+                (max(1, math.ceil(left)),) * 2)
+            cursor.close()
+        self.started_at = time.time()
         self.db.start_transaction(
             consistent_snapshot=True,
             isolation_level='REPEATABLE READ')
@@ -35,11 +95,18 @@ class MysqlAdapter:
             values = ()
         else:
             raise ModelError("invalid query type: {}".format(query))
+        check_deadline('database')
+        stmt = self.limit_execution_time(stmt)
         try:
             if self.log:
                 print("[SQL] {};".format(stmt % tuple(values)))
             cursor = self.db.cursor()
-            cursor.execute(stmt, values)
+            try:
+                cursor.execute(stmt, values)
+            except mysql.Error as ex:
+                if ex.errno in TIMEOUT_ERRNOS or is_expired():
+                    raise DeadlineError('database deadline exceeded', ex)
+                raise
             return cursor
         except mysql.IntegrityError as ex:
             raise ModelError('integrity error', ex)
@@ -51,6 +118,16 @@ class MysqlAdapter:
                 mysql.NotSupportedError) as ex:
             raise ModelError('programming error', format(stmt))
 
+    def limit_execution_time(self, stmt):
+        """ Add a MAX_EXECUTION_TIME optimizer hint to SELECT statements
+            so that MySQL aborts them when the request deadline passes.
+        """
+        left = remaining()
+        if left is None or not stmt.startswith('SELECT '):
+            return stmt
+        return 'SELECT /*+ MAX_EXECUTION_TIME({}) */ {}'.format(
+            max(1, int(left * 1000)), stmt[7:])
+
     def scalar(self, query):
         cursor = self.execute(query.select())
         row = cursor.fetchone()
@@ -105,11 +182,32 @@ class MysqlAdapter:
             raise ModelError('database is unavailable')
 
     def rollback(self):
+        self.commit_callbacks = []
+        callbacks, self.rollback_callbacks = self.rollback_callbacks, []
         if self.connected:
             self.db.rollback()
+        run_callbacks(callbacks, 'after_rollback')
 
     def commit(self):
         self.db.commit()
+        self.rollback_callbacks = []
+        callbacks, self.commit_callbacks = self.commit_callbacks, []
+        # The transaction is committed, a failing callback must not turn
+        # the request into an error.
+        run_callbacks(callbacks, 'after_commit')
+
+    def after_commit(self, callback):
+        """ Call callback once the current transaction is committed.
+            The callback is dropped if the transaction is rolled back.
+        """
+        self.commit_callbacks.append(callback)
+
+    def after_rollback(self, callback):
+        """ Call callback if the current transaction is rolled back
+            (including after a failed commit).
+            The callback is dropped if the transaction is committed.
+        """
+        self.rollback_callbacks.append(callback)
 
     def close(self):
         if self.connected:
@@ -208,3 +306,11 @@ class MysqlAdapter:
 
     def log_error(self, error):
         self.insert_row(self.tables.errors, error)
+
+
+def run_callbacks(callbacks, what):
+    for callback in callbacks:
+        try:
+            callback()
+        except Exception as ex:
+            print("{} callback failed: {!r}".format(what, ex))
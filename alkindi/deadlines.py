@@ -0,0 +1,111 @@
+"""
+Per-request time budget.
+
+The deadline is set by a tween when a request starts and is consulted
+by the database adapter and by every outbound HTTP call, so that a
+stuck task backend or a long lock wait makes the request fail with a
+DeadlineError instead of holding the worker until it is killed.
+
+The deadline is stored in thread-local storage, so that code outside
+of views (such as alkindi.tasks) does not need access to the request.
+Work handed to other threads takes the deadline along (get_deadline
+in the submitting thread, use_deadline in the other one).
+"""
+
+from contextlib import contextmanager
+import threading
+import time
+
+import requests
+
+from alkindi.errors import DeadlineError
+
+
+# Default request budget, in seconds.  It must stay well below the
+# server's own limit (harakiri = 60 in config.ini).
+DEFAULT_BUDGET = 30
+
+# Timeout applied to outbound HTTP calls made outside of a request.
+DEFAULT_HTTP_TIMEOUT = 30
+
+_state = threading.local()
+
+
+def start_deadline(budget):
+    """ Set the deadline for the current thread to budget seconds from
+        now.  A budget of None disables the deadline.
+    """
+    _state.deadline = None if budget is None else time.monotonic() + budget
+
+
+def clear_deadline():
+    _state.deadline = None
+
+
+def get_deadline():
+    return getattr(_state, 'deadline', None)
+
+
+@contextmanager
+def use_deadline(deadline):
+    """ Run a block under a deadline obtained with get_deadline,
+        possibly in another thread.
+    """
+    previous = get_deadline()
+    _state.deadline = deadline
+    try:
+        yield
+    finally:
+        _state.deadline = previous
+
+
+def remaining():
+    """ Return the number of seconds left before the deadline, or None
+        if there is no deadline.
+    """
+    deadline = getattr(_state, 'deadline', None)
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def is_expired():
+    left = remaining()
+    return left is not None and left <= 0
+
+
+def check_deadline(what='request'):
+    """ Raise DeadlineError if the deadline has passed.
+    """
+    if is_expired():
+        raise DeadlineError('deadline exceeded', what)
+
+
+def http_timeout(default=DEFAULT_HTTP_TIMEOUT):
+    """ Return the timeout (in seconds) for an outbound HTTP call,
+        bounded by both default and the time left before the deadline.
+        DeadlineError is raised if the deadline has passed.
+    """
+    left = remaining()
+    if left is None:
+        return default
+    if left <= 0:
+        raise DeadlineError('deadline exceeded', 'http')
+    return left if default is None else min(left, default)
+
+
+@contextmanager
+def http_deadline(url, default=DEFAULT_HTTP_TIMEOUT):
+    """ Yield the timeout to use for an HTTP call to url, and turn
+        a timeout into a DeadlineError: one that names the url (with
+        the requests exception as cause) if the call ran out of its
+        own timeout, 'deadline exceeded' if the timeout was shortened
+        by the deadline.
+    """
+    timeout = http_timeout(default)
+    try:
+        yield timeout
+    except requests.Timeout as ex:
+        if default is not None and timeout >= default:
+            raise DeadlineError('timed out: {}'.format(url), ex)
+        raise DeadlineError('deadline exceeded', 'http')
@@ -13,3 +13,7 @@ class ModelError(ApplicationError):
 
 class ApiError(ApplicationError):
     pass
+
+
+class DeadlineError(ApplicationError):
+    pass
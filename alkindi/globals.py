@@ -5,8 +5,11 @@ import codecs
 import json
 import locale
 import logging
+import threading
+import time
 
-from redis import StrictRedis
+from redis import BlockingConnectionPool, StrictRedis
+from redis.exceptions import RedisError
 
 from .utils import as_int
 
@@ -14,6 +17,43 @@ from .utils import as_int
 __all__ = ['app']
 
 
+# Configuration keys read by the application, see configure.sh.
+CONFIG_KEYS = [
+    'configured', 'assets_timestamp',
+    'session_secret', 'session_settings',
+    'oauth_client_id', 'oauth_client_secret', 'oauth_authorise_uri',
+    'oauth_token_uri', 'oauth_refresh_uri', 'identity_provider_uri',
+    'logout_uri', 'requested_badge', 'add_badge_uri',
+    'mysql_connection', 'error_log_target',
+    'assets_pregenerator', 'nocdn_assets_pregenerator',
+    'profiler_interval', 'profiler_ttl', 'request_deadline',
+    'admission_limits', 'admission_wait', 'admission_retry_after',
+    'catalogue_path', 'catalogue_version',
+    'http_timeouts', 'http_pool_size', 'ca_bundle', 'principals_ttl',
+    'jwt_secret', 'jwt_ttl', 'jwt_check_after', 'profile_ttl',
+    'code_login_limits', 'task_backends', 'grading_mode', 'grading_workers',
+    'task_runtime',
+]
+
+# The configuration version is incremented and published on this
+# channel whenever the configuration changes (see publish_config).
+CONFIG_VERSION_KEY = 'config_version'
+CONFIG_CHANNEL = 'config'
+
+
+class ConfigSnapshot:
+    """ The configuration values loaded at a given version, and the
+        decoded JSON values (filled as they are requested).
+        A snapshot is replaced as a whole when the configuration is
+        reloaded, so that a reader never sees a mix of two versions.
+    """
+
+    def __init__(self, version, values):
+        self.version = version
+        self.values = values
+        self.parsed = dict()
+
+
 class Globals:
     """ A single instance of this class is used for global state that
         persists across requests, that is reused during a request, or
@@ -30,7 +70,11 @@ class Globals:
         self.logger = logging.getLogger("alkindi")
         # The redis connection is established at first use.
         self._redis = None
-        self._dict = dict()
+        self._config = None
+        self._watcher = None
+        self._watcher_lock = threading.Lock()
+        # Set while the application is being built (see warm_up).
+        self._watcher_deferred = False
         self._assets_pregenerator = None
 
     @property
@@ -43,23 +87,120 @@ class Globals:
         db = as_int(os.environ.get('REDIS_DB', '0'))
         return {'host': host, 'port': port, 'db': db}
 
+    @property
+    def redis_pool_settings(self):
+        """ Retrieve the connection pool settings from the environment.
+            The pool is shared by the threads of a process (requests,
+            configuration watcher), a thread waits up to timeout seconds
+            for a free connection.  Idle connections are checked before
+            reuse after health_check_interval seconds.
+        """
+        env = os.environ
+        return {
+            'max_connections': as_int(env.get('REDIS_MAX_CONNECTIONS', '16')),
+            'timeout': as_int(env.get('REDIS_POOL_TIMEOUT', '5')),
+            'health_check_interval':
+                as_int(env.get('REDIS_HEALTH_CHECK_INTERVAL', '30')),
+            'socket_keepalive': True,
+        }
+
     @property
     def redis(self):
         if self._redis is None:
-            self._redis = StrictRedis(**self.redis_settings)
-            if self.get('configured') != 'yes':
-                self.logger.fatal("redis is not configured, see configure.sh")
-                sys.exit(4)
+            settings = dict(self.redis_settings)
+            settings.update(self.redis_pool_settings)
+            pool = BlockingConnectionPool(**settings)
+            self._redis = StrictRedis(connection_pool=pool)
         return self._redis
 
+    @property
+    def config(self):
+        if self._config is None:
+            self.load_config()
+        if self._watcher is None and not self._watcher_deferred:
+            self.start_config_watcher()
+        return self._config
+
+    def load_config(self):
+        """ Load all the known configuration keys in a single MGET and
+            install them as the current snapshot.
+            The application exits if redis has not been configured.
+        """
+        keys = [CONFIG_VERSION_KEY] + CONFIG_KEYS
+        values = [
+            None if value is None else codecs.decode(value)
+            for value in self.redis.mget(keys)
+        ]
+        config = ConfigSnapshot(values[0], dict(zip(keys, values)))
+        if self._config is None and config.values['configured'] != 'yes':
+            self.logger.fatal("redis is not configured, see configure.sh")
+            sys.exit(4)
+        self._config = config
+        print("=== worker {} loaded configuration version {}".format(
+            os.getpid(), values[0]))
+
+    def publish_config(self):
+        """ Notify all workers that the configuration has changed.
+            configure.sh does the same using redis-cli.
+        """
+        version = self.redis.incr(CONFIG_VERSION_KEY)
+        self.redis.publish(CONFIG_CHANNEL, version)
+        return version
+
+    def start_config_watcher(self):
+        with self._watcher_lock:
+            if self._watcher is not None:
+                return
+            self._watcher = threading.Thread(
+                target=self.watch_config, name='alkindi-config',
+                daemon=True)
+            self._watcher.start()
+
+    def watch_config(self):
+        """ Reload the configuration whenever a new version is published.
+        """
+        while True:
+            pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.subscribe(CONFIG_CHANNEL)
+                # A version may have been published while we were not
+                # subscribed (before the worker forked, or while the
+                # connection was down).
+                version = self.redis.get(CONFIG_VERSION_KEY)
+                if version is not None:
+                    version = codecs.decode(version)
+                if version != self._config.version:
+                    self.load_config()
+                for message in pubsub.listen():
+                    self.load_config()
+            except RedisError as ex:
+                self.logger.warning("config watcher: {}".format(ex))
+                time.sleep(1)
+            finally:
+                pubsub.close()
+
     def get(self, key, default=None):
-        if key in self._dict:
-            value = self._dict[key]
+        config = self.config
+        if key in config.values:
+            value = config.values[key]
         else:
+            # Keys missing from CONFIG_KEYS are loaded on first use.
             value = self.redis.get(key)
             if value is not None:
                 value = codecs.decode(value)
-            self._dict[key] = value
+            config.values[key] = value
+        return value if value is not None else default
+
+    def get_json(self, key, default=None):
+        """ Return the decoded JSON value of a configuration key.
+            The value is decoded once per configuration version and is
+            shared, callers must not modify it.
+        """
+        config = self.config
+        if key not in config.parsed:
+            value = self.get(key)
+            config.parsed[key] = None if value is None else json.loads(value)
+        value = config.parsed[key]
         return value if value is not None else default
 
     def __getitem__(self, key):
@@ -68,9 +209,39 @@ class Globals:
             raise KeyError('missing redis key {}'.format(key))
         return value
 
+    def warm_up(self):
+        """ Load all the configuration keys.
+            When the application is preloaded (gunicorn's preload_app),
+            this runs once in the master and the values are inherited
+            by the workers.  The configuration watcher is not started
+            until ready() is called.
+        """
+        self._watcher_deferred = True
+        self.load_config()
+        for key in ['session_settings', 'mysql_connection']:
+            self.get_json(key)
+
+    def ready(self):
+        """ Called once the application is built.  The watcher is
+            started on the next use of the configuration, which is
+            in a worker: gunicorn's master does not serve requests.
+        """
+        self._watcher_deferred = False
+
+    def after_fork(self):
+        """ Drop the connections inherited from the parent process.
+            A redis socket shared by the master and several workers
+            would interleave their replies.
+            The watcher thread does not survive the fork, it is started
+            again on first use of the configuration.
+        """
+        self._redis = None
+        self._watcher = None
+        self._watcher_lock = threading.Lock()
+
     def assets_pregenerator(self):
-        cdn_dict = json.loads(self.get('assets_pregenerator', '{}'))
-        nocdn_dict = json.loads(self.get('nocdn_assets_pregenerator', '{}'))
+        cdn_dict = self.get_json('assets_pregenerator', {})
+        nocdn_dict = self.get_json('nocdn_assets_pregenerator', {})
 
         def pregenerator(request, elements, kwargs):
             if 'nocdn' in request.params:
@@ -87,3 +258,7 @@ class Globals:
 
 
 app = Globals()
+
+# Python 3.7+: reset the inherited connections in forked workers.
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=app.after_fork)
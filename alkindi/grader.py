@@ -0,0 +1,184 @@
+"""
+Grading worker, for the asynchronous grading mode:
+
+    python -m alkindi.grader
+
+When grading_mode is "async", submitted answers are stored as pending
+and queued in redis, one queue per task (see submit_answer).  This
+worker grades them from a pool of threads, with at most `per_task`
+concurrent calls to the backend of each task, and records the grading
+and the attempt and participation updates (see grade_pending_answer).
+Clients poll the answer_status action, or subscribe to the redis
+channel answer_graded:<attempt_id>.
+
+An answer whose grading fails is graded again after a delay that
+doubles on each failure (starting at retry_delay seconds).  After
+`retries` retries it is marked as failed, which clients see.
+
+The settings are configured in redis (key grading_workers), and apply
+to each running worker:
+
+    {"threads": 16, "per_task": 4, "retries": 3, "retry_delay": 10}
+
+On start, the worker queues the answers left pending by a previous run
+(once, even if several workers start).
+"""
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import sys
+import threading
+import time
+
+from alkindi.globals import app
+from alkindi.database_adapters import MysqlAdapter
+from alkindi.model.answers import (
+    GRADING_TASKS_KEY, grade_pending_answer, grading_queue_key,
+    is_retry_scheduled, load_pending_answer_ids, mark_answer_failed,
+    queue_answer, queue_due_retries, schedule_answer_retry)
+
+
+DEFAULT_SETTINGS = {
+    'threads': 16,
+    'per_task': 4,
+    # Number of times an answer is graded again after a failure before
+    # it is marked as failed.
+    'retries': 3,
+    # Delay (in seconds) before the first retry, doubled for each
+    # following one.
+    'retry_delay': 10,
+}
+
+# Failure counts of the answers being retried, shared by the workers.
+FAILURES_KEY = 'grading_failures'
+
+# Time (in seconds) the worker blocks on the queues before looking for
+# new tasks.
+POLL_TIMEOUT = 5
+
+
+def main(argv):
+    settings = get_settings()
+    requeue_pending_answers()
+    executor = ThreadPoolExecutor(max_workers=settings['threads'])
+    busy = Counter()
+    idle = threading.Condition()
+
+    def run(task_id, answer_id):
+        try:
+            if grade(answer_id):
+                app.redis.hdel(FAILURES_KEY, answer_id)
+            else:
+                retry_later(settings, task_id, answer_id)
+        finally:
+            with idle:
+                busy[task_id] -= 1
+                idle.notify()
+
+    print("grader: started with {}".format(settings))
+    while True:
+        queue_due_retries(time.time())
+        task_ids = get_task_ids()
+        with idle:
+            if sum(busy.values()) >= settings['threads']:
+                idle.wait(POLL_TIMEOUT)
+                continue
+            task_ids = [
+                task_id for task_id in task_ids
+                if busy[task_id] < settings['per_task']
+            ]
+        if len(task_ids) == 0:
+            with idle:
+                idle.wait(POLL_TIMEOUT)
+            continue
+        item = app.redis.brpop(
+            [grading_queue_key(task_id) for task_id in task_ids],
+            timeout=POLL_TIMEOUT)
+        if item is None:
+            continue
+        key, answer_id = item
+        task_id = int(key.decode('ascii').rsplit(':', 1)[1])
+        with idle:
+            busy[task_id] += 1
+        executor.submit(run, task_id, int(answer_id))
+
+
+def grade(answer_id):
+    """ Grade the answer in a transaction of its own.  Return False if
+        grading failed.
+    """
+    db = MysqlAdapter(**app.get_json('mysql_connection'))
+    db.log = False
+    try:
+        db.ensure_connected()
+        db.start_transaction()
+        answer = grade_pending_answer(db, answer_id, datetime.utcnow())
+        db.commit()
+        if answer is not None:
+            print("grader: answer {} scored {}".format(
+                answer_id, answer['score']))
+        return True
+    except Exception as ex:
+        db.rollback()
+        print("grader: answer {} failed: {}".format(answer_id, ex))
+        return False
+    finally:
+        db.close()
+
+
+def retry_later(settings, task_id, answer_id):
+    failures = app.redis.hincrby(FAILURES_KEY, answer_id, 1)
+    if failures <= settings['retries']:
+        delay = settings['retry_delay'] * 2 ** (failures - 1)
+        schedule_answer_retry(task_id, answer_id, time.time() + delay)
+        return
+    app.redis.hdel(FAILURES_KEY, answer_id)
+    db = MysqlAdapter(**app.get_json('mysql_connection'))
+    db.log = False
+    try:
+        db.ensure_connected()
+        db.start_transaction()
+        mark_answer_failed(db, answer_id, datetime.utcnow())
+        db.commit()
+        print("grader: answer {} failed {} times, giving up".format(
+            answer_id, failures))
+    except Exception as ex:
+        db.rollback()
+        print("grader: answer {} could not be marked as failed: {}".format(
+            answer_id, ex))
+    finally:
+        db.close()
+
+
+def requeue_pending_answers():
+    db = MysqlAdapter(**app.get_json('mysql_connection'))
+    db.log = False
+    try:
+        db.ensure_connected()
+        pending = load_pending_answer_ids(db)
+    finally:
+        db.close()
+    count = 0
+    for task_id, answer_id in pending:
+        if not is_retry_scheduled(task_id, answer_id):
+            queue_answer(task_id, answer_id, dedupe=True)
+            count += 1
+    print("grader: queued {} pending answers".format(count))
+
+
+def get_settings():
+    config = app.get_json('grading_workers', {})
+    settings = dict(DEFAULT_SETTINGS)
+    for key in DEFAULT_SETTINGS:
+        if key in config:
+            settings[key] = int(config[key])
+    return settings
+
+
+def get_task_ids():
+    return [int(task_id) for task_id in app.redis.smembers(GRADING_TASKS_KEY)]
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
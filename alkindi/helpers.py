@@ -1,6 +1,5 @@
 
 import iso8601
-from babel.dates import format_date, format_datetime
 from pyramid.renderers import render
 
 
@@ -33,6 +32,8 @@ def localize_date(value, locale='fr_FR'):
     """
     Formats a date object or an iso8601 string with the given locale.
     """
+    # Babel loads its locale data on import, keep it off the startup path.
+    from babel.dates import format_date
     if value is None:
         return None
     if isinstance(value, str):
@@ -44,6 +45,7 @@ def localize_datetime(value, locale='fr_FR'):
     """
     Formats a datetime object or an iso8601 string with the given locale.
     """
+    from babel.dates import format_datetime
     if value is None:
         return None
     if isinstance(value, str):
@@ -0,0 +1,194 @@
+"""
+Process-wide HTTP client for the identity provider, the badge endpoint
+and the task backends.
+
+All outbound calls share a requests session with a keep-alive
+connection pool per host, and a single SSL context that loads the CA
+bundle once per process (rather than once per connection).  Timeouts
+are configured in redis (http_timeouts) and bounded by the request
+deadline.
+
+Per-host statistics (requests, connections opened, latency) are
+available to admins at /stats/http.
+"""
+
+from collections import defaultdict
+import os
+import ssl
+import threading
+import time
+import urllib.parse
+
+from pyramid.httpexceptions import HTTPForbidden
+import requests
+from requests.adapters import HTTPAdapter
+
+from alkindi.deadlines import http_deadline
+from alkindi.globals import app
+
+
+DEFAULT_CA_BUNDLE = '/etc/ssl/certs/ca-certificates.crt'
+DEFAULT_POOL_SIZE = 10
+
+# Default connect and read timeouts, in seconds.  They can be set in
+# redis, globally and per host:
+#   {"connect": 3.05, "read": 30, "hosts": {"127.0.0.1:8014": {"read": 60}}}
+DEFAULT_TIMEOUTS = {'connect': 3.05, 'read': 30}
+
+_session = None
+_session_lock = threading.Lock()
+_latency = defaultdict(lambda: {'count': 0, 'errors': 0, 'total': 0, 'max': 0})
+
+
+def includeme(config):
+    config.add_route('http_stats', '/stats/http', request_method='GET')
+    config.add_view(http_stats_view, route_name='http_stats', renderer='json')
+
+
+def http_stats_view(request):
+    if not request.by_admin:
+        raise HTTPForbidden()
+    return {'success': True, 'pid': os.getpid(), 'hosts': get_stats()}
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
+
+
+def request(method, url, timeouts=None, **kwargs):
+    """ Perform an HTTP request using the shared session and return the
+        requests.Response.  The timeouts are taken from the configuration
+        unless given (as a dict with 'connect' and 'read' keys), and are
+        bounded by the request deadline; a timeout is reported as a
+        DeadlineError.
+    """
+    host = get_host(url)
+    if timeouts is None:
+        timeouts = get_timeouts(host)
+    started = time.perf_counter()
+    stats = _latency[host]
+    try:
+        with http_deadline(url, timeouts['read']) as read_timeout:
+            connect_timeout = min(timeouts['connect'], read_timeout)
+            response = get_session().request(
+                method, url, timeout=(connect_timeout, read_timeout),
+                **kwargs)
+    except Exception:
+        stats['errors'] += 1
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        stats['count'] += 1
+        stats['total'] += elapsed
+        stats['max'] = max(stats['max'], elapsed)
+    return response
+
+
+def get_host(url):
+    parts = urllib.parse.urlsplit(url)
+    return parts.netloc
+
+
+def get_timeouts(host):
+    config = app.get_json('http_timeouts', {})
+    timeouts = dict(DEFAULT_TIMEOUTS)
+    for key in DEFAULT_TIMEOUTS:
+        if key in config:
+            timeouts[key] = config[key]
+    timeouts.update(config.get('hosts', {}).get(host, {}))
+    return timeouts
+
+
+def get_session():
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = make_session()
+    return _session
+
+
+def make_session():
+    session = requests.Session()
+    pool_size = int(app.get('http_pool_size', DEFAULT_POOL_SIZE))
+    adapter = PooledAdapter(
+        make_ssl_context(),
+        pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def make_ssl_context():
+    ca_bundle = app.get('ca_bundle', DEFAULT_CA_BUNDLE)
+    if os.path.isfile(ca_bundle):
+        return ssl.create_default_context(cafile=ca_bundle)
+    return ssl.create_default_context()
+
+
+class PooledAdapter(HTTPAdapter):
+    """ An adapter whose connection pools share an SSL context.
+    """
+
+    def __init__(self, ssl_context, **kwargs):
+        self.ssl_context = ssl_context
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['ssl_context'] = self.ssl_context
+        super().init_poolmanager(*args, **kwargs)
+
+    def cert_verify(self, conn, url, verify, cert):
+        super().cert_verify(conn, url, verify, cert)
+        if url.lower().startswith('https') and verify is not False:
+            # The shared context already holds the CA bundle, do
+            # not have urllib3 load it again for each connection.
+            conn.ca_certs = None
+            conn.ca_cert_dir = None
+
+
+def get_stats():
+    """ Return the per-host statistics of the current process: number
+        of requests and errors, latency (in ms), and the number of
+        connections opened (requests - connections were served over a
+        reused connection).
+    """
+    stats = {}
+    for host, latency in list(_latency.items()):
+        count = latency['count']
+        stats[host] = {
+            'requests': count,
+            'errors': latency['errors'],
+            'avg_ms': round(latency['total'] * 1000 / count, 1) if count else None,
+            'max_ms': round(latency['max'] * 1000, 1),
+            'connections': 0,
+        }
+    if _session is not None:
+        for adapter in set(_session.adapters.values()):
+            for pool in list(adapter.poolmanager.pools.values()):
+                host = pool.host if pool.port is None else \
+                    '{}:{}'.format(pool.host, pool.port)
+                if host not in stats:
+                    # Default ports are omitted from the url netloc.
+                    host = pool.host
+                if host in stats:
+                    stats[host]['connections'] += pool.num_connections
+    return stats
+
+
+def reset_after_fork():
+    """ Connections inherited from the parent process must not be used
+        by the child.
+    """
+    global _session, _session_lock
+    _session = None
+    _session_lock = threading.Lock()
+    _latency.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_after_fork)
@@ -0,0 +1,134 @@
+"""
+Cache of the user profiles returned by the identity provider.
+
+Profiles are cached in redis by foreign id for profile_ttl seconds.
+Expired entries are kept for a while longer, and revalidated with a
+conditional request (If-None-Match / If-Modified-Since) if the identity
+provider returned an ETag or a Last-Modified header, so that an
+unchanged profile is not transferred again.  Entries are marked stale
+when the user's badges change, which forces such a conditional request
+(the profile fetched at login, whose foreign id is not known in
+advance, is stored for these later requests).
+
+The fingerprint of the last profile written to the users table is also
+kept, so that logging in does not update the user's row when their
+profile has not changed.
+"""
+
+import hashlib
+import json
+import time
+
+from alkindi.globals import app
+
+
+DEFAULT_TTL = 300
+
+# Expired entries are kept REVALIDATE_FACTOR times longer than their
+# TTL, for conditional requests.
+REVALIDATE_FACTOR = 12
+
+# The fingerprint of the profile stored in the users table is kept for
+# SYNCED_TTL seconds.
+SYNCED_TTL = 30 * 86400
+
+# Profile fields copied to the users table (see update_user).
+SYNCED_FIELDS = ('idUser', 'sLogin', 'sFirstName', 'sLastName', 'aBadges')
+
+
+def load_profile_entry(foreign_id):
+    """ Return the cache entry for foreign_id, or None.
+        An entry holds the profile, the time it was fetched, and the
+        validators (etag, last_modified) returned with it.
+    """
+    value = app.redis.get(profile_key(foreign_id))
+    if value is None:
+        return None
+    return json.loads(value.decode('utf-8'))
+
+
+def is_fresh(entry):
+    return entry['fetched_at'] + get_ttl() > time.time()
+
+
+def conditional_headers(entry):
+    """ Return the headers that make a request for the profile in entry
+        conditional.
+    """
+    headers = {}
+    if entry is None:
+        return headers
+    if entry.get('etag') is not None:
+        headers['If-None-Match'] = entry['etag']
+    if entry.get('last_modified') is not None:
+        headers['If-Modified-Since'] = entry['last_modified']
+    return headers
+
+
+def store_profile(profile, etag=None, last_modified=None):
+    entry = {
+        'profile': profile,
+        'fetched_at': time.time(),
+        'etag': etag,
+        'last_modified': last_modified
+    }
+    save_entry(entry)
+
+
+def renew_profile_entry(entry):
+    """ The identity provider confirmed that the profile in entry has
+        not changed, restart its TTL.
+    """
+    entry['fetched_at'] = time.time()
+    save_entry(entry)
+
+
+def mark_profile_stale(foreign_id):
+    """ Have the next lookup of the profile revalidate it, keeping its
+        validators for the conditional request.
+    """
+    entry = load_profile_entry(foreign_id)
+    if entry is not None:
+        entry['fetched_at'] = 0
+        save_entry(entry)
+
+
+def is_profile_synced(profile):
+    """ Return whether profile is the one last written to the users
+        table.
+    """
+    synced = app.redis.get(synced_key(profile['idUser']))
+    return synced is not None and \
+        synced.decode('ascii') == profile_fingerprint(profile)
+
+
+def mark_profile_synced(db, profile):
+    """ Record that profile has been written to the users table, once
+        the current transaction is committed.
+    """
+    key = synced_key(profile['idUser'])
+    fingerprint = profile_fingerprint(profile)
+    db.after_commit(lambda: app.redis.setex(key, SYNCED_TTL, fingerprint))
+
+
+def profile_fingerprint(profile):
+    fields = [profile.get(name) for name in SYNCED_FIELDS]
+    data = json.dumps(fields, sort_keys=True).encode('utf-8')
+    return hashlib.sha256(data).hexdigest()
+
+
+def get_ttl():
+    return int(app.get('profile_ttl', DEFAULT_TTL))
+
+
+def save_entry(entry):
+    key = profile_key(entry['profile']['idUser'])
+    app.redis.setex(key, get_ttl() * REVALIDATE_FACTOR, json.dumps(entry))
+
+
+def profile_key(foreign_id):
+    return 'idp_profile:{}'.format(foreign_id)
+
+
+def synced_key(foreign_id):
+    return 'idp_profile_synced:{}'.format(foreign_id)
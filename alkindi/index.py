@@ -1,18 +1,19 @@
 
 from datetime import datetime, timedelta
-import requests
 
 from pyramid.exceptions import PredicateMismatch
 from pyramid.httpexceptions import HTTPFound, HTTPForbidden, HTTPNotFound
 from pyramid.session import check_csrf_token
-from ua_parser import user_agent_parser
 
 from alkindi.auth import (
     get_user_profile, get_oauth2_token, reset_user_principals)
+from alkindi.idp_profiles import (
+    is_profile_synced, mark_profile_stale, mark_profile_synced)
 from alkindi.contexts import (
     ApiContext, UserApiContext, TeamApiContext, AttemptApiContext,
     UserAttemptApiContext, ParticipationRoundTaskApiContext,
     ParticipationApiContext)
+from alkindi import http_client
 from alkindi.errors import ApiError, ApplicationError
 import alkindi.views as views
 from alkindi.globals import app
@@ -38,7 +39,7 @@ from alkindi.model.hints import (
 from alkindi.model.access_codes import (
     get_access_code, clear_access_codes, unlock_access_code)
 from alkindi.model.answers import (
-    grade_answer)
+    grade_answer, submit_answer, load_answer)
 
 
 def includeme(config):
@@ -88,6 +89,9 @@ def includeme(config):
     api_post(
         config, UserAttemptApiContext,
         'answer', submit_user_attempt_answer_action, permission='answer')
+    api_post(
+        config, UserAttemptApiContext,
+        'answer_status', answer_status_action, permission='read')
 
     # Revisions
     api_post(
@@ -112,7 +116,8 @@ def includeme(config):
 def not_found_view(error, request):
     if request.method == 'POST' and isinstance(error, PredicateMismatch):
         # Return a 403 error on CSRF token mismatch.
-        if not check_csrf_token(request, raises=False):
+        if request.token_claims is None and \
+                not check_csrf_token(request, raises=False):
             return HTTPForbidden()
     return error
 
@@ -120,7 +125,7 @@ def not_found_view(error, request):
 def api_post(config, context, name, view, permission='change'):
     config.add_view(
         view, context=context, name=name,
-        request_method='POST', check_csrf=True,
+        request_method='POST', check_csrf_or_token=True,
         permission=permission, renderer='json')
 
 
@@ -133,6 +138,7 @@ def application_error_view(error, request):
 def ancient_browser_view(request):
     if not is_ancient_browser(request):
         raise HTTPFound(request.route_url('index'))
+    from ua_parser import user_agent_parser
     ua = request.headers['User-Agent']
     return user_agent_parser.Parse(ua)
 
@@ -233,10 +239,8 @@ def add_badge_action(request):
         'Accept': 'application/json',
         'Authorization': 'Bearer {}'.format(access_token)
     }
-    req = requests.post(
-        app['add_badge_uri'],
-        headers=headers, data=params,
-        verify='/etc/ssl/certs/ca-certificates.crt')
+    add_badge_uri = app['add_badge_uri']
+    req = http_client.post(add_badge_uri, headers=headers, data=params)
     req.raise_for_status()
     result = req.json()
     print("\033[91mresult\033[0m {}".format(result))
@@ -248,9 +252,13 @@ def add_badge_action(request):
             'error': result.get('error', 'undefined')
         }
     profileUpdated = False
+    # The user's badges have changed, fetch their profile again.
+    mark_profile_stale(foreign_id)
     profile = get_user_profile(request, foreign_id)
     if profile is not None:
-        update_user(request.db, user['id'], profile)
+        if not is_profile_synced(profile):
+            update_user(request.db, user['id'], profile)
+            mark_profile_synced(request.db, profile)
         profileUpdated = True
     return {
         'success': True,
@@ -441,6 +449,27 @@ def submit_user_attempt_answer_action(request):
         revision = query['data']
         revision_id = store_revision_query(
             request.db, submitter_id, attempt_id, revision)
+    if app.get('grading_mode') == 'async':
+        # The answer is graded by the grading worker, the client polls
+        # answer_status for the result.
+        answer = submit_answer(
+            request.db, attempt_id, submitter_id, revision_id, answer,
+            now=now)
+        if answer['graded_at'] is None:
+            return {
+                'success': True,
+                'answer_id': answer['id'],
+                'revision_id': revision_id,
+                'is_pending': True
+            }
+        return {
+            'success': True,
+            'answer_id': answer['id'],
+            'revision_id': revision_id,
+            'is_pending': False,
+            'feedback': answer['feedback'],
+            'score': answer['score']
+        }
     answer, feedback = grade_answer(
         request.db, attempt_id, submitter_id, revision_id, answer, now=now)
     return {
@@ -452,6 +481,36 @@ def submit_user_attempt_answer_action(request):
     }
 
 
+def answer_status_action(request):
+    attempt_id = request.context.attempt_id
+    try:
+        body = request.json_body
+    except ValueError:
+        body = None
+    answer_id = body.get('answer_id') if isinstance(body, dict) else None
+    if not isinstance(answer_id, int):
+        return {'success': False, 'error': 'missing answer id'}
+    answer = load_answer(request.db, answer_id)
+    if answer['attempt_id'] != attempt_id:
+        raise ApiError('bad answer id')
+    if answer['grading_failed_at'] is not None:
+        return {
+            'success': True,
+            'answer_id': answer_id,
+            'is_pending': False,
+            'is_failed': True
+        }
+    if answer['graded_at'] is None:
+        return {'success': True, 'answer_id': answer_id, 'is_pending': True}
+    return {
+        'success': True,
+        'answer_id': answer_id,
+        'is_pending': False,
+        'feedback': answer['grading'].get('feedback'),
+        'score': answer['score']
+    }
+
+
 def enter_participation_code_action(request):
     now = datetime.utcnow()
     participation = request.context.participation
@@ -504,6 +563,9 @@ def is_ancient_browser(request):
     ua = request.headers.get('User-Agent')
     if ua is None:
         return True
+    # ua_parser compiles its regexes on import, which is slow and only
+    # needed by the (rarely used) ancient browser views.
+    from ua_parser import user_agent_parser
     ua = user_agent_parser.Parse(ua)
     ua = ua.get('user_agent')
     if ua is None:
@@ -0,0 +1,92 @@
+"""
+Conversion of the stored instances of a task to the current encoding
+of a built-in task module (see alkindi.task_modules):
+
+    python -m alkindi.migrate_instances TASK_ID MODULE
+
+The task instances of the task's attempts and the unclaimed instances
+of its pre-generation pool are converted, for example to the compact
+grids of playfair and adfgx (see alkindi.task_grids).  The instances
+already converted are left alone, so the tool can be run again.
+The task modules also convert the instances they are given (see
+alkindi.task_modules.load_instance), so this is an optional backfill.
+
+The hint queries that a module moves to full_data['hint_history'] (the
+adfgx hint ledger) are added to the attempt's hint history.
+"""
+
+from datetime import datetime
+import sys
+
+from alkindi import task_modules
+from alkindi.globals import app
+from alkindi.database_adapters import MysqlAdapter
+from alkindi.model.hints import insert_hint_history
+from alkindi.model.task_instances import (
+    load_task_instance, load_task_instance_ids, update_task_instance_data)
+from alkindi.model.task_instance_pool import (
+    load_pool_instances, update_pool_instance_data)
+
+
+# Number of instances converted per transaction.
+BATCH_SIZE = 100
+
+
+def main(argv):
+    if len(argv) != 3:
+        print(__doc__.strip())
+        return 2
+    task_id = int(argv[1])
+    name = argv[2]
+    db = MysqlAdapter(**app.get_json('mysql_connection'))
+    db.log = False
+    db.ensure_connected()
+    try:
+        count = migrate_task_instances(db, task_id, name)
+        print("{} task instances converted".format(count))
+        count = migrate_pool_instances(db, task_id, name)
+        print("{} pool instances converted".format(count))
+    finally:
+        db.close()
+    return 0
+
+
+def migrate_task_instances(db, task_id, name):
+    count = 0
+    attempt_ids = load_task_instance_ids(db, task_id)
+    for start in range(0, len(attempt_ids), BATCH_SIZE):
+        db.start_transaction()
+        for attempt_id in attempt_ids[start:start + BATCH_SIZE]:
+            # Lock the instance against concurrent hints.
+            instance = load_task_instance(db, attempt_id, for_update=True)
+            full_data = instance['full_data']
+            team_data = instance['team_data']
+            result = task_modules.migrate(name, full_data, team_data)
+            if result is not None:
+                full_data, team_data = result
+            history = full_data.pop('hint_history', None)
+            if history:
+                insert_hint_history(db, attempt_id, history)
+            if result is not None or history is not None:
+                update_task_instance_data(
+                    db, attempt_id, full_data, team_data, datetime.utcnow())
+                count += 1
+        db.commit()
+    return count
+
+
+def migrate_pool_instances(db, task_id, name):
+    count = 0
+    for pool_id, full_data, team_data in load_pool_instances(db, task_id):
+        result = task_modules.migrate(name, full_data, team_data)
+        if result is not None:
+            update_pool_instance_data(db, pool_id, *result)
+            count += 1
+            if count % BATCH_SIZE == 0:
+                db.commit()
+    db.commit()
+    return count
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -1,8 +1,11 @@
 
 from datetime import timedelta
 from decimal import Decimal
+import hashlib
+import json
 
 from alkindi.errors import ModelError
+from alkindi.globals import app
 from alkindi.model.attempts import load_attempt, update_attempt_with_grading
 from alkindi.model.participations import (
     load_participation, update_participation)
@@ -14,47 +17,32 @@ from alkindi.model.task_instances import load_task_instance
 from alkindi.tasks import task_grade_answer
 
 
+# Set of the ids of the tasks that have a grading queue.
+GRADING_TASKS_KEY = 'grading_tasks'
+
+# Answers waiting to be graded again after a failure, as a sorted set
+# of "task_id:answer_id" members scored by the time they are due.
+GRADING_RETRIES_KEY = 'grading_retries'
+
+# Gradings of an attempt's answers are memoized for GRADING_MEMO_TTL
+# seconds after the last one.
+GRADING_MEMO_TTL = 6 * 3600
+
+
 def grade_answer(db, attempt_id, submitter_id, revision_id, data, now):
     attempt = load_attempt(db, attempt_id, now)
-    is_training = attempt['is_training']
-    participation_id = attempt['participation_id']
     participation = load_participation(
-        db, participation_id, for_update=True)
+        db, attempt['participation_id'], for_update=True)
     round_task = load_round_task(db, attempt['round_task_id'])
-    task = load_task(db, round_task['task_id'])  # backend_url
-    # Fail if the attempt is closed.
-    if attempt['is_closed']:
-        raise ModelError('attempt is closed')
-    # Get the greatest ordinal and nth most recent submitted_at.
-    (prev_ordinal, nth_submitted_at) = \
-        get_attempt_latest_answer_infos(db, attempt_id, nth=2)
-    # Fail if timed(not training) and there are more answers than
-    # allowed.
-    round_ = load_round(db, participation['round_id'], now)
-    if round_['status'] != 'open':
-        raise ModelError('round not open')
-    max_answers = round_task['max_attempt_answers']
-    if (not is_training and max_answers is not None and
-            prev_ordinal >= max_answers):
-        raise ModelError('too many answers')
-    # Fail if answer was submitted too recently.
-    if nth_submitted_at is not None:
-        if now < nth_submitted_at + timedelta(minutes=1):
-            raise ModelError('too soon')
-    ordinal = prev_ordinal + 1
+    task = load_task(db, round_task['task_id'])  # backend
+    ordinal = check_answer_allowed(db, attempt, participation, round_task, now)
 
-    # Perform grading.
-    backend_url = task['backend_url']
-    auth = task['backend_auth']
+    # Perform grading, unless the same answer was already graded
+    # against the same task instance.
     task_instance = load_task_instance(db, attempt_id)
-    full_data = task_instance['full_data']
-    team_data = task_instance['team_data']
-    grading = task_grade_answer(backend_url, full_data, team_data, data, auth)
+    grading = memo_grade_answer(task, attempt_id, task_instance, data)
     # grading: {feedback, score, is_solution, is_full_solution}
 
-    # Update the attempt to indicate if solved, fully solved.
-    update_attempt_with_grading(db, attempt_id, grading)
-
     # Store the answer and grading.
     answers = db.tables.answers
     answer = {
@@ -63,22 +51,181 @@ def grade_answer(db, attempt_id, submitter_id, revision_id, data, now):
         'ordinal': ordinal,
         'created_at': now,
         'answer': db.dump_json(data),
-        'grading': db.dump_json(grading),
-        'score': grading['score'],
-        'is_solution': grading['is_solution'],
-        'is_full_solution': grading['is_full_solution'],
         'revision_id': revision_id
     }
+    answer.update(grading_attrs(db, grading, now))
     answer['id'] = db.insert_row(answers, answer)
-    # Best score for the participation?
-    new_score = Decimal(answer['score'])
-    if not is_training and (participation['score'] is None or
-                            new_score > participation['score']):
-        update_participation(
-            db, participation_id, {'score': new_score})
+    record_grading(db, attempt, participation, grading)
     return (answer, grading.get('feedback'))
 
 
+def submit_answer(db, attempt_id, submitter_id, revision_id, data, now):
+    """ Store the answer as pending and queue it for grading by the
+        grading worker (see alkindi.grader).
+        The answer counts towards the attempt's limits right away.
+        An answer whose grading is memoized is graded right away.
+    """
+    attempt = load_attempt(db, attempt_id, now)
+    participation = load_participation(
+        db, attempt['participation_id'], for_update=True)
+    round_task = load_round_task(db, attempt['round_task_id'])
+    ordinal = check_answer_allowed(db, attempt, participation, round_task, now)
+    answers = db.tables.answers
+    answer = {
+        'attempt_id': attempt_id,
+        'submitter_id': submitter_id,
+        'ordinal': ordinal,
+        'created_at': now,
+        'answer': db.dump_json(data),
+        'revision_id': revision_id
+    }
+    task_instance = load_task_instance(db, attempt_id)
+    grading = lookup_grading_memo(attempt_id, task_instance, data)
+    if grading is not None:
+        answer.update(grading_attrs(db, grading, now))
+        answer['id'] = db.insert_row(answers, answer)
+        record_grading(db, attempt, participation, grading)
+        answer['feedback'] = grading.get('feedback')
+        return answer
+    answer['graded_at'] = None
+    answer['id'] = db.insert_row(answers, answer)
+    task_id = round_task['task_id']
+    db.after_commit(lambda: queue_answer(task_id, answer['id']))
+    return answer
+
+
+def grade_pending_answer(db, answer_id, now):
+    """ Grade a pending answer and record the grading.
+        No lock is held while the task backend grades the answer.
+        Return the graded answer, or None if the answer was already
+        graded.
+    """
+    answer = load_answer(db, answer_id)
+    if answer['graded_at'] is not None:
+        return None
+    attempt_id = answer['attempt_id']
+    attempt = load_attempt(db, attempt_id)
+    round_task = load_round_task(db, attempt['round_task_id'])
+    task = load_task(db, round_task['task_id'])  # backend
+    task_instance = load_task_instance(db, attempt_id)
+    grading = memo_grade_answer(
+        task, attempt_id, task_instance, answer['answer'])
+    # Lock the participation as the synchronous path does, and check
+    # that another worker did not grade the answer in the meantime.
+    participation = load_participation(
+        db, attempt['participation_id'], for_update=True)
+    answer = load_answer(db, answer_id, for_update=True)
+    if answer['graded_at'] is not None:
+        return None
+    attrs = grading_attrs(db, grading, now)
+    db.update_row(db.tables.answers, answer_id, attrs)
+    record_grading(db, attempt, participation, grading)
+    answer.update(attrs)
+    answer['feedback'] = grading.get('feedback')
+    db.after_commit(lambda: publish_grading(attempt_id, answer_id))
+    return answer
+
+
+def load_answer(db, answer_id, for_update=False):
+    keys = [
+        'id', 'attempt_id', 'submitter_id', 'ordinal', 'created_at',
+        'graded_at', 'answer', 'grading', 'score', 'is_solution',
+        'is_full_solution', 'revision_id', 'grading_failed_at'
+    ]
+    row = db.load_row(
+        db.tables.answers, answer_id, keys, for_update=for_update)
+    for key in ['answer', 'grading']:
+        if row[key] is not None:
+            row[key] = db.load_json(row[key])
+    for key in ['is_solution', 'is_full_solution']:
+        if row[key] is not None:
+            row[key] = db.load_bool(row[key])
+    return row
+
+
+def load_pending_answer_ids(db):
+    """ Return pairs (task_id, answer_id) for the pending answers
+        whose grading has not failed.
+    """
+    answers = db.tables.answers
+    attempts = db.tables.attempts
+    round_tasks = db.tables.round_tasks
+    query = db.query(answers & attempts & round_tasks) \
+        .where(answers.attempt_id == attempts.id) \
+        .where(attempts.round_task_id == round_tasks.id) \
+        .where(answers.graded_at.is_(None)) \
+        .where(answers.grading_failed_at.is_(None)) \
+        .fields(round_tasks.task_id, answers.id) \
+        .order_by(answers.id)
+    return [(row[0], row[1]) for row in db.all(query)]
+
+
+def invalidate_grading_memo(db, attempt_id):
+    """ Forget the memoized gradings of the attempt's answers, once
+        the transaction (which changes the task instance) is committed.
+    """
+    db.after_commit(lambda: app.redis.delete(grading_memo_key(attempt_id)))
+
+
+def mark_answer_failed(db, answer_id, now):
+    """ Record that the pending answer could not be graded.  Clients
+        see it as failed rather than pending.
+    """
+    answers = db.tables.answers
+    query = db.query(answers) \
+        .where(answers.id == answer_id) \
+        .where(answers.graded_at.is_(None))
+    if db.update(query, {answers.grading_failed_at: now}) == 1:
+        attempt_id = load_answer(db, answer_id)['attempt_id']
+        db.after_commit(lambda: publish_grading(attempt_id, answer_id))
+
+
+def queue_answer(task_id, answer_id, dedupe=False):
+    """ Queue the answer for grading.  If dedupe is true, a copy of the
+        answer already in the queue is removed first.
+    """
+    key = grading_queue_key(task_id)
+    with app.redis.pipeline(transaction=dedupe) as pipe:
+        pipe.sadd(GRADING_TASKS_KEY, task_id)
+        if dedupe:
+            pipe.lrem(key, 0, answer_id)
+        pipe.lpush(key, answer_id)
+        pipe.execute()
+
+
+def schedule_answer_retry(task_id, answer_id, due):
+    """ Queue the answer again at time due (a unix timestamp).
+    """
+    member = '{}:{}'.format(task_id, answer_id)
+    app.redis.zadd(GRADING_RETRIES_KEY, {member: due})
+
+
+def queue_due_retries(now):
+    """ Move the retries due at time now to the grading queues.
+    """
+    redis = app.redis
+    members = redis.zrangebyscore(GRADING_RETRIES_KEY, 0, now)
+    for member in members:
+        # Another worker may be moving the same member.
+        if redis.zrem(GRADING_RETRIES_KEY, member) == 1:
+            task_id, answer_id = member.decode('ascii').split(':')
+            queue_answer(int(task_id), int(answer_id))
+    return len(members)
+
+
+def is_retry_scheduled(task_id, answer_id):
+    member = '{}:{}'.format(task_id, answer_id)
+    return app.redis.zscore(GRADING_RETRIES_KEY, member) is not None
+
+
+def grading_queue_key(task_id):
+    return 'grading_queue:{}'.format(task_id)
+
+
+def grading_channel(attempt_id):
+    return 'answer_graded:{}'.format(attempt_id)
+
+
 def get_attempt_latest_answer_infos(db, attempt_id, nth=2):
     """ Returns a pair whose first element is greatest answer ordinal
         for the attempt (or 0, if there are no answers), and whose
@@ -104,8 +251,9 @@ def load_limited_attempt_answers(db, attempt_id):
     """
     answers = db.tables.answers
     cols = [
-        'id', 'submitter_id', 'ordinal', 'created_at', 'answer',
-        'score', 'is_solution', 'is_full_solution'
+        'id', 'submitter_id', 'ordinal', 'created_at', 'graded_at',
+        'answer', 'score', 'is_solution', 'is_full_solution',
+        'grading_failed_at'
     ]
     query = db.query(answers) \
         .where(answers.attempt_id == attempt_id) \
@@ -115,8 +263,108 @@ def load_limited_attempt_answers(db, attempt_id):
     for row in db.all(query):
         result = {c: row[i] for i, c in enumerate(cols)}
         for key in ['is_solution']:
-            result[key] = db.load_bool(result[key])
+            if result[key] is not None:
+                result[key] = db.load_bool(result[key])
         for key in ['answer']:
             result[key] = db.load_json(result[key])
         results.append(result)
     return results
+
+
+#
+# Functions below this point are used internally by the model.
+#
+
+
+def check_answer_allowed(db, attempt, participation, round_task, now):
+    """ Raise ModelError if the team cannot submit an answer to the
+        attempt, otherwise return the ordinal of the new answer.
+        The participation must be locked by the caller.
+    """
+    # Fail if the attempt is closed.
+    if attempt['is_closed']:
+        raise ModelError('attempt is closed')
+    # Get the greatest ordinal and nth most recent submitted_at.
+    (prev_ordinal, nth_submitted_at) = \
+        get_attempt_latest_answer_infos(db, attempt['id'], nth=2)
+    # Fail if timed(not training) and there are more answers than
+    # allowed.
+    round_ = load_round(db, participation['round_id'], now)
+    if round_['status'] != 'open':
+        raise ModelError('round not open')
+    max_answers = round_task['max_attempt_answers']
+    if (not attempt['is_training'] and max_answers is not None and
+            prev_ordinal >= max_answers):
+        raise ModelError('too many answers')
+    # Fail if answer was submitted too recently.
+    if nth_submitted_at is not None:
+        if now < nth_submitted_at + timedelta(minutes=1):
+            raise ModelError('too soon')
+    return prev_ordinal + 1
+
+
+def grading_attrs(db, grading, now):
+    return {
+        'graded_at': now,
+        'grading': db.dump_json(grading),
+        'score': grading['score'],
+        'is_solution': grading['is_solution'],
+        'is_full_solution': grading['is_full_solution']
+    }
+
+
+def record_grading(db, attempt, participation, grading):
+    # Update the attempt to indicate if solved, fully solved.
+    update_attempt_with_grading(db, attempt['id'], grading)
+    # Best score for the participation?
+    new_score = Decimal(grading['score'])
+    if not attempt['is_training'] and (participation['score'] is None or
+                                       new_score > participation['score']):
+        update_participation(
+            db, participation['id'], {'score': new_score})
+
+
+def publish_grading(attempt_id, answer_id):
+    app.redis.publish(grading_channel(attempt_id), answer_id)
+
+
+def memo_grade_answer(task, attempt_id, task_instance, data):
+    """ Grade the answer, reusing the grading of an identical answer to
+        the same version of the task instance.
+    """
+    grading = lookup_grading_memo(attempt_id, task_instance, data)
+    if grading is not None:
+        return grading
+    grading = task_grade_answer(
+        task, task_instance['full_data'], task_instance['team_data'], data)
+    key = grading_memo_key(attempt_id)
+    with app.redis.pipeline(transaction=False) as pipe:
+        pipe.hset(
+            key, grading_memo_field(task_instance, data),
+            json.dumps(grading))
+        pipe.expire(key, GRADING_MEMO_TTL)
+        pipe.execute()
+    return grading
+
+
+def lookup_grading_memo(attempt_id, task_instance, data):
+    value = app.redis.hget(
+        grading_memo_key(attempt_id),
+        grading_memo_field(task_instance, data))
+    if value is None:
+        return None
+    return json.loads(value.decode('utf-8'))
+
+
+def grading_memo_key(attempt_id):
+    return 'grading_memo:{}'.format(attempt_id)
+
+
+def grading_memo_field(task_instance, data):
+    """ The memo of an attempt holds one field per task instance version
+        (updated_at) and answer (hash of its canonical JSON encoding).
+    """
+    canonical = json.dumps(
+        data, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    digest = hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+    return '{}:{}'.format(task_instance['updated_at'].isoformat(), digest)
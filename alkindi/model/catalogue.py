@@ -0,0 +1,264 @@
+"""
+Round catalogue: rounds, round_tasks, tasks, regions and badges.
+
+These tables change rarely (when an admin prepares or closes a round),
+but they are read by almost every request.  Instead of querying them,
+each worker maps a file holding the whole catalogue.  The file is
+written by one process and mapped read-only by all the workers on the
+node, so the memory used does not grow with the number of workers and
+records are decoded directly from the shared pages.
+
+The catalogue is rebuilt when the catalogue_version configuration key
+changes; admins bump it (and publish the configuration, see
+configure.sh) after editing these tables.
+
+The file lives in a directory private to the service user (by default
+/dev/shm/alkindi-<uid>, created with mode 0700).  The directory and the
+file are checked (owner, mode, no symlinks) before the file is mapped,
+and it holds JSON rather than pickles, so that a planted file cannot
+run code in the workers.  A file that cannot be used is rebuilt from
+the database.
+
+File layout: a fixed header (magic, index offset, index length), the
+JSON records, then the JSON index that maps (kind, id) to the (offset,
+length) of each record.
+"""
+
+from datetime import datetime, date
+import decimal
+import fcntl
+import json
+import mmap
+import os
+import stat
+import struct
+
+from alkindi.globals import app
+
+
+MAGIC = b'ALKCAT2\n'
+HEADER = struct.Struct('<8sQQ')
+DEFAULT_DIR = '/dev/shm/alkindi-{uid}'
+
+# Errors that indicate a missing, truncated, corrupt or foreign
+# catalogue file (json.JSONDecodeError and UnicodeDecodeError are
+# ValueErrors).
+CATALOGUE_ERRORS = (OSError, ValueError, KeyError, TypeError, struct.error)
+
+_catalogue = None
+
+
+class Catalogue:
+
+    def __init__(self, path):
+        fd = open_private(path, os.O_RDONLY)
+        try:
+            self.mmap = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        magic, index_offset, index_length = HEADER.unpack_from(self.mmap, 0)
+        if magic != MAGIC:
+            raise ValueError('not a catalogue: {}'.format(path))
+        header = decode(self.mmap[index_offset:index_offset + index_length])
+        self.version = header['version']
+        self.index = {
+            (kind, id): (offset, length)
+            for kind, id, offset, length in header['index']
+        }
+        self.lists = {
+            (name, key): ids for name, key, ids in header['lists']
+        }
+
+    def get(self, kind, id):
+        """ Return a fresh copy of the record, or None if not found.
+        """
+        entry = self.index.get((kind, id))
+        if entry is None:
+            return None
+        offset, length = entry
+        return decode(self.mmap[offset:offset + length])
+
+    def get_many(self, kind, ids):
+        records = [self.get(kind, id) for id in ids]
+        return [record for record in records if record is not None]
+
+    def get_list(self, name, key):
+        return self.lists.get((name, key), [])
+
+
+def get_catalogue(db):
+    """ Return the current catalogue, building it if needed, or None
+        if the catalogue file cannot be used (callers then query the
+        database).
+    """
+    global _catalogue
+    version = app.get('catalogue_version', '0')
+    if _catalogue is not None and _catalogue.version == version:
+        return _catalogue
+    try:
+        _catalogue = open_catalogue(db, get_catalogue_path(), version)
+    except CATALOGUE_ERRORS as ex:
+        print("catalogue unavailable: {!r}".format(ex))
+        return None
+    return _catalogue
+
+
+def get_catalogue_path():
+    """ Return the path of the catalogue file, after making sure that
+        its directory exists and is private to the service user.
+    """
+    path = app.get('catalogue_path')
+    if path is None:
+        path = os.path.join(
+            DEFAULT_DIR.format(uid=os.getuid()), 'catalogue')
+    directory = os.path.dirname(path)
+    try:
+        os.mkdir(directory, 0o700)
+    except FileExistsError:
+        pass
+    st = os.lstat(directory)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or \
+            st.st_mode & 0o077:
+        raise PermissionError(
+            'catalogue directory is not private: {}'.format(directory))
+    return path
+
+
+def open_catalogue(db, path, version):
+    catalogue = try_open_catalogue(path, version)
+    if catalogue is not None:
+        return catalogue
+    # Build the catalogue under an exclusive lock, so that a single
+    # worker queries the database when the version changes.
+    lock = open_private(path + '.lock', os.O_WRONLY | os.O_CREAT)
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        catalogue = try_open_catalogue(path, version)
+        if catalogue is None:
+            write_catalogue(path, version, *collect_catalogue(db))
+            catalogue = Catalogue(path)
+    finally:
+        os.close(lock)
+    return catalogue
+
+
+def try_open_catalogue(path, version):
+    try:
+        catalogue = Catalogue(path)
+    except FileNotFoundError:
+        return None
+    except CATALOGUE_ERRORS as ex:
+        # A corrupt or foreign file is replaced.
+        print("catalogue rebuilt: {!r}".format(ex))
+        return None
+    return catalogue if catalogue.version == version else None
+
+
+def open_private(path, flags):
+    """ Open a file of the catalogue directory without following
+        symlinks, and check that it is a regular file owned by the
+        service user and not writable by others.
+    """
+    fd = os.open(path, flags | os.O_NOFOLLOW, 0o600)
+    try:
+        st = os.fstat(fd)
+        if not stat.S_ISREG(st.st_mode) or st.st_uid != os.getuid() or \
+                st.st_mode & 0o022:
+            raise PermissionError('unsafe catalogue file: {}'.format(path))
+    except:
+        os.close(fd)
+        raise
+    return fd
+
+
+def collect_catalogue(db):
+    """ Load the catalogue tables and return (records, lists), where
+        records is a list of ((kind, id), record) pairs, and lists maps
+        (name, key) to a list of ids.
+    """
+    from alkindi.model.rounds import query_rounds, query_badges
+    from alkindi.model.round_tasks import query_round_tasks
+    from alkindi.model.tasks import query_tasks
+    from alkindi.model.regions import query_regions
+    records = []
+    lists = {}
+    for round_ in query_rounds(db):
+        records.append((('rounds', round_['id']), round_))
+    for round_task in query_round_tasks(db):
+        records.append((('round_tasks', round_task['id']), round_task))
+        # query_round_tasks returns the round_tasks in ordinal order.
+        key = ('round_tasks', round_task['round_id'])
+        lists.setdefault(key, []).append(round_task['id'])
+    for task in query_tasks(db):
+        records.append((('tasks', task['id']), task))
+    for region in query_regions(db):
+        records.append((('regions', region['id']), region))
+    for badge in query_badges(db):
+        if badge['is_active']:
+            key = ('badge_rounds', badge['symbol'])
+            lists.setdefault(key, []).append(badge['round_id'])
+    return records, lists
+
+
+def write_catalogue(path, version, records, lists):
+    # Write to a temporary file and rename it, so that workers never
+    # map a partial file; workers that mapped the previous file keep
+    # reading it until they notice the new version.
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    # The file holds the task backend credentials.
+    fd = os.open(
+        tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW,
+        0o600)
+    with open(fd, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, 0, 0))
+        index = []
+        for (kind, id), record in records:
+            data = encode(record)
+            index.append((kind, id, f.tell(), len(data)))
+            f.write(data)
+        index_offset = f.tell()
+        data = encode({
+            'version': version,
+            'index': index,
+            'lists': [(name, key, ids) for (name, key), ids in lists.items()],
+        })
+        f.write(data)
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, index_offset, len(data)))
+    os.rename(tmp_path, path)
+    print("catalogue version {} written ({} records)".format(
+        version, len(records)))
+
+
+#
+# Private definitions
+#
+
+def encode(value):
+    return json.dumps(value, default=encode_value).encode('utf-8')
+
+
+def decode(data):
+    return json.loads(str(data, 'utf-8'), object_hook=decode_value)
+
+
+def encode_value(value):
+    # Records hold DATETIME, DATE and DECIMAL columns.
+    if isinstance(value, datetime):
+        return {'$datetime': value.isoformat()}
+    if isinstance(value, date):
+        return {'$date': value.isoformat()}
+    if isinstance(value, decimal.Decimal):
+        return {'$decimal': str(value)}
+    raise TypeError('cannot store {!r} in the catalogue'.format(value))
+
+
+def decode_value(obj):
+    if len(obj) == 1:
+        if '$datetime' in obj:
+            return datetime.fromisoformat(obj['$datetime'])
+        if '$date' in obj:
+            return date.fromisoformat(obj['$date'])
+        if '$decimal' in obj:
+            return decimal.Decimal(obj['$decimal'])
+    return obj
@@ -1,4 +1,6 @@
 
+from datetime import datetime
+
 from alkindi.errors import ModelError
 from alkindi.model.rounds import load_round
 from alkindi.model.participations import load_participation
@@ -6,6 +8,7 @@ from alkindi.model.attempts import load_attempt
 from alkindi.model.round_tasks import load_round_task
 from alkindi.model.tasks import load_task
 from alkindi.model.task_instances import load_task_instance
+from alkindi.model.answers import invalidate_grading_memo
 from alkindi.tasks import task_grant_hint
 
 
@@ -22,11 +25,9 @@ def get_task_instance_hint(db, attempt_id, query, now):
     if round_['status'] != 'open':
         raise ModelError('round not open')
 
-    # Obtain task backend URL and Authorization header.
+    # Obtain the task (backend URL and Authorization header).
     round_task = load_round_task(db, attempt['round_task_id'])
     task = load_task(db, round_task['task_id'])
-    backend_url = task['backend_url']
-    auth = task['backend_auth']
 
     # Load the task instance.
     task_instance = load_task_instance(db, attempt_id, for_update=True)
@@ -38,11 +39,17 @@ def get_task_instance_hint(db, attempt_id, query, now):
     # Get the task backend to validate the hint request and apply the hint
     # from full_data onto team_data.
     print('grantHint query {}'.format(query))
-    result = task_grant_hint(backend_url, full_data, team_data, query, auth)
+    result = task_grant_hint(task, full_data, team_data, query)
     # result: {success, task, full_task}
     print('grantHint result {}'.format(result))
     team_data = result.get('task', team_data)
     full_data = result.get('full_task', full_data)
+    # Queries listed in an instance stored before the hint history was
+    # kept in hint_queries (adfgx) are moved there.
+    history = None
+    if 'hint_history' in full_data:
+        full_data = dict(full_data)
+        history = full_data.pop('hint_history')
 
     # If successful, update the task instance.
     # 'full_data' is also updated in case the task needs to store extra private
@@ -57,10 +64,53 @@ def get_task_instance_hint(db, attempt_id, query, now):
             attrs['updated_at'] = now
             task_instances = db.tables.task_instances
             db.update_row(task_instances, {'attempt_id': attempt_id}, attrs)
+            # Answers must be graded against the new team_data.
+            invalidate_grading_memo(db, attempt_id)
+        if history is not None:
+            insert_hint_history(db, attempt_id, history)
+        insert_hint_query(db, attempt_id, query, now)
 
     return result['success']
 
 
+def insert_hint_query(db, attempt_id, query, now):
+    """ Add a granted hint query to the attempt's history.
+    """
+    db.insert_row(db.tables.hint_queries, {
+        'attempt_id': attempt_id,
+        'created_at': now,
+        'query': db.dump_json(query)
+    })
+
+
+def insert_hint_history(db, attempt_id, history):
+    """ Add queries formerly listed in an instance's team_data, with
+        their submitted_at time, to the attempt's history.
+    """
+    for query in history:
+        query = dict(query)
+        submitted_at = datetime.strptime(
+            query.pop('submitted_at')[:19], '%Y-%m-%dT%H:%M:%S')
+        insert_hint_query(db, attempt_id, query, submitted_at)
+
+
+def load_hint_queries(db, attempt_id):
+    """ Return the queries granted on the attempt, oldest first, with
+        their submitted_at time, as formerly listed in team_data.
+    """
+    hint_queries = db.tables.hint_queries
+    query = db.query(hint_queries) \
+        .where(hint_queries.attempt_id == attempt_id) \
+        .fields(hint_queries.created_at, hint_queries.query) \
+        .order_by(hint_queries.id)
+    results = []
+    for created_at, value in db.all(query):
+        value = db.load_json(value)
+        value['submitted_at'] = created_at.isoformat()
+        results.append(value)
+    return results
+
+
 def reset_task_instance_hints(db, attempt_id, now, force=False):
     # XXX to rewrite
     attempt = load_attempt(db, attempt_id, for_update=True)
@@ -1,7 +1,12 @@
 
+from alkindi.globals import app
 from alkindi.utils import generate_code
 
 
+# Entries of the access code map are kept for CODE_MAP_TTL seconds.
+CODE_MAP_TTL = 90 * 86400
+
+
 def participations_columns(db):
     participations = db.tables.participations
     return [
@@ -85,16 +90,25 @@ def advance_participations(db, round_id, next_round_id, now):
         .where(
             (participations.round_id == round_id) &
             participations.is_qualified)
+    codes = {}
     for row in db.all_rows(query, cols):
+        team_id = row['team_id']
         participation = {
-            'team_id': row['team_id'],
+            'team_id': team_id,
             'round_id': next_round_id,
             'created_at': now,
             'updated_at': now
         }
         if gen_access_codes:
-            participation['access_code'] = generate_code()
-        db.insert_row(participations, participation)
+            code = generate_code()
+            while find_participation_by_code(db, code) is not None:
+                code = generate_code()
+            participation['access_code'] = code
+        participation_id = db.insert_row(participations, participation)
+        if gen_access_codes:
+            codes[code] = (participation_id, team_id)
+    # Publish the new codes once they are committed.
+    db.after_commit(lambda: store_participation_codes(codes))
 
 
 def find_participation_by_code(db, code):
@@ -109,6 +123,50 @@ def find_participation_by_code(db, code):
     return None if row is None else row[0]
 
 
+def lookup_participation_code(db, code):
+    """ Return the (participation_id, team_id) pair for an access code,
+        or None if the code is not valid.
+        Codes are looked up in redis first, then in the database.
+    """
+    value = app.redis.get(participation_code_key(code))
+    if value is not None:
+        participation_id, team_id = value.decode('ascii').split(':')
+        return int(participation_id), int(team_id)
+    participations = db.tables.participations
+    query = db.query(participations) \
+        .fields(participations.id, participations.team_id) \
+        .where(participations.access_code == code)
+    row = db.first(query)
+    if row is None:
+        return None
+    store_participation_codes({code: (row[0], row[1])})
+    return row[0], row[1]
+
+
 def mark_participation_code_entered(db, participation_id, now):
-    attrs = {'access_code_entered': 1}
-    update_participation(db, participation_id, attrs)
+    # Only the first login with the code writes to the row.
+    participations = db.tables.participations
+    query = db.query(participations) \
+        .where(participations.id == participation_id) \
+        .where(participations.access_code_entered == 0)
+    db.update(query, {participations.access_code_entered: 1})
+
+
+#
+# Functions below this point are used internally by the model.
+#
+
+
+def store_participation_codes(codes):
+    if len(codes) == 0:
+        return
+    with app.redis.pipeline(transaction=False) as pipe:
+        for code, (participation_id, team_id) in codes.items():
+            pipe.setex(
+                participation_code_key(code), CODE_MAP_TTL,
+                '{}:{}'.format(participation_id, team_id))
+        pipe.execute()
+
+
+def participation_code_key(code):
+    return 'participation_code:{}'.format(code)
@@ -1,8 +1,31 @@
+from alkindi.errors import ModelError
+from alkindi.model.catalogue import get_catalogue
+
+
+REGION_KEYS = ['id', 'name', 'code', 'big_region_code', 'big_region_name']
+
 
 def load_region(db, region_id, for_update=False):
     if region_id is None:
         return None
-    keys = ['id', 'name', 'code', 'big_region_code', 'big_region_name']
-    result = db.load_row(db.tables.regions, region_id, keys,
+    if not for_update:
+        catalogue = get_catalogue(db)
+        if catalogue is not None:
+            result = catalogue.get('regions', region_id)
+            if result is None:
+                raise ModelError('no such row')
+            return result
+    result = db.load_row(db.tables.regions, region_id, REGION_KEYS,
                          for_update=for_update)
     return result
+
+
+#
+# Functions below this point are used internally by the model.
+#
+
+
+def query_regions(db):
+    regions = db.tables.regions
+    cols = [(key, getattr(regions, key)) for key in REGION_KEYS]
+    return db.all_rows(db.query(regions), cols)
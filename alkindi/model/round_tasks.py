@@ -1,3 +1,5 @@
+from alkindi.model.catalogue import get_catalogue
+
 
 def round_task_columns(db):
     round_tasks = db.tables.round_tasks
@@ -20,6 +22,10 @@ def round_task_columns(db):
 
 
 def load_round_task(db, round_task_id, for_update=False):
+    if not for_update:
+        catalogue = get_catalogue(db)
+        if catalogue is not None:
+            return catalogue.get('round_tasks', round_task_id)
     round_tasks = db.tables.round_tasks
     tasks = db.tables.tasks
     cols = round_task_columns(db)
@@ -29,6 +35,10 @@ def load_round_task(db, round_task_id, for_update=False):
 
 
 def load_round_tasks(db, round_id):
+    catalogue = get_catalogue(db)
+    if catalogue is not None:
+        return catalogue.get_many(
+            'round_tasks', catalogue.get_list('round_tasks', round_id))
     round_tasks = db.tables.round_tasks
     tasks = db.tables.tasks
     cols = round_task_columns(db)
@@ -36,3 +46,20 @@ def load_round_tasks(db, round_id):
         .where(round_tasks.round_id == round_id) \
         .order_by(round_tasks.ordinal)
     return db.all_rows(query, cols)
+
+
+#
+# Functions below this point are used internally by the model.
+#
+
+
+def query_round_tasks(db):
+    """ Load all round_tasks from the database, ordered by round and
+        ordinal.
+    """
+    round_tasks = db.tables.round_tasks
+    tasks = db.tables.tasks
+    cols = round_task_columns(db)
+    query = db.query(round_tasks & tasks.on(round_tasks.task_id == tasks.id)) \
+        .order_by(round_tasks.round_id, round_tasks.ordinal)
+    return db.all_rows(query, cols)
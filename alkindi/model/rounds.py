@@ -1,21 +1,18 @@
+from alkindi.model.catalogue import get_catalogue
+
 
 def load_round(db, round_id, now=None):
     return load_rounds(db, [round_id], now)[round_id]
 
 
 def load_rounds(db, round_ids, now=None):
-    cols = [
-        'id', 'created_at', 'updated_at', 'title', 'status',
-        'registration_opens_at', 'training_opens_at',
-        'min_team_size', 'max_team_size', 'min_team_ratio',
-        'allow_team_changes', 'duration'
-    ]
-    bool_cols = ['allow_team_changes']
-    rows = db.load_rows(db.tables.rounds, round_ids, cols)
+    catalogue = get_catalogue(db)
+    if catalogue is None:
+        rows = query_rounds(db, round_ids)
+    else:
+        rows = catalogue.get_many('rounds', round_ids)
     result = {}
     for row in rows:
-        for key in bool_cols:
-            row[key] = db.load_bool(row[key])
         if now is not None:
             row['is_registration_open'] = row['registration_opens_at'] <= now
             row['is_training_open'] = row['training_opens_at'] <= now
@@ -31,6 +28,17 @@ def find_round_ids_with_badges(db, badges, now):
     rounds = db.tables.rounds
     if len(badges) == 0:
         return None
+    catalogue = get_catalogue(db)
+    if catalogue is not None:
+        round_ids = [
+            round_id
+            for badge in badges
+            for round_id in catalogue.get_list('badge_rounds', badge)
+        ]
+        rows = load_rounds(db, round_ids)
+        return sorted(
+            round_ids, key=lambda round_id: rows[round_id]['updated_at'],
+            reverse=True)
     badges_table = db.tables.badges
     query = db.query(rounds & badges_table) \
               .fields(rounds.id) \
@@ -39,3 +47,50 @@ def find_round_ids_with_badges(db, badges, now):
               .where(badges_table.is_active) \
               .order_by(rounds.updated_at.desc())
     return [row[0] for row in db.all(query)]
+
+
+#
+# Functions below this point are used internally by the model.
+#
+
+
+def round_columns(db):
+    rounds = db.tables.rounds
+    return [
+        ('id', rounds.id),
+        ('created_at', rounds.created_at),
+        ('updated_at', rounds.updated_at),
+        ('title', rounds.title),
+        ('status', rounds.status),
+        ('registration_opens_at', rounds.registration_opens_at),
+        ('training_opens_at', rounds.training_opens_at),
+        ('min_team_size', rounds.min_team_size),
+        ('max_team_size', rounds.max_team_size),
+        ('min_team_ratio', rounds.min_team_ratio),
+        ('allow_team_changes', rounds.allow_team_changes, 'bool'),
+        ('duration', rounds.duration)
+    ]
+
+
+def query_rounds(db, round_ids=None):
+    """ Load the given rounds (all rounds if round_ids is None) from
+        the database.
+    """
+    rounds = db.tables.rounds
+    query = db.query(rounds)
+    if round_ids is not None:
+        if len(round_ids) == 0:
+            return []
+        query = query.where(rounds.id.in_(list(round_ids)))
+    return db.all_rows(query, round_columns(db))
+
+
+def query_badges(db):
+    badges = db.tables.badges
+    cols = [
+        ('id', badges.id),
+        ('symbol', badges.symbol),
+        ('round_id', badges.round_id),
+        ('is_active', badges.is_active, 'bool')
+    ]
+    return db.all_rows(db.query(badges), cols)
@@ -0,0 +1,129 @@
+"""
+Task instances generated ahead of the round (see alkindi.pregenerate).
+
+The ids of the unclaimed instances of each round_task are listed in
+redis, so that concurrent attempts pop distinct instances instead of
+waiting on each other's row locks.
+"""
+
+from alkindi.globals import app
+
+
+# Number of listed instances an attempt tries before falling back to
+# live generation (an id may have been claimed since it was listed).
+MAX_CLAIM_TRIES = 3
+
+
+def claim_pool_instance(db, round_task_id, attempt_id, now):
+    """ Claim a pre-generated instance of the round_task for the attempt.
+        Return the pair (team_data, full_data), or None if the pool is
+        empty.
+        If the transaction is rolled back, the instance stays unclaimed
+        in the database and its id is put back in the list.
+    """
+    pool = db.tables.task_instance_pool
+    key = pool_key(round_task_id)
+    for _ in range(MAX_CLAIM_TRIES):
+        pool_id = app.redis.lpop(key)
+        if pool_id is None:
+            return None
+        pool_id = int(pool_id)
+        # Put the id back if the claim is not committed (a claimed id
+        # put back is skipped by the next claim).
+        db.after_rollback(
+            lambda pool_id=pool_id: app.redis.rpush(key, pool_id))
+        query = db.query(pool) \
+            .where(pool.id == pool_id) \
+            .where(pool.attempt_id.is_(None))
+        count = db.update(query, {
+            pool.attempt_id: attempt_id,
+            pool.claimed_at: now
+        })
+        if count == 1:
+            row = db.load_row(pool, pool_id, ['team_data', 'full_data'])
+            return (
+                db.load_json(row['team_data']),
+                db.load_json(row['full_data']))
+    return None
+
+
+def count_pool_instances(db, round_task_id):
+    """ Return the total number of instances in the round_task's pool and
+        the number of those that are unclaimed.
+    """
+    pool = db.tables.task_instance_pool
+    query = db.query(pool).where(pool.round_task_id == round_task_id)
+    total = db.count(query.fields(pool.id))
+    available = db.count(
+        query.where(pool.attempt_id.is_(None)).fields(pool.id))
+    return total, available
+
+
+def insert_pool_instance(db, round_task_id, seed, team_data, full_data, now):
+    pool = db.tables.task_instance_pool
+    db.insert_row(pool, {
+        'round_task_id': round_task_id,
+        'seed': seed,
+        'created_at': now,
+        'full_data': db.dump_json(full_data),
+        'team_data': db.dump_json(team_data)
+    })
+
+
+def publish_task_pool(db, round_task_id):
+    """ List the committed, unclaimed instances of the round_task's pool
+        in redis.
+    """
+    pool = db.tables.task_instance_pool
+    query = db.query(pool) \
+        .fields(pool.id) \
+        .where(pool.round_task_id == round_task_id) \
+        .where(pool.attempt_id.is_(None)) \
+        .order_by(pool.id)
+    pool_ids = [row[0] for row in db.all(query)]
+    key = pool_key(round_task_id)
+    with app.redis.pipeline(transaction=True) as pipe:
+        pipe.delete(key)
+        if len(pool_ids) > 0:
+            pipe.rpush(key, *pool_ids)
+        pipe.execute()
+    return len(pool_ids)
+
+
+def load_pool_instances(db, task_id):
+    """ Return the unclaimed pool instances of the given task, as
+        triples (id, full_data, team_data).
+    """
+    pool = db.tables.task_instance_pool
+    round_tasks = db.tables.round_tasks
+    query = db.query(pool & round_tasks) \
+        .where(pool.round_task_id == round_tasks.id) \
+        .where(round_tasks.task_id == task_id) \
+        .where(pool.attempt_id.is_(None)) \
+        .fields(pool.id, pool.full_data, pool.team_data) \
+        .order_by(pool.id)
+    return [
+        (row[0], db.load_json(row[1]), db.load_json(row[2]))
+        for row in db.all(query)
+    ]
+
+
+def update_pool_instance_data(db, pool_id, full_data, team_data):
+    pool = db.tables.task_instance_pool
+    db.update_row(pool, pool_id, {
+        'full_data': db.dump_json(full_data),
+        'team_data': db.dump_json(team_data)
+    })
+
+
+def pool_seed(round_task_id, ordinal):
+    return 'pool:{}:{}'.format(round_task_id, ordinal)
+
+
+#
+# Functions below this point are used internally by the model.
+#
+
+
+def pool_key(round_task_id):
+    return 'task_pool:{}'.format(round_task_id)
@@ -11,8 +11,10 @@ from alkindi.model.participations import (
 from alkindi.model.attempts import load_attempt
 from alkindi.model.workspaces import create_attempt_workspace
 from alkindi.model.round_tasks import load_round_task
+from alkindi.model.task_instance_pool import claim_pool_instance
 from alkindi.model.tasks import load_task
 from alkindi.tasks import task_generate
+from alkindi.task_grids import decode_team_data
 
 
 def load_task_instance(db, attempt_id, for_update=False):
@@ -37,10 +39,36 @@ def load_user_task_instance(db, attempt_id):
     task_instances = db.tables.task_instances
     row = db.load_row(
         task_instances, {'attempt_id': attempt_id}, keys)
-    row['team_data'] = json.loads(row['team_data'])
+    # The task frontends expect the grids in their original encoding.
+    row['team_data'] = decode_team_data(json.loads(row['team_data']))
     return row
 
 
+def load_task_instance_ids(db, task_id):
+    """ Return the attempt ids of the instances of the given task.
+    """
+    task_instances = db.tables.task_instances
+    attempts = db.tables.attempts
+    round_tasks = db.tables.round_tasks
+    query = db.query(task_instances & attempts & round_tasks) \
+        .where(task_instances.attempt_id == attempts.id) \
+        .where(attempts.round_task_id == round_tasks.id) \
+        .where(round_tasks.task_id == task_id) \
+        .fields(task_instances.attempt_id) \
+        .order_by(task_instances.attempt_id)
+    return [row[0] for row in db.all(query)]
+
+
+def update_task_instance_data(db, attempt_id, full_data, team_data, now):
+    attrs = {
+        'updated_at': now,
+        'full_data': db.dump_json(full_data),
+        'team_data': db.dump_json(team_data)
+    }
+    task_instances = db.tables.task_instances
+    db.update_row(task_instances, {'attempt_id': attempt_id}, attrs)
+
+
 def assign_task_instance(db, attempt_id, now):
     """ Assign a task to the attempt.
         The team performing the attempt must be valid, otherwise
@@ -68,12 +96,14 @@ def assign_task_instance(db, attempt_id, now):
     # TODO: check round_task['have_training_attempt'] if next ordinal is 1
     # TODO: check round_task['max_timed_attempts'] if next ordinal is >1
 
-    task = load_task(db, round_task['task_id'])  # backend_url
-    backend_url = task['backend_url']
-    auth = task['backend_auth']
-    task_params = round_task['generate_params']
-    seed = str(attempt_id)  # TODO add a participation-specific key to the seed
-    team_data, full_data = task_generate(backend_url, task_params, seed, auth)
+    # Claim a pre-generated instance, or generate one.
+    instance = claim_pool_instance(db, round_task_id, attempt_id, now)
+    if instance is None:
+        task = load_task(db, round_task['task_id'])  # backend
+        task_params = round_task['generate_params']
+        seed = str(attempt_id)  # TODO add a participation-specific key
+        instance = task_generate(task, task_params, seed)
+    team_data, full_data = instance
 
     try:
         # Lock the task_instances table to prevent concurrent inserts.
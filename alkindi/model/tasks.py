@@ -1,9 +1,32 @@
+from alkindi.errors import ModelError
+from alkindi.model.catalogue import get_catalogue
+
+
+TASK_KEYS = [
+    'id', 'created_at', 'updated_at', 'title',
+    'backend_url', 'frontend_url', 'backend_auth'
+]
+
 
 def load_task(db, task_id, for_update=False):
-    keys = [
-        'id', 'created_at', 'updated_at', 'title',
-        'backend_url', 'frontend_url', 'backend_auth'
-    ]
+    if not for_update:
+        catalogue = get_catalogue(db)
+        if catalogue is not None:
+            result = catalogue.get('tasks', task_id)
+            if result is None:
+                raise ModelError('no such row')
+            return result
     tasks = db.tables.tasks
-    result = db.load_row(tasks, task_id, keys, for_update=for_update)
+    result = db.load_row(tasks, task_id, TASK_KEYS, for_update=for_update)
     return result
+
+
+#
+# Functions below this point are used internally by the model.
+#
+
+
+def query_tasks(db):
+    tasks = db.tables.tasks
+    cols = [(key, getattr(tasks, key)) for key in TASK_KEYS]
+    return db.all_rows(db.query(tasks), cols)
@@ -1,5 +1,6 @@
 
 from alkindi.errors import ModelError
+from alkindi.principals import invalidate_team_principals
 from alkindi.model.users import load_user, set_user_team_id
 from alkindi.model.teams import load_team, create_empty_team
 from alkindi.model.rounds import load_round
@@ -146,6 +147,7 @@ def leave_team(db, user_id, team_id, now):
             db.update(
                 query.where(team_members.user_id == new_creator_id),
                 {team_members.is_creator: True})
+            invalidate_team_principals(db, team_id)
 
 
 #
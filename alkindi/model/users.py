@@ -1,5 +1,6 @@
 
 from alkindi.errors import ModelError
+from alkindi.principals import invalidate_user_principals
 
 
 def load_user(db, user_id, for_update=False):
@@ -34,13 +35,13 @@ def update_user(db, user_id, profile):
     })
 
 
-def get_user_principals(db, user_id):
+def get_user_principals(db, user_id, for_update=False):
     user_id = int(user_id)
     users = db.tables.users
     query = db.query(users) \
         .where(users.id == user_id) \
         .fields(users.team_id, users.is_admin)
-    row = db.first(query)
+    row = db.first(query, for_update=for_update)
     if row is None:
         raise ModelError('invalid user')
     principals = ['u:{}'.format(user_id)]
@@ -54,7 +55,7 @@ def get_user_principals(db, user_id):
         .where(team_members.user_id == user_id) \
         .where(team_members.team_id == team_id) \
         .fields(team_members.is_qualified, team_members.is_creator)
-    row = db.first(query)
+    row = db.first(query, for_update=for_update)
     if row is None:
         raise ModelError('missing team_member row')
     principals.append('t:{}'.format(team_id))
@@ -116,3 +117,4 @@ def get_user_team_id(db, user_id):
 
 def set_user_team_id(db, user_id, team_id):
     db.update_row(db.tables.users, user_id, {'team_id': team_id})
+    invalidate_user_principals(db, user_id)
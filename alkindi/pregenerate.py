@@ -0,0 +1,92 @@
+"""
+Pre-generation of the task instances of a round, to run before the
+round opens:
+
+    python -m alkindi.pregenerate ROUND_ID [SIZE]
+
+For each task of the round, instances are generated by the task's
+backend (for the deterministic seeds pool:<round_task_id>:<n>) until
+the pool holds SIZE unclaimed instances.  SIZE defaults to one instance
+per official team and attempt kind (training and timed), plus a margin.
+Running the tool again tops up the pools.
+
+Starting an attempt claims an instance from the pool, and falls back to
+generating one if the pool is empty (see assign_task_instance).
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import math
+import sys
+
+from alkindi.globals import app
+from alkindi.database_adapters import MysqlAdapter
+from alkindi.model.round_tasks import load_round_tasks
+from alkindi.model.tasks import load_task
+from alkindi.model.teams import count_teams_in_round
+from alkindi.model.task_instance_pool import (
+    count_pool_instances, insert_pool_instance, publish_task_pool, pool_seed
+)
+from alkindi.tasks import task_generate
+
+
+# Fraction of extra instances generated by default.
+POOL_MARGIN = 0.1
+
+# Number of concurrent calls to the task backends.
+PARALLEL_CALLS = 4
+
+
+def main(argv):
+    if len(argv) not in (2, 3):
+        print(__doc__.strip())
+        return 2
+    round_id = int(argv[1])
+    size = int(argv[2]) if len(argv) == 3 else None
+    db = MysqlAdapter(**app.get_json('mysql_connection'))
+    db.log = False
+    db.ensure_connected()
+    try:
+        for round_task in load_round_tasks(db, round_id):
+            fill_task_pool(db, round_task, size)
+    finally:
+        db.close()
+    return 0
+
+
+def fill_task_pool(db, round_task, size=None):
+    """ Top up the pool of the round_task to `size` unclaimed instances,
+        committing each instance as it is generated.
+    """
+    round_task_id = round_task['id']
+    if size is None:
+        size = default_pool_size(db, round_task)
+    total, available = count_pool_instances(db, round_task_id)
+    missing = max(0, size - available)
+    print("round_task {}: {} available, generating {}".format(
+        round_task_id, available, missing))
+    task = load_task(db, round_task['task_id'])
+    params = round_task['generate_params']
+    seeds = [pool_seed(round_task_id, total + n) for n in range(missing)]
+
+    def generate(seed):
+        return seed, task_generate(task, params, seed)
+
+    with ThreadPoolExecutor(max_workers=PARALLEL_CALLS) as executor:
+        for seed, (team_data, full_data) in executor.map(generate, seeds):
+            insert_pool_instance(
+                db, round_task_id, seed, team_data, full_data,
+                datetime.utcnow())
+            db.commit()
+    count = publish_task_pool(db, round_task_id)
+    print("round_task {}: {} instances listed".format(round_task_id, count))
+
+
+def default_pool_size(db, round_task):
+    teams = count_teams_in_round(db, round_task['round_id'])
+    kinds = 2 if round_task['have_training_attempt'] else 1
+    return math.ceil(teams * kinds * (1 + POOL_MARGIN))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,215 @@
+"""
+Principals cache shared by all sessions.
+
+The principals of a user (see get_user_principals in model.users) are
+cached in redis under the user's id, together with the versions of the
+user and of their team at the time they were computed.  The model bumps
+the user's version when their team changes, and the team's version when
+the principals of its members change (a new creator is promoted).  An
+entry is current if both versions still match, which is checked by a
+script in a single round trip.  The session factory runs the same
+check in the script that loads the session (load_session_principals),
+so that a request authenticated by its session reads both at once.
+
+Principals are read from the database without locks, in the request's
+transaction snapshot.  The time of each version bump is kept for a
+while, and an entry is not stored if a version it depends on was
+bumped after the snapshot was taken, as the snapshot may then predate
+the change.
+
+After changing users.is_admin by hand, bump the user's version:
+
+    redis-cli incr principals_version:u:<user_id>
+"""
+
+import codecs
+import json
+import time
+
+from alkindi.globals import app
+
+
+# How long (in seconds) unused entries are kept.
+DEFAULT_TTL = 86400
+
+# How long (in seconds) the time of a version bump is kept: longer than
+# any request's transaction.
+BUMP_TTL = 300
+
+# Allowance (in seconds) for clock differences between hosts when
+# comparing a bump time to the start of a transaction.
+CLOCK_MARGIN = 1
+
+# Return the principals of a current entry, or false.
+LOOKUP_FUNCTION = """
+local function lookup(entry_key, user_version_key, team_version_prefix)
+    local entry = redis.call('GET', entry_key)
+    if not entry then
+        return false
+    end
+    local cached = cjson.decode(entry)
+    if cached.uv ~= (redis.call('GET', user_version_key) or '0') then
+        return false
+    end
+    if cached.team_id then
+        local team_version =
+            redis.call('GET', team_version_prefix .. cached.team_id) or '0'
+        if cached.tv ~= team_version then
+            return false
+        end
+    end
+    return cached.principals
+end
+"""
+
+# KEYS[1] entry, KEYS[2] user version; ARGV[1] team version key prefix
+LOOKUP_SCRIPT = LOOKUP_FUNCTION + """
+return lookup(KEYS[1], KEYS[2], ARGV[1])
+"""
+
+# KEYS[1] session; ARGV[1] session field holding the user id (JSON),
+# ARGV[2] entry key prefix, ARGV[3] user version key prefix,
+# ARGV[4] team version key prefix
+SESSION_SCRIPT = LOOKUP_FUNCTION + """
+local fields = redis.call('HGETALL', KEYS[1])
+local principals = false
+for i = 1, #fields, 2 do
+    if fields[i] == ARGV[1] then
+        local user_id = tostring(cjson.decode(fields[i + 1]))
+        principals = lookup(
+            ARGV[2] .. user_id, ARGV[3] .. user_id, ARGV[4])
+    end
+end
+return {fields, principals}
+"""
+
+_lookup_script = None
+_session_script = None
+
+
+def get_cached_principals(user_id):
+    """ Return the cached principals of the user, or None if they are
+        missing or out of date.
+    """
+    global _lookup_script
+    if _lookup_script is None:
+        _lookup_script = app.redis.register_script(LOOKUP_SCRIPT)
+    principals = _lookup_script(
+        keys=[entry_key(user_id), user_version_key(user_id)],
+        args=[team_version_key('')])
+    if principals is None:
+        return None
+    return [codecs.decode(principal) for principal in principals]
+
+
+def load_session_principals(session_key, user_id_field):
+    """ Return the fields of the session hash (as a flat list of names
+        and values), and the cached principals of the user whose id is
+        stored in user_id_field, or None if there are none or they are
+        out of date.
+    """
+    global _session_script
+    if _session_script is None:
+        _session_script = app.redis.register_script(SESSION_SCRIPT)
+    fields, principals = _session_script(
+        keys=[session_key],
+        args=[user_id_field, entry_key(''), user_version_key(''),
+              team_version_key('')])
+    if principals is not None:
+        principals = [codecs.decode(principal) for principal in principals]
+    return fields, principals
+
+
+def cache_principals(request, user_id, principals):
+    """ Store principals computed from the database in the request's
+        transaction.
+        The versions are read after the rows.  A change whose version
+        was bumped before that may have been committed after the
+        transaction's snapshot was taken: the entry is then not stored,
+        as it could be stale under a current version.
+    """
+    team_id = get_team_id(principals)
+    keys = version_keys(user_id, team_id)
+    # Read the versions and their bump times in a single round trip.
+    values = app.redis.mget(keys + [bump_key(key) for key in keys])
+    versions = [decode_version(value) for value in values[:len(keys)]]
+    bumped_at = [
+        float(value) for value in values[len(keys):] if value is not None]
+    started_at = request.db.started_at
+    if started_at is None or \
+            any(bump >= started_at - CLOCK_MARGIN for bump in bumped_at):
+        return
+    entry = {'principals': principals, 'uv': versions[0]}
+    if team_id is not None:
+        entry['team_id'] = team_id
+        entry['tv'] = versions[1]
+    ttl = int(app.get('principals_ttl', DEFAULT_TTL))
+    app.redis.set(entry_key(user_id), json.dumps(entry), ex=ttl)
+
+
+def get_principals_version(user_id, principals):
+    """ Return a string that identifies the current versions of the
+        user's principals.
+    """
+    team_id = get_team_id(principals)
+    return '.'.join(get_versions(app.redis, user_id, team_id))
+
+
+def invalidate_user_principals(db, user_id):
+    """ Have the user's principals recomputed once the current
+        transaction is committed.
+    """
+    db.after_commit(lambda: bump_version(user_version_key(user_id)))
+
+
+def invalidate_team_principals(db, team_id):
+    """ Have the principals of all the team's members recomputed once
+        the current transaction is committed.
+    """
+    db.after_commit(lambda: bump_version(team_version_key(team_id)))
+
+
+def bump_version(key):
+    with app.redis.pipeline(transaction=False) as pipe:
+        pipe.incr(key)
+        pipe.set(bump_key(key), time.time(), ex=BUMP_TTL)
+        pipe.execute()
+
+
+def entry_key(user_id):
+    return 'principals:{}'.format(user_id)
+
+
+def user_version_key(user_id):
+    return 'principals_version:u:{}'.format(user_id)
+
+
+def team_version_key(team_id):
+    return 'principals_version:t:{}'.format(team_id)
+
+
+def bump_key(version_key):
+    return '{}:bumped_at'.format(version_key)
+
+
+def version_keys(user_id, team_id):
+    keys = [user_version_key(user_id)]
+    if team_id is not None:
+        keys.append(team_version_key(team_id))
+    return keys
+
+
+def get_versions(redis, user_id, team_id):
+    keys = version_keys(user_id, team_id)
+    return [decode_version(value) for value in redis.mget(keys)]
+
+
+def decode_version(value):
+    return '0' if value is None else codecs.decode(value)
+
+
+def get_team_id(principals):
+    for principal in principals:
+        if principal.startswith('t:'):
+            return principal[2:]
+    return None
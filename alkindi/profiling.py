@@ -0,0 +1,185 @@
+"""
+On-demand sampling profiler.
+
+An admin can profile a single request by adding the header
+"X-Alkindi-Profile: 1" or the query parameter "profile=1".  While the
+request runs, a background thread samples the stack of the thread
+serving the request.  The samples are stored in redis as collapsed
+stacks (one "frame;frame;frame count" line per distinct stack), which
+flamegraph.pl and speedscope accept as-is.
+
+The profile id is returned in the X-Alkindi-Profile response header;
+admins retrieve the profiles at /profiles and /profiles/{id}.
+"""
+
+from collections import Counter
+from datetime import datetime
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+
+from pyramid.httpexceptions import HTTPForbidden, HTTPNotFound
+from pyramid.response import Response
+
+from alkindi.globals import app
+
+
+PROFILE_HEADER = 'X-Alkindi-Profile'
+PROFILE_PARAM = 'profile'
+
+# Sampling interval (in seconds) and profile retention (in seconds).
+DEFAULT_INTERVAL = 0.005
+DEFAULT_TTL = 86400
+
+# Number of profile summaries kept in the 'profiles' list.
+MAX_PROFILES = 100
+
+
+def includeme(config):
+    config.add_tween(
+        'alkindi.profiling.profiler_tween_factory',
+        under='alkindi.backend.transaction_manager_tween_factory')
+    config.add_route('profiles', '/profiles', request_method='GET')
+    config.add_view(list_profiles_view, route_name='profiles', renderer='json')
+    config.add_route('profile', '/profiles/{id}', request_method='GET')
+    config.add_view(read_profile_view, route_name='profile')
+
+
+def profiler_tween_factory(handler, registry):
+
+    def tween(request):
+        # The by_admin check may query the database, so it is performed
+        # only when profiling is requested.  The tween sits under the
+        # transaction manager, the connection is ready at this point.
+        if not is_profiling_requested(request) or not request.by_admin:
+            return handler(request)
+        sampler = StackSampler(
+            threading.get_ident(),
+            float(app.get('profiler_interval', DEFAULT_INTERVAL)))
+        started = time.perf_counter()
+        sampler.start()
+        try:
+            response = handler(request)
+        finally:
+            sampler.stop()
+            duration = time.perf_counter() - started
+            profile_id = store_profile(request, sampler, duration)
+        response.headers[PROFILE_HEADER] = profile_id
+        return response
+
+    return tween
+
+
+def is_profiling_requested(request):
+    return (PROFILE_HEADER in request.headers or
+            PROFILE_PARAM in request.GET)
+
+
+def list_profiles_view(request):
+    if not request.by_admin:
+        raise HTTPForbidden()
+    items = app.redis.lrange('profiles', 0, MAX_PROFILES - 1)
+    return {
+        'success': True,
+        'profiles': [json.loads(item.decode('utf-8')) for item in items]
+    }
+
+
+def read_profile_view(request):
+    if not request.by_admin:
+        raise HTTPForbidden()
+    stacks = app.redis.get(profile_key(request.matchdict['id']))
+    if stacks is None:
+        raise HTTPNotFound()
+    return Response(body=stacks, content_type='text/plain', charset='utf-8')
+
+
+class StackSampler:
+    """ Periodically samples the stack of a thread from a daemon thread.
+        The sampling thread only holds the GIL long enough to walk the
+        frames, so the overhead stays low at a 5ms interval.
+    """
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = Counter()
+        self.n_samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name='alkindi-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            self.counts[collapse_stack(frame)] += 1
+            self.n_samples += 1
+
+    def collapsed(self):
+        lines = [
+            '{} {}'.format(stack, count)
+            for stack, count in self.counts.most_common()
+        ]
+        return '\n'.join(lines) + '\n'
+
+
+def collapse_stack(frame):
+    """ Return the stack ending at frame in collapsed format, outermost
+        frame first.
+    """
+    labels = []
+    while frame is not None:
+        labels.append(frame_label(frame))
+        frame = frame.f_back
+    labels.reverse()
+    return ';'.join(labels)
+
+
+def frame_label(frame):
+    code = frame.f_code
+    # Keep the package directory and the file name, which identify
+    # the module without the noise of the installation path.
+    path = code.co_filename
+    filename = os.path.join(
+        os.path.basename(os.path.dirname(path)), os.path.basename(path))
+    return '{}:{}'.format(filename, code.co_name)
+
+
+def profile_key(profile_id):
+    return 'profile:{}'.format(profile_id)
+
+
+def store_profile(request, sampler, duration):
+    profile_id = str(uuid.uuid4())
+    ttl = int(app.get('profiler_ttl', DEFAULT_TTL))
+    summary = {
+        'id': profile_id,
+        'created_at': '{}Z'.format(datetime.utcnow().isoformat()),
+        'method': request.method,
+        'url': request.url,
+        'user_id': request.unauthenticated_userid,
+        'duration': round(duration * 1000, 1),
+        'samples': sampler.n_samples,
+    }
+    redis = app.redis
+    with redis.pipeline() as pipe:
+        pipe.set(profile_key(profile_id), sampler.collapsed(), ex=ttl)
+        pipe.lpush('profiles', json.dumps(summary))
+        pipe.ltrim('profiles', 0, MAX_PROFILES - 1)
+        pipe.execute()
+    print("profile {} stored ({} samples, {:.1f} ms)".format(
+        profile_id, sampler.n_samples, summary['duration']))
+    return profile_id
@@ -0,0 +1,304 @@
+"""
+Redis sessions stored as hashes.
+
+Each session is a redis hash (session:<id>) with one field per session
+key, holding the value encoded as compact JSON.  The session is loaded
+with a single HGETALL when it is first used by a request; changes are
+tracked per key and written when the response is sent, as HSET/HDEL of
+the changed fields only.  A request that does not change the session
+writes nothing, except to push back its expiry once the session has
+been idle for a while.
+
+Only assignments are tracked (session[key] = value, update, pop,
+setdefault, del): a change made inside a mutable value, such as
+appending to a list stored in the session, is not saved unless the key
+is assigned again or session.changed() is called.
+
+The script that loads the session also looks up the cached principals
+of the session's user (see alkindi.principals), and leaves them in
+request.user_principals for the authentication callback, so that the
+session and the principals are read in a single round trip.
+
+The session id is carried in a cookie signed with the session secret.
+Sessions stored by pyramid_redis_sessions (pickled, with a pickled id
+in the cookie) are not read, so users log in again after the upgrade.
+A new session is only stored (and its cookie set) once a value is
+written to it.
+"""
+
+import binascii
+import hashlib
+import hmac
+import json
+import os
+import time
+
+from pyramid.interfaces import ISession
+from zope.interface import implementer
+
+from alkindi.globals import app
+from alkindi.principals import load_session_principals
+
+
+KEY_PREFIX = 'session:'
+
+# Field holding the user id, set by SessionAuthenticationPolicy (with
+# its default 'auth.' prefix).
+USER_ID_FIELD = 'auth.userid'
+
+# Field holding the session's creation time, and the time its expiry
+# was last pushed back.
+CREATED_FIELD = '_c'
+TOUCHED_FIELD = '_t'
+
+# The expiry of an unchanged session is pushed back when at least this
+# fraction of its timeout has elapsed since it was last pushed back.
+TOUCH_FRACTION = 0.1
+
+# Settings of pyramid_redis_sessions that do not apply here: the
+# application's redis client is used, and values are stored as JSON.
+IGNORED_SETTINGS = frozenset([
+    'url', 'host', 'port', 'db', 'password', 'socket_timeout',
+    'connection_pool', 'unix_socket_path', 'client_callable', 'charset',
+    'errors', 'serialize', 'deserialize', 'id_generator', 'prefix',
+    'timeout_trigger', 'cookie_samesite', 'func_check_response',
+])
+
+_MISSING = object()
+
+
+def HashSessionFactory(
+        secret, timeout=1200, cookie_name='session', cookie_max_age=None,
+        cookie_path='/', cookie_domain=None, cookie_secure=False,
+        cookie_httponly=True, cookie_on_exception=True, **ignored):
+    """ Return a session factory.  The settings have the same meaning as
+        those of pyramid_redis_sessions, which this replaces; those in
+        IGNORED_SETTINGS are accepted and have no effect, and any other
+        setting raises ValueError.
+    """
+    unknown = set(ignored) - IGNORED_SETTINGS
+    if len(unknown) != 0:
+        raise ValueError('unknown session settings: {}'.format(
+            ', '.join(sorted(unknown))))
+    secret = secret.encode('utf-8')
+
+    def factory(request):
+        redis = app.redis
+        session_id = get_session_id(request, cookie_name, secret)
+        values = {}
+        if session_id is not None:
+            values, principals = load_session(session_id)
+            if values is None:
+                session_id = None
+                values = {}
+            elif principals is not None:
+                request.user_principals = (values[USER_ID_FIELD], principals)
+        cookie_was_valid = session_id is not None
+        session = HashSession(redis, session_id, values, timeout)
+
+        def persist(request, response=None):
+            session.persist()
+
+        def set_cookie(request, response):
+            session.persist()
+            if not cookie_on_exception and request.exception is not None:
+                return
+            if session.session_id is None:
+                if cookie_was_valid:
+                    response.delete_cookie(
+                        cookie_name, path=cookie_path, domain=cookie_domain)
+            elif session.new:
+                response.set_cookie(
+                    cookie_name,
+                    value=sign_session_id(session.session_id, secret),
+                    max_age=cookie_max_age, path=cookie_path,
+                    domain=cookie_domain, secure=cookie_secure,
+                    httponly=cookie_httponly)
+
+        request.add_response_callback(set_cookie)
+        # Changes are also saved if no response is produced.
+        request.add_finished_callback(persist)
+        return session
+
+    return factory
+
+
+@implementer(ISession)
+class HashSession(dict):
+
+    def __init__(self, redis, session_id, values, timeout):
+        self.redis = redis
+        self.session_id = session_id
+        self.timeout = timeout
+        self.new = session_id is None
+        self.created = values.pop(CREATED_FIELD, None) or time.time()
+        self.touched = values.pop(TOUCHED_FIELD, None) or 0
+        super().__init__(values)
+        # Keys to write and keys to delete when the session is persisted.
+        self._changed = set()
+        self._deleted = set()
+        self._cleared = False
+
+    # Tracking of changes
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._changed.add(key)
+        self._deleted.discard(key)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._changed.discard(key)
+        self._deleted.add(key)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, default=_MISSING):
+        if key in self:
+            value = self[key]
+            del self[key]
+            return value
+        if default is _MISSING:
+            raise KeyError(key)
+        return default
+
+    def popitem(self):
+        key, value = super().popitem()
+        self._changed.discard(key)
+        self._deleted.add(key)
+        return key, value
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        super().clear()
+        self._changed.clear()
+        self._deleted.clear()
+        self._cleared = True
+
+    def changed(self):
+        """ Mark all the values as changed (for mutable values).
+        """
+        self._changed.update(self.keys())
+
+    # ISession
+
+    def invalidate(self):
+        self.clear()
+        if self.session_id is not None:
+            self.redis.delete(KEY_PREFIX + self.session_id)
+        self.session_id = None
+        self.new = True
+        self._cleared = False
+        self.created = time.time()
+
+    def new_csrf_token(self):
+        token = binascii.hexlify(os.urandom(20)).decode('ascii')
+        self['_csrft_'] = token
+        return token
+
+    def get_csrf_token(self):
+        token = self.get('_csrft_')
+        if token is None:
+            token = self.new_csrf_token()
+        return token
+
+    def flash(self, msg, queue='', allow_duplicate=True):
+        storage = self.setdefault('_f_' + queue, [])
+        if allow_duplicate or (msg not in storage):
+            storage.append(msg)
+            self.changed()
+
+    def peek_flash(self, queue=''):
+        return self.get('_f_' + queue, [])
+
+    def pop_flash(self, queue=''):
+        return self.pop('_f_' + queue, [])
+
+    # Storage
+
+    def persist(self):
+        """ Write the changes made to the session, if any.
+        """
+        now = time.time()
+        dirty = self._cleared or self._changed or self._deleted
+        if not dirty:
+            if self.session_id is None or \
+                    now - self.touched < self.timeout * TOUCH_FRACTION:
+                return
+        if self.session_id is None:
+            if len(self) == 0:
+                # Do not store empty sessions.
+                return
+            self.session_id = binascii.hexlify(os.urandom(32)).decode('ascii')
+            self._changed.update(self.keys())
+        key = KEY_PREFIX + self.session_id
+        fields = {
+            name: encode_value(self[name]) for name in self._changed
+        }
+        fields[CREATED_FIELD] = encode_value(self.created)
+        fields[TOUCHED_FIELD] = encode_value(now)
+        with self.redis.pipeline(transaction=True) as pipe:
+            if self._cleared:
+                pipe.delete(key)
+            elif self._deleted:
+                pipe.hdel(key, *self._deleted)
+            pipe.hset(key, mapping=fields)
+            pipe.expire(key, self.timeout)
+            pipe.execute()
+        self.touched = now
+        self._changed.clear()
+        self._deleted.clear()
+        self._cleared = False
+
+
+def load_session(session_id):
+    """ Return the values of the session, or None if it does not exist,
+        and the cached principals of its user, or None.
+    """
+    fields, principals = load_session_principals(
+        KEY_PREFIX + session_id, USER_ID_FIELD)
+    if len(fields) == 0:
+        return None, None
+    values = {
+        fields[i].decode('utf-8'): decode_value(fields[i + 1])
+        for i in range(0, len(fields), 2)
+    }
+    return values, principals
+
+
+def encode_value(value):
+    return json.dumps(value, separators=(',', ':'))
+
+
+def decode_value(value):
+    return json.loads(value.decode('utf-8'))
+
+
+def sign_session_id(session_id, secret):
+    return '{}.{}'.format(session_id, session_signature(session_id, secret))
+
+
+def get_session_id(request, cookie_name, secret):
+    """ Return the session id from the request's cookie, or None if it
+        is missing or its signature is not valid.
+    """
+    value = request.cookies.get(cookie_name)
+    if value is None:
+        return None
+    session_id, _, signature = value.partition('.')
+    expected = session_signature(session_id, secret)
+    if not hmac.compare_digest(
+            signature.encode('utf-8'), expected.encode('ascii')):
+        return None
+    return session_id
+
+
+def session_signature(session_id, secret):
+    return hmac.new(
+        secret, session_id.encode('utf-8'), hashlib.sha256).hexdigest()
@@ -0,0 +1,99 @@
+"""
+Cache of the task corpora used by the task modules in alkindi/tasks/.
+
+A corpus is described by an INDEX file that lists the task files, one
+per line, relative to the INDEX.  The first access to a corpus reads
+the INDEX and parses every task (with the module's parse function);
+entries that are missing or fail to parse are logged, and keep their
+position in the INDEX (so that the tasks chosen by seed do not move),
+but cannot be chosen.
+The parsed tasks are kept in memory as JSON strings, so that they
+cannot be modified by the callers, and every get_task decodes a fresh
+copy.  Later accesses only stat the INDEX, and the corpus is read
+again when its modification time changes.
+
+Files are read through mmap if ALKINDI_TASKS_MMAP is set in the
+environment.
+"""
+
+import json
+import mmap
+import os
+import random
+import threading
+
+
+USE_MMAP = bool(os.environ.get('ALKINDI_TASKS_MMAP'))
+
+
+class TaskCorpus:
+    """ The corpora of a task module, by INDEX path.
+        parse_task(task_txt, read) returns the task stored in the file
+        task_txt (and its siblings), reading files with read(path).
+    """
+
+    def __init__(self, parse_task, use_mmap=USE_MMAP):
+        self.parse_task = parse_task
+        self.use_mmap = use_mmap
+        # INDEX path -> (modification time, tuple of JSON-encoded tasks,
+        # None for the entries that could not be parsed)
+        self.corpora = {}
+        self.lock = threading.Lock()
+
+    def get_task(self, index, choice=None):
+        """ Return a copy of a task of the corpus, the one at position
+            `choice` in the INDEX, or a random one.  RuntimeError is
+            raised if the chosen entry could not be parsed.
+        """
+        tasks = self.load(index)
+        if choice is None:
+            task = random.choice([task for task in tasks if task is not None])
+        else:
+            task = tasks[choice]
+            if task is None:
+                raise RuntimeError(
+                    "bad task {} in {}".format(choice, index))
+        return json.loads(task)
+
+    def count(self, index):
+        return len(self.load(index))
+
+    def load(self, index):
+        mtime = os.stat(index).st_mtime_ns
+        corpus = self.corpora.get(index)
+        if corpus is not None and corpus[0] == mtime:
+            return corpus[1]
+        with self.lock:
+            corpus = self.corpora.get(index)
+            if corpus is None or corpus[0] != mtime:
+                corpus = (mtime, self.parse_corpus(index))
+                self.corpora[index] = corpus
+        return corpus[1]
+
+    def parse_corpus(self, index):
+        base_dir = os.path.dirname(index)
+        tasks = []
+        for line in self.read(index).strip().split('\n'):
+            task_txt = os.path.join(base_dir, line)
+            try:
+                task = json.dumps(self.parse_task(task_txt, self.read))
+            except Exception as ex:
+                print("bad task {} ({}): {!r}".format(
+                    len(tasks), task_txt, ex))
+                task = None
+            tasks.append(task)
+        if all(task is None for task in tasks):
+            raise RuntimeError("empty task corpus: {}".format(index))
+        return tuple(tasks)
+
+    def read(self, path):
+        return read_text(path, self.use_mmap)
+
+
+def read_text(path, use_mmap=False):
+    with open(path, 'rb') as f:
+        if use_mmap and os.fstat(f.fileno()).st_size > 0:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                # Decode straight from the mapping, without a bytes copy.
+                return str(m, 'utf-8')
+        return str(f.read(), 'utf-8')
@@ -0,0 +1,115 @@
+"""
+Compact encoding of the 5x5 letter grids of the playfair and adfgx
+task modules (in alkindi/tasks/).
+
+A grid is a string of 25 characters, row by row: the cell's letter (of
+ALPHABET, which has no W) or UNKNOWN.  It replaces grids of nested
+lists, of letter indices or None (adfgx) or of {'q': 'hint', 'l': i}
+and {'q': 'unknown'} cells (playfair), which take about 6 (adfgx) to 18
+(playfair) times more space in JSON.  The decode functions return the
+former structures, for display and for code that has not been
+converted; decode_team_data gives the task frontends the team_data
+they were written for.  The modules mark the team_data whose grids
+they store in compact form (ENCODING_KEY), so that only those are
+decoded: other task backends may use the same keys for other data.
+"""
+
+ALPHABET = 'ABCDEFGHIJKLMNOPQRSTUVXYZ'
+SIZE = 5
+UNKNOWN = '.'
+EMPTY_GRID = UNKNOWN * (SIZE * SIZE)
+
+# team_data key marking the instances whose grids are compact.
+ENCODING_KEY = 'grid_encoding'
+COMPACT = 'compact'
+
+
+def is_compact(grid):
+    return isinstance(grid, str)
+
+
+def is_in_grid(row, col):
+    return 0 <= row < SIZE and 0 <= col < SIZE
+
+
+def get_cell(grid, row, col):
+    """ Return the letter index in the cell, or None if it is unknown.
+    """
+    char = grid[row * SIZE + col]
+    return None if char == UNKNOWN else ALPHABET.index(char)
+
+
+def set_cell(grid, row, col, index):
+    """ Return the grid with the cell set to the letter index (or to
+        unknown if index is None).
+    """
+    pos = row * SIZE + col
+    char = UNKNOWN if index is None else ALPHABET[index]
+    return grid[:pos] + char + grid[pos + 1:]
+
+
+def find_letter(grid, index):
+    """ Return the (row, col) of the letter index in the grid, or
+        (None, None) if it does not appear.
+    """
+    pos = grid.find(ALPHABET[index])
+    if pos == -1:
+        return (None, None)
+    return divmod(pos, SIZE)
+
+
+def encode_indices(rows):
+    return ''.join(
+        UNKNOWN if index is None else ALPHABET[index]
+        for cells in rows for index in cells)
+
+
+def decode_indices(grid):
+    return [
+        [get_cell(grid, row, col) for col in range(SIZE)]
+        for row in range(SIZE)
+    ]
+
+
+def encode_cells(rows):
+    return ''.join(
+        ALPHABET[cell['l']] if 'l' in cell else UNKNOWN
+        for cells in rows for cell in cells)
+
+
+def decode_cells(grid):
+    return [
+        [
+            {'q': 'unknown'} if index is None else {'q': 'hint', 'l': index}
+            for index in row_indices
+        ]
+        for row_indices in decode_indices(grid)
+    ]
+
+
+def mark_compact(team_data):
+    """ Mark team_data as holding compact grids.  Return True if it
+        was not marked.
+    """
+    if team_data.get(ENCODING_KEY) == COMPACT:
+        return False
+    team_data[ENCODING_KEY] = COMPACT
+    return True
+
+
+def decode_team_data(team_data):
+    """ Return a copy of an instance's team_data with its compact grids
+        (playfair's hints, adfgx's substitution_grid) decoded.  The
+        team_data of instances not marked by mark_compact is returned
+        as is.
+    """
+    if team_data.get(ENCODING_KEY) != COMPACT:
+        return team_data
+    team_data = dict(team_data)
+    del team_data[ENCODING_KEY]
+    if is_compact(team_data.get('hints')):
+        team_data['hints'] = decode_cells(team_data['hints'])
+    if is_compact(team_data.get('substitution_grid')):
+        team_data['substitution_grid'] = decode_indices(
+            team_data['substitution_grid'])
+    return team_data
@@ -0,0 +1,146 @@
+"""
+Task backend actions (generate, gradeAnswer, grantHint) implemented by
+the task modules bundled in alkindi/tasks/ (playfair, adfgx, round4).
+
+The modules work on a single dict holding the instance's full_data and
+team_data.  The protocol's `task` is the team_data, and its `full_task`
+is the rest of the dict (full_data, and the score for playfair).
+
+The generate params give the path of the task's INDEX file, which
+lists the task files; the seed selects one of them:
+
+    {"index": "/srv/alkindi/tasks/adfgx/INDEX"}
+
+Used by the local task server (alkindi.task_server) and the in-process
+task runtime (alkindi.task_runtime).
+"""
+
+import copy
+import importlib.util
+import os
+import random
+import threading
+
+
+MODULE_NAMES = ('playfair', 'adfgx', 'round4')
+MODULES_DIR = os.path.join(os.path.dirname(__file__), 'tasks')
+
+_modules = {}
+_modules_lock = threading.Lock()
+
+
+def perform(name, action, body):
+    """ Perform a protocol action on the decoded request body, and
+        return the response body.
+    """
+    if action == 'generate':
+        return generate(name, body.get('params') or {}, body['seed'])
+    if action == 'gradeAnswer':
+        return grade_answer(
+            name, body['full_task'], body['task'], body['answer'])
+    if action == 'grantHint':
+        return grant_hint(name, body['full_task'], body['task'], body['query'])
+    raise ValueError('unknown action {}'.format(action))
+
+
+def generate(name, params, seed):
+    module = load_module(name)
+    index = params['index']
+    choice = random.Random(seed).randrange(module.corpus.count(index))
+    return split_instance(module.get_task(index, choice=choice))
+
+
+def grade_answer(name, full_task, task, answer):
+    module = load_module(name)
+    grading = module.grade(load_instance(module, full_task, task), answer)
+    if grading is None:
+        # The modules reject malformed answers, score them as wrong.
+        return {
+            'score': '0',
+            'is_solution': False,
+            'is_full_solution': False,
+            'feedback': None
+        }
+    return {
+        'score': grading['actual_score'],
+        'is_solution': bool(grading['is_solution']),
+        'is_full_solution': bool(grading['is_full_solution']),
+        'feedback': grading.get('feedback')
+    }
+
+
+def grant_hint(name, full_task, task, query):
+    module = load_module(name)
+    instance = load_instance(module, full_task, task)
+    success = module.get_hint(instance, query)
+    result = split_instance(instance)
+    result['success'] = bool(success)
+    return result
+
+
+def migrate(name, full_task, task):
+    """ Convert a stored instance to the module's current encoding.
+        Return the pair (full_task, task), or None if it is unchanged.
+    """
+    module = load_module(name)
+    migrate_instance = getattr(module, 'migrate_instance', None)
+    if migrate_instance is None:
+        return None
+    instance = join_instance(full_task, task)
+    if not migrate_instance(instance):
+        return None
+    result = split_instance(instance)
+    return result['full_task'], result['task']
+
+
+def load_modules():
+    for name in MODULE_NAMES:
+        load_module(name)
+
+
+def load_module(name):
+    """ Load a module from alkindi/tasks/, which is not a package (and
+        is shadowed by alkindi/tasks.py).
+    """
+    if name not in MODULE_NAMES:
+        raise ValueError('unknown task module {}'.format(name))
+    with _modules_lock:
+        module = _modules.get(name)
+        if module is None:
+            spec = importlib.util.spec_from_file_location(
+                'alkindi_task_{}'.format(name),
+                os.path.join(MODULES_DIR, name + '.py'))
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            _modules[name] = module
+    return module
+
+
+#
+# Private definitions
+#
+
+
+def load_instance(module, full_task, task):
+    """ Join the instance and convert it to the module's current
+        encoding, so that instances stored before a change of encoding
+        (and not converted by alkindi.migrate_instances) keep working.
+    """
+    instance = join_instance(full_task, task)
+    migrate_instance = getattr(module, 'migrate_instance', None)
+    if migrate_instance is not None:
+        migrate_instance(instance)
+    return instance
+
+
+def split_instance(instance):
+    full_task = dict(instance)
+    task = full_task.pop('team_data')
+    return {'task': task, 'full_task': full_task}
+
+
+def join_instance(full_task, task):
+    # The modules update the instance in place, work on a copy.
+    instance = copy.deepcopy(full_task)
+    instance['team_data'] = copy.deepcopy(task)
+    return instance
@@ -0,0 +1,155 @@
+"""
+In-process runtime for the task modules bundled in alkindi/tasks/.
+
+A task whose backend_url is local:<module> (for example local:adfgx) is
+not called over HTTP: its actions run in a pool of worker processes
+owned by the web worker (see alkindi.task_modules), which avoids the
+network round trips and uses every core.
+
+The runtime is enabled by its settings in redis (key task_runtime):
+
+    {"processes": 2}
+
+The pool is per web worker, and each of its processes holds the parsed
+corpora (see alkindi.task_corpus), so its default size is small.
+
+A process that dies breaks the pool, which is then replaced.  Since a
+running action cannot be interrupted, a call that times out also
+replaces the pool, killing its processes: the other calls in progress
+are sent once more to the new pool.
+
+The pool is started and its processes load the task modules when the
+application starts.  With gunicorn's preload_app, the master's pool is
+shut down before the workers fork, and each worker starts its own.
+The pool processes are started by a fork server, so that they do not
+inherit the web worker's threads and connections.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import os
+import threading
+
+from alkindi import task_modules
+from alkindi.errors import ModelError
+from alkindi.globals import app
+
+
+LOCAL_SCHEME = 'local:'
+TIMEOUT_ERROR = 'task runtime timeout'
+
+# Default number of processes of each web worker's pool.
+DEFAULT_PROCESSES = 2
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def is_local(task):
+    return task['backend_url'].startswith(LOCAL_SCHEME)
+
+
+def call(task, action, body, timeout):
+    """ Perform the action of a local task in the pool, waiting at most
+        timeout seconds for the result.
+    """
+    name = task['backend_url'][len(LOCAL_SCHEME):].strip()
+    retried = False
+    while True:
+        pool = get_pool()
+        try:
+            future = pool.submit(task_modules.perform, name, action, body)
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            # The process keeps running the action, free its slot.
+            print("task runtime: {} timed out, recycling the pool".format(
+                action))
+            recycle_pool(pool)
+            raise ModelError(TIMEOUT_ERROR)
+        except BrokenProcessPool:
+            recycle_pool(pool)
+            if retried:
+                raise
+            retried = True
+
+
+def is_runtime_failure(ex):
+    """ Return True if the exception raised by call is a fault of the
+        runtime (a timeout or a dead process) rather than an error
+        raised by the task module for this request.
+    """
+    if isinstance(ex, BrokenProcessPool):
+        return True
+    return isinstance(ex, ModelError) and str(ex) == TIMEOUT_ERROR
+
+
+def warm_up():
+    """ Start the pool's processes if the runtime is enabled.
+    """
+    settings = app.get_json('task_runtime', None)
+    if settings is None:
+        return
+    pool = get_pool()
+    # The pool starts a process per pending call, up to its size.
+    futures = [
+        pool.submit(task_modules.load_modules)
+        for _ in range(get_pool_size(settings))
+    ]
+    for future in futures:
+        future.result()
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            settings = app.get_json('task_runtime', None) or {}
+            _pool = ProcessPoolExecutor(
+                max_workers=get_pool_size(settings),
+                mp_context=multiprocessing.get_context('forkserver'),
+                initializer=task_modules.load_modules)
+    return _pool
+
+
+#
+# Private definitions
+#
+
+
+def get_pool_size(settings):
+    return int(settings.get('processes') or DEFAULT_PROCESSES)
+
+
+def recycle_pool(pool):
+    """ Replace the pool, if it is still the current one, and kill its
+        processes.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is not pool:
+            return
+        _pool = None
+    processes = list((getattr(pool, '_processes', None) or {}).values())
+    pool.shutdown(wait=False, cancel_futures=True)
+    for process in processes:
+        if process.is_alive():
+            process.terminate()
+
+
+def shutdown_before_fork():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=True)
+        _pool = None
+
+
+def warm_up_after_fork():
+    if app.get_json('task_runtime', None) is not None:
+        threading.Thread(target=warm_up, daemon=True).start()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(
+        before=shutdown_before_fork, after_in_child=warm_up_after_fork)
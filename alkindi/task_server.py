@@ -0,0 +1,187 @@
+"""
+Local stand-in task backend, for development and load tests:
+
+    python -m alkindi.task_server [--port 8014] [--latency lognormal:-2,0.5]
+        [--error-rate 0.05] [--hang-rate 0.01] [--hang-for 300]
+
+It serves /<module>/generate, /<module>/gradeAnswer and
+/<module>/grantHint for the task modules bundled in alkindi/tasks/ (see
+alkindi.task_modules), so a task whose backend_url is
+http://127.0.0.1:8014/adfgx/ is handled by adfgx.py.  Both protocol
+versions are supported (see alkindi.tasks.post_referenced).
+
+Faults are injected before each action is performed: a delay drawn
+from the latency distribution, then with the given probabilities an
+HTTP 500 error, or a hang (the response is delayed by hang_for seconds,
+beyond the platform's timeouts).  The latency distributions are:
+
+    fixed:SECONDS  uniform:LOW,HIGH  exp:MEAN  lognormal:MU,SIGMA
+"""
+
+import argparse
+from collections import OrderedDict
+import gzip
+import json
+import random
+import socketserver
+import sys
+import threading
+import time
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+from alkindi import task_modules
+from alkindi.tasks import INSTANCE_KEYS, UNKNOWN_INSTANCE_STATUS, content_hash
+
+
+ACTIONS = ('generate', 'gradeAnswer', 'grantHint')
+
+# Number of instance parts kept for protocol 2.
+MAX_INSTANCES = 10000
+
+LATENCY_DISTRIBUTIONS = {
+    'fixed': lambda seconds: seconds,
+    'uniform': random.uniform,
+    'exp': lambda mean: random.expovariate(1 / mean),
+    'lognormal': random.lognormvariate,
+}
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Local stand-in task backend.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8014)
+    parser.add_argument('--latency', default='fixed:0', type=parse_latency)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--hang-rate', type=float, default=0)
+    parser.add_argument('--hang-for', type=float, default=300)
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args(argv[1:])
+    handler_class = WSGIRequestHandler if args.verbose else QuietHandler
+    server = make_server(
+        args.host, args.port, make_application(args),
+        server_class=ThreadingWSGIServer, handler_class=handler_class)
+    print("task server: listening on {}:{}".format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def make_application(settings):
+    instances = InstanceStore(MAX_INSTANCES)
+
+    def application(environ, start_response):
+        path = environ.get('PATH_INFO', '').strip('/').split('/')
+        if environ['REQUEST_METHOD'] != 'POST' or len(path) != 2 or \
+                path[1] not in ACTIONS or \
+                path[0] not in task_modules.MODULE_NAMES:
+            return respond(start_response, 404, {'error': 'not found'})
+        name, action = path
+        inject_faults(settings)
+        if random.random() < settings.error_rate:
+            return respond(start_response, 500, {'error': 'injected'})
+        body = read_body(environ)
+        if body.get('protocol', 1) >= 2:
+            if not instances.resolve(body):
+                return respond(
+                    start_response, UNKNOWN_INSTANCE_STATUS,
+                    {'error': 'unknown instance'})
+        result = task_modules.perform(name, action, body)
+        if body.get('protocol', 1) >= 2:
+            # Keep the instances generated or updated.
+            instances.add(result)
+        return respond(start_response, 200, result)
+
+    return application
+
+
+class InstanceStore:
+    """ The instance parts received or produced, by content hash, for
+        protocol 2.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, body):
+        for key in INSTANCE_KEYS:
+            if key in body:
+                self.put(content_hash(body[key]), body[key])
+
+    def put(self, ref, value):
+        with self.lock:
+            self.items[ref] = value
+            self.items.move_to_end(ref)
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def resolve(self, body):
+        """ Replace the references in body with the instance parts.
+            Return False if a part is missing.
+        """
+        refs = body.pop('instance', {})
+        for key, ref in refs.items():
+            if key in body:
+                self.put(ref, body[key])
+                continue
+            with self.lock:
+                value = self.items.get(ref)
+            if value is None:
+                return False
+            body[key] = value
+        return True
+
+
+class ThreadingWSGIServer(socketserver.ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class QuietHandler(WSGIRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+
+def parse_latency(text):
+    kind, _, values = text.partition(':')
+    if kind not in LATENCY_DISTRIBUTIONS:
+        raise argparse.ArgumentTypeError(
+            'unknown distribution {}'.format(kind))
+    params = [float(value) for value in values.split(',') if value]
+    sample = LATENCY_DISTRIBUTIONS[kind]
+    return lambda: max(0, sample(*params))
+
+
+def inject_faults(settings):
+    time.sleep(settings.latency())
+    if random.random() < settings.hang_rate:
+        time.sleep(settings.hang_for)
+
+
+def read_body(environ):
+    length = int(environ.get('CONTENT_LENGTH') or 0)
+    data = environ['wsgi.input'].read(length)
+    if environ.get('HTTP_CONTENT_ENCODING') == 'gzip':
+        data = gzip.decompress(data)
+    return json.loads(data.decode('utf-8'))
+
+
+def respond(start_response, status, value):
+    reasons = {
+        200: 'OK', 404: 'Not Found', 409: 'Conflict',
+        500: 'Internal Server Error'
+    }
+    data = json.dumps(value).encode('utf-8')
+    start_response('{} {}'.format(status, reasons[status]), [
+        ('Content-Type', 'application/json'),
+        ('Content-Length', str(len(data)))
+    ])
+    return [data]
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
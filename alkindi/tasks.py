@@ -1,66 +1,281 @@
 
-import requests
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import gzip
+import hashlib
 import json
+import os
+import time
 import urllib.parse
 
+import requests
 
-def task_generate(backend_url, params, seed, auth=None):
-    generate_url = urllib.parse.urljoin(backend_url, 'generate')
-    headers = {
-        'Accept': 'application/json',
-        'Content-Type': 'application/json'
-    }
-    if auth is not None:
-        headers['Authorization'] = auth
+from alkindi import balancer
+from alkindi import breakers
+from alkindi import http_client
+from alkindi import task_runtime
+from alkindi.deadlines import http_timeout, get_deadline, use_deadline
+from alkindi.errors import DeadlineError, ModelError
+
+
+# Calls that can safely be sent twice, and are hedged.
+HEDGED_ACTIONS = {'gradeAnswer'}
+
+# Threads used to run hedged calls.
+HEDGE_THREADS = 8
+
+# Protocol 2: the parts of the task instance that are sent by reference
+# (content hash), and the status of the answer of a backend that does
+# not have them.  Request bodies are sent gzip-compressed.
+INSTANCE_KEYS = ('full_task', 'task')
+UNKNOWN_INSTANCE_STATUS = 409
+GZIP_LEVEL = 6
+
+_executor = None
+
+
+def task_generate(task, params, seed):
     body = {
         'params': params,
         'seed': seed
     }
-    req = requests.post(
-        generate_url, headers=headers, data=json.dumps(body),
-        verify='/etc/ssl/certs/ca-certificates.crt')
-    req.raise_for_status()
-    result = req.json()
+    result = call_task_backend(task, 'generate', body)
     if 'task' not in result or 'full_task' not in result:
-        raise RuntimeError('bad task generator {}'.format(generate_url))
+        raise RuntimeError(
+            'bad task generator {}'.format(task['backend_url']))
     return (result['task'], result['full_task'])
 
 
-def task_grade_answer(backend_url, full_task, task, answer, auth=None):
-    submit_answer_url = urllib.parse.urljoin(backend_url, 'gradeAnswer')
-    headers = {
-        'Accept': 'application/json',
-        'Content-Type': 'application/json'
-    }
-    if auth is not None:
-        headers['Authorization'] = auth
+def task_grade_answer(task, full_task, team_task, answer):
     body = {
         'full_task': full_task,
-        'task': task,
+        'task': team_task,
         'answer': answer
     }
-    req = requests.post(
-        submit_answer_url, headers=headers, data=json.dumps(body),
-        verify='/etc/ssl/certs/ca-certificates.crt')
-    req.raise_for_status()
-    return req.json()
+    return call_task_backend(task, 'gradeAnswer', body)
+
+
+def task_grant_hint(task, full_task, team_task, query):
+    body = {
+        'full_task': full_task,
+        'task': team_task,
+        'query': query
+    }
+    return call_task_backend(task, 'grantHint', body)
 
 
-def task_grant_hint(backend_url, full_task, task, query, auth=None):
-    submit_answer_url = urllib.parse.urljoin(backend_url, 'grantHint')
+def call_task_backend(task, action, body):
+    """ Call an action of the task's backend, through the task's circuit
+        breaker (see alkindi.breakers).  ModelError is raised without
+        calling the backend if the breaker is open.
+        Only the faults of the backend (see is_backend_failure) count as
+        failures; an error caused by the request itself, such as a 4xx
+        answer, shows that the backend is up.
+    """
+    task_id = task['id']
+    settings = breakers.get_settings(task_id)
+    # Bound the read timeout by the deadline (the local task runtime
+    # uses it as is).
+    timeouts = {
+        'connect': settings['connect'],
+        'read': http_timeout(settings['read'])
+    }
+    is_probe = breakers.before_call(task_id, settings)
+    try:
+        if task_runtime.is_local(task):
+            # Built-in task modules run in the worker's process pool.
+            result = task_runtime.call(task, action, body, timeouts['read'])
+        else:
+            result = balanced_call(task, action, body, settings, timeouts)
+    except Exception as ex:
+        if is_backend_failure(task, ex):
+            breakers.record_failure(task_id, settings, is_probe)
+        else:
+            breakers.record_success(task_id, settings, is_probe)
+        raise
+    breakers.record_success(task_id, settings, is_probe)
+    return result
+
+
+def balanced_call(task, action, body, settings, timeouts):
+    """ Call the action on the least loaded of the task's endpoints.
+        Idempotent actions are hedged: if the call is slower than usual,
+        a second one is sent to another endpoint, and the first answer
+        is used.
+    """
+    endpoints = balancer.get_endpoints(task)
+    call = EndpointCall(task, action, body, settings, timeouts)
+    first = call.acquire(endpoints)
+    if action not in HEDGED_ACTIONS or len(endpoints) < 2 or \
+            not settings['hedge']:
+        return call.post(first)
+    executor = get_executor()
+    futures = [executor.submit(call.post, first)]
+    done, pending = wait(futures, timeout=get_hedge_delay(call))
+    if not done:
+        second = call.acquire(endpoints, exclude=first[0])
+        if second is not None:
+            print("hedging {} on task {}".format(action, task['id']))
+            futures.append(executor.submit(call.post, second))
+    error = None
+    pending = futures
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                return future.result()
+            if error is None:
+                error = future.exception()
+    raise error
+
+
+class EndpointCall:
+
+    def __init__(self, task, action, body, settings, timeouts):
+        self.task = task
+        self.action = action
+        self.body = body
+        self.settings = settings
+        self.timeouts = timeouts
+        # Hedged calls run in other threads, under the caller's deadline.
+        self.deadline = get_deadline()
+
+    def acquire(self, endpoints, exclude=None):
+        lease = self.timeouts['connect'] + self.timeouts['read'] + 5
+        if exclude is None and len(endpoints) == 1:
+            # Nothing to balance.
+            return endpoints[0], None
+        selected = balancer.acquire_endpoint(endpoints, lease, exclude)
+        if selected is None and exclude is None:
+            raise ModelError('no task backend')
+        return selected
+
+    def post(self, selected):
+        endpoint, token = selected
+        url = urllib.parse.urljoin(endpoint, self.action)
+        started = time.perf_counter()
+        try:
+            with use_deadline(self.deadline):
+                if self.settings['protocol'] >= 2:
+                    result = post_referenced(
+                        url, self.body, self.task['backend_auth'],
+                        self.timeouts)
+                else:
+                    result = post_json(
+                        url, self.body, self.task['backend_auth'],
+                        self.timeouts)
+        except Exception as ex:
+            if is_endpoint_failure(ex):
+                balancer.mark_down(endpoint, self.settings['eject_for'])
+            raise
+        finally:
+            if token is not None:
+                balancer.release_endpoint(endpoint, token)
+        balancer.record_latency(
+            self.task['id'], self.action, time.perf_counter() - started)
+        return result
+
+
+def post_json(url, body, auth=None, timeouts=None, compress=False):
+    """ POST body (encoded as JSON) to a task backend and return the
+        decoded response.  The call is bounded by the request deadline.
+    """
     headers = {
         'Accept': 'application/json',
         'Content-Type': 'application/json'
     }
     if auth is not None:
         headers['Authorization'] = auth
-    body = {
-        'full_task': full_task,
-        'task': task,
-        'query': query
-    }
-    req = requests.post(
-        submit_answer_url, headers=headers, data=json.dumps(body),
-        verify='/etc/ssl/certs/ca-certificates.crt')
+    data = json.dumps(body)
+    if compress:
+        data = gzip.compress(data.encode('utf-8'), GZIP_LEVEL)
+        headers['Content-Encoding'] = 'gzip'
+    req = http_client.post(url, headers=headers, data=data, timeouts=timeouts)
     req.raise_for_status()
     return req.json()
+
+
+def post_referenced(url, body, auth=None, timeouts=None):
+    """ POST body to a task backend using protocol 2: the task instance
+        (full_task and task) is referenced by the SHA-256 of its
+        canonical JSON encoding, and is only sent if the backend answers
+        that it does not have it (it keeps the instances it generated
+        or received).
+    """
+    short_body = {'protocol': 2}
+    refs = {}
+    for key, value in body.items():
+        if key in INSTANCE_KEYS:
+            refs[key] = content_hash(value)
+        else:
+            short_body[key] = value
+    if len(refs) > 0:
+        short_body['instance'] = refs
+    try:
+        return post_json(url, short_body, auth, timeouts, compress=True)
+    except Exception as ex:
+        response = getattr(ex, 'response', None)
+        if len(refs) == 0 or response is None or \
+                response.status_code != UNKNOWN_INSTANCE_STATUS:
+            raise
+    full_body = dict(short_body)
+    for key in refs:
+        full_body[key] = body[key]
+    return post_json(url, full_body, auth, timeouts, compress=True)
+
+
+def content_hash(value):
+    canonical = json.dumps(
+        value, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def get_hedge_delay(call):
+    p95 = balancer.get_latency_percentile(call.task['id'], call.action)
+    if p95 is None:
+        return call.settings['hedge_delay']
+    return max(p95, call.settings['hedge_min_delay'])
+
+
+def is_backend_failure(task, ex):
+    if task_runtime.is_local(task):
+        return task_runtime.is_runtime_failure(ex)
+    if isinstance(ex, ModelError):
+        # All the task's endpoints are marked down.
+        return str(ex) == 'no task backend'
+    return is_endpoint_failure(ex)
+
+
+def is_endpoint_failure(ex):
+    """ Return True if the exception raised by a call shows a fault of
+        the endpoint: no response or a 5xx answer, or a connect or read
+        timeout that was the endpoint's own.
+    """
+    if isinstance(ex, DeadlineError):
+        # A timeout shortened by the caller's deadline is reported as
+        # 'deadline exceeded' (see deadlines.http_deadline), only the
+        # endpoint's own timeouts have the requests exception as cause.
+        cause = ex.args[1] if len(ex.args) > 1 else None
+        return isinstance(cause, requests.Timeout)
+    if isinstance(ex, requests.HTTPError):
+        # An HTTP error below 500 is an answer from a healthy endpoint.
+        response = ex.response
+        return response is None or response.status_code >= 500
+    if isinstance(ex, getattr(requests, 'JSONDecodeError', ())):
+        return False
+    return isinstance(ex, requests.RequestException)
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=HEDGE_THREADS)
+    return _executor
+
+
+def reset_after_fork():
+    global _executor
+    _executor = None
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_after_fork)
@@ -1,46 +1,45 @@
 import os
-import random
 import re
-from datetime import datetime
 from unidecode import unidecode
 from decimal import Decimal
 
+from alkindi.task_corpus import TaskCorpus
+from alkindi.task_grids import (
+    ALPHABET, EMPTY_GRID, encode_indices, find_letter, get_cell,
+    is_compact, is_in_grid, mark_compact, set_cell)
+
 __all__ = ['get_task', 'get_hint', 'get_current_score', 'grade']
 
 
 INITIAL_SCORE = 1000
-ALPHABET = 'ABCDEFGHIJKLMNOPQRSTUVXYZ'
+
+# The hint ledger in team_data is the list [total cost, count of each
+# of HINT_TYPES], updated as hints are granted.  The history of the
+# queries is kept by the backend (see alkindi.model.hints).
+HINT_TYPES = (
+    'subst-decipher', 'subst-cipher', 'perm-decipher', 'perm-cipher')
+EMPTY_LEDGER = [0] * (1 + len(HINT_TYPES))
 
 
 def get_task(index, choice=None):
-    with open(index, 'r') as f:
-        lines = f.read().strip().split('\n')
-        if choice is None:
-            line = random.choice(lines)
-        else:
-            line = lines[choice]
-        base_dir = os.path.dirname(index)
-        task_txt = os.path.join(base_dir, line)
-        if not os.path.isfile(task_txt):
-            raise RuntimeError("missing task file: {}".format(task_txt))
-        task_dir = os.path.dirname(task_txt)
-        hints_txt = task_file(task_dir, 'hints.txt')
-        plain_txt = task_file(task_dir, 'plain.txt')
-        answer_txt = task_file(task_dir, 'answer.txt')
-    with open(task_txt, 'r') as f:
-        cipher_text = f.read().strip()
-    with open(hints_txt, 'r') as f:
-        hints = f.read().strip()
-    with open(plain_txt, 'r') as f:
-        plain_text = f.read().strip()
-    with open(answer_txt, 'r') as f:
-        answer = f.read().strip()
+    return corpus.get_task(index, choice)
+
+
+def parse_task(task_txt, read):
+    task_dir = os.path.dirname(task_txt)
+    hints_txt = task_file(task_dir, 'hints.txt')
+    plain_txt = task_file(task_dir, 'plain.txt')
+    answer_txt = task_file(task_dir, 'answer.txt')
+    cipher_text = read(task_txt).strip()
+    hints = read(hints_txt).strip()
+    plain_text = read(plain_txt).strip()
+    answer = read(answer_txt).strip()
     hint_lines = hints.split('\n')
     permutation = read_permutation(hint_lines[0])
     substitution_grid = read_grid(hint_lines[-5:])
     initial_permutation = empty_permutation(permutation)
-    initial_grid = empty_grid(substitution_grid)
-    return {
+    initial_grid = EMPTY_GRID
+    task = {
         'task_dir': task_dir,
         'full_data': {
             'cipher_text': cipher_text,
@@ -54,8 +53,14 @@ def get_task(index, choice=None):
             'cipher_text': cipher_text,
             'permutation': initial_permutation,
             'substitution_grid': initial_grid,
+            'hint_ledger': list(EMPTY_LEDGER),
         }
     }
+    mark_compact(task['team_data'])
+    return task
+
+
+corpus = TaskCorpus(parse_task)
 
 
 def task_file(dir, name):
@@ -75,40 +80,39 @@ def empty_permutation(permutation):
 
 
 def read_grid(lines):
-    return [
+    """ Return the compact encoding of the grid (see alkindi.task_grids).
+    """
+    return encode_indices([
         [ALPHABET.index(cell) for cell in line.strip().split(' ')]
         for line in lines[-5:]
-    ]
-
-
-def empty_grid(grid):
-    return [[None for cell in row] for row in grid]
-
-
-def find_in_grid(grid, value):
-    for row, row_cells in enumerate(grid):
-        for col, cell in enumerate(row_cells):
-            if cell == value:
-                return (row, col)
-    return (None, None)
+    ])
 
 
 def get_subst_decipher_hint(task, row, col):
-    dst_hints = task['team_data']['substitution_grid']
-    if dst_hints[row][col] is not None:
+    if not is_in_grid(row, col):
+        return False
+    team_data = task['team_data']
+    dst_hints = team_data['substitution_grid']
+    if get_cell(dst_hints, row, col) is not None:
         return False
     src_hints = task['full_data']['substitution_grid']
-    dst_hints[row][col] = src_hints[row][col]
+    team_data['substitution_grid'] = set_cell(
+        dst_hints, row, col, get_cell(src_hints, row, col))
     return True
 
 
 def get_subst_cipher_hint(task, rank):
+    if not 0 <= rank < len(ALPHABET):
+        return False
     src_hints = task['full_data']['substitution_grid']
-    dst_hints = task['team_data']['substitution_grid']
-    row, col = find_in_grid(src_hints, rank)
-    if dst_hints[row][col] is not None:
+    team_data = task['team_data']
+    dst_hints = team_data['substitution_grid']
+    row, col = find_letter(src_hints, rank)
+    if row is None:
+        return False
+    if get_cell(dst_hints, row, col) is not None:
         return True
-    dst_hints[row][col] = src_hints[row][col]
+    team_data['substitution_grid'] = set_cell(dst_hints, row, col, rank)
     return True
 
 
@@ -132,13 +136,28 @@ def get_perm_cipher_hint(task, line):
 
 
 def get_current_score(task):
+    return INITIAL_SCORE - get_hint_ledger(task)[0]
+
+
+def get_hint_ledger(task):
     team_data = task['team_data']
-    score = INITIAL_SCORE
-    if 'hint_queries' not in team_data:
-        return score
-    for query in team_data['hint_queries']:
-        score -= get_hint_cost(query)
-    return score
+    if 'hint_queries' in team_data:
+        # Instance not converted yet (see migrate_instance).
+        return make_hint_ledger(team_data['hint_queries'])
+    return team_data.get('hint_ledger', EMPTY_LEDGER)
+
+
+def make_hint_ledger(queries):
+    ledger = list(EMPTY_LEDGER)
+    for query in queries:
+        add_to_ledger(ledger, query)
+    return ledger
+
+
+def add_to_ledger(ledger, query):
+    ledger[0] += get_hint_cost(query)
+    if query['type'] in HINT_TYPES:
+        ledger[1 + HINT_TYPES.index(query['type'])] += 1
 
 
 def get_hint_cost(query):
@@ -155,11 +174,8 @@ def get_hint_cost(query):
 
 
 def save_hint_query(task, query):
-    team_data = task['team_data']
-    if 'hint_queries' not in team_data:
-        team_data['hint_queries'] = []
-    query['submitted_at'] = datetime.utcnow().isoformat()
-    team_data['hint_queries'].append(query)
+    migrate_hint_queries(task)
+    add_to_ledger(task['team_data']['hint_ledger'], query)
 
 
 def get_hint(task, query):
@@ -186,9 +202,45 @@ def get_hint(task, query):
 
 def reset_hints(task):
     team_data = task['team_data']
-    team_data['substitution_grid'] = empty_grid(team_data['substitution_grid'])
+    team_data['substitution_grid'] = EMPTY_GRID
     team_data['permutation'] = empty_permutation(team_data['permutation'])
-    team_data['hint_queries'] = []
+    team_data.pop('hint_queries', None)
+    team_data['hint_ledger'] = list(EMPTY_LEDGER)
+
+
+def migrate_instance(task):
+    """ Convert the substitution grids of an instance stored as nested
+        lists to the compact encoding, and its list of hint queries to a
+        hint ledger.  Return True if it was changed.
+    """
+    changed = migrate_hint_queries(task)
+    for data in (task['full_data'], task['team_data']):
+        if not is_compact(data['substitution_grid']):
+            data['substitution_grid'] = encode_indices(
+                data['substitution_grid'])
+            changed = True
+    if mark_compact(task['team_data']):
+        changed = True
+    return changed
+
+
+def migrate_hint_queries(task):
+    """ Replace the hint queries listed in team_data with a hint ledger.
+        The queries are moved to full_data['hint_history'], from where
+        the backend adds them to its history (when the hint is saved, or
+        by alkindi.migrate_instances).
+    """
+    team_data = task['team_data']
+    if 'hint_queries' in team_data:
+        queries = team_data.pop('hint_queries')
+        team_data['hint_ledger'] = make_hint_ledger(queries)
+        full_data = task['full_data']
+        full_data['hint_history'] = full_data.get('hint_history', []) + queries
+        return True
+    if 'hint_ledger' not in team_data:
+        team_data['hint_ledger'] = list(EMPTY_LEDGER)
+        return True
+    return False
 
 
 def canon_input(input):
@@ -242,7 +294,7 @@ def grade(task, data):
         'hints': {
             'substitution_grid': team_data['substitution_grid'],
             'permutation': team_data['permutation'],
-            'hint_queries': team_data.get('hint_queries')
+            'hint_ledger': get_hint_ledger(task)
         },
         'feedback': {
             'city': city_equal == Decimal(1),
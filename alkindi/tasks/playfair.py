@@ -1,33 +1,30 @@
 import os
-import random
 import re
 from unidecode import unidecode
 from difflib import SequenceMatcher
 from decimal import Decimal
 
+from alkindi.task_corpus import TaskCorpus
+from alkindi.task_grids import (
+    ALPHABET, SIZE, UNKNOWN, encode_cells, find_letter, get_cell,
+    is_compact, is_in_grid, mark_compact, set_cell)
+
 INITIAL_SCORE = 500
 
 
-def get_task(index):
-    with open(index, 'r') as f:
-        lines = f.read().strip().split('\n')
-        line = random.choice(lines)
-        base_dir = os.path.dirname(index)
-        task_txt = os.path.join(base_dir, line)
-        if not os.path.isfile(task_txt):
-            raise RuntimeError("missing task file: {}".format(task_txt))
-        task_dir = os.path.dirname(task_txt)
-        hints_txt = task_file(task_dir, 'hints.txt')
-        plain_txt = task_file(task_dir, 'plain.txt')
-        answer_txt = task_file(task_dir, 'answer.txt')
-    with open(task_txt, 'r') as f:
-        task = f.read().strip()
-    with open(hints_txt, 'r') as f:
-        hints_grid = f.read().strip()
-    with open(plain_txt, 'r') as f:
-        plain_text = f.read().strip()
-    with open(answer_txt, 'r') as f:
-        answer = f.read().strip()
+def get_task(index, choice=None):
+    return corpus.get_task(index, choice)
+
+
+def parse_task(task_txt, read):
+    task_dir = os.path.dirname(task_txt)
+    hints_txt = task_file(task_dir, 'hints.txt')
+    plain_txt = task_file(task_dir, 'plain.txt')
+    answer_txt = task_file(task_dir, 'answer.txt')
+    task = read(task_txt).strip()
+    hints_grid = read(hints_txt).strip()
+    plain_text = read(plain_txt).strip()
+    answer = read(answer_txt).strip()
     task_lines = task.split('\n')
     grid_pos = len(task_lines) - 5
     cipher_text = '\n'.join(task_lines[0:2])
@@ -35,7 +32,7 @@ def get_task(index):
     initial_grid = '\n'.join(task_lines[grid_pos:])
     hints = parse_grid(hints_grid)
     initial_hints = parse_grid(initial_grid)
-    return {
+    task = {
         'task_dir': task_dir,
         'score': INITIAL_SCORE,
         'full_data': {
@@ -52,6 +49,11 @@ def get_task(index):
             'hints': initial_hints
         }
     }
+    mark_compact(task['team_data'])
+    return task
+
+
+corpus = TaskCorpus(parse_task)
 
 
 def task_file(dir, name):
@@ -61,18 +63,12 @@ def task_file(dir, name):
     return full_path
 
 
-ALPHABET = 'ABCDEFGHIJKLMNOPQRSTUVXYZ'
-
-
 def parse_grid(text):
+    """ Return the compact encoding of the grid (see alkindi.task_grids).
+    """
     chars = re.split('\s+', text)
-    indices = [ALPHABET.find(c) for c in chars]
-    objects = [
-        {'q': 'unknown'} if i == -1 else
-        {'q': 'hint', 'l': i} for i in indices
-    ]
-    span = 5
-    return [objects[i:i+span] for i in range(0, len(chars), span)]
+    return ''.join(
+        c if len(c) == 1 and c in ALPHABET else UNKNOWN for c in chars)
 
 
 def get_hint(task, query):
@@ -89,38 +85,37 @@ def get_hint(task, query):
 def get_grid_hint(task, row, col):
     if task['score'] < 10:
         return False
-    try:
-        dst_hints = task['team_data']['hints']
-        if 'l' in dst_hints[row][col]:
-            return False
-        src_hints = task['full_data']['hints']
-        cell = src_hints[row][col]
-        dst_hints[row][col] = cell
-        task['score'] -= 10
-        return True
-    except IndexError:
+    if not is_in_grid(row, col):
         return False
+    team_data = task['team_data']
+    if get_cell(team_data['hints'], row, col) is not None:
+        return False
+    letter = get_cell(task['full_data']['hints'], row, col)
+    team_data['hints'] = set_cell(team_data['hints'], row, col, letter)
+    task['score'] -= 10
+    return True
 
 
 def get_alphabet_hint(task, rank):
     if task['score'] < 10:
         return False
-    src_hints = task['full_data']['hints']
-    dst_hints = task['team_data']['hints']
-    for row, row_cells in enumerate(src_hints):
-        for col, cell in enumerate(row_cells):
-            if cell['l'] == rank and 'l' not in dst_hints[row][col]:
-                task['score'] -= 10
-                dst_hints[row][col] = cell
-                return True
-    return False
+    if not 0 <= rank < len(ALPHABET):
+        return False
+    team_data = task['team_data']
+    row, col = find_letter(task['full_data']['hints'], rank)
+    if row is None or get_cell(team_data['hints'], row, col) is not None:
+        return False
+    task['score'] -= 10
+    team_data['hints'] = set_cell(team_data['hints'], row, col, rank)
+    return True
 
 
 def print_hints(hints):
-    for row_cells in hints:
-        for cell in row_cells:
-            if 'l' in cell:
-                print(ALPHABET[cell['l']], end=' ')
+    for row in range(SIZE):
+        for col in range(SIZE):
+            letter = get_cell(hints, row, col)
+            if letter is not None:
+                print(ALPHABET[letter], end=' ')
             else:
                 print(' ', end=' ')
         print('')
@@ -131,22 +126,23 @@ def reset_hints(task):
     task['team_data']['hints'] = task['full_data']['initial_hints']
 
 
-def fix_hints(hints):
-    for row_cells in hints:
-        for cell in row_cells:
-            q = cell.get('q')
-            if q == 'hint':
-                return False
-            if q == 'confirmed':
-                cell['q'] = 'hint'
-    return True
-
-
-def fix_task(task):
-    # Use a binary or to always check all three grids.
-    return (fix_hints(task['full_data']['hints']) |
-            fix_hints(task['full_data']['initial_hints']) |
-            fix_hints(task['team_data']['hints']))
+def migrate_instance(task):
+    """ Convert the grids of an instance stored with nested lists of
+        cells to the compact encoding.  Return True if it was changed.
+    """
+    changed = False
+    grids = [
+        (task['full_data'], 'hints'),
+        (task['full_data'], 'initial_hints'),
+        (task['team_data'], 'hints')
+    ]
+    for data, key in grids:
+        if not is_compact(data[key]):
+            data[key] = encode_cells(data[key])
+            changed = True
+    if mark_compact(task['team_data']):
+        changed = True
+    return changed
 
 
 def canon_number(input):
@@ -221,8 +217,6 @@ def test_grader():
 
 if __name__ == '__main__':
     task = get_task('/home/sebc/alkindi/tasks/playfair/INDEX')
-    print('fixed? {}'.format(fix_task(task)))
-    print('fixed again? {}'.format(fix_task(task)))
     print_hints(task['team_data']['hints'])
     print("Initial score={}\n".format(task['score']))
 
@@ -1,8 +1,9 @@
 import os
-import random
 import re
 from unidecode import unidecode
 
+from alkindi.task_corpus import TaskCorpus
+
 __all__ = ['get_task', 'get_hint', 'get_current_score', 'grade']
 
 
@@ -11,28 +12,18 @@ ALPHABET = 'ABCDEFGHIJKLMNOPQRSTUVXYZ'
 
 
 def get_task(index, choice=None):
-    with open(index, 'r') as f:
-        lines = f.read().strip().split('\n')
-        if choice is None:
-            line = random.choice(lines)
-        else:
-            line = lines[choice]
-        base_dir = os.path.dirname(index)
-        task_txt = os.path.join(base_dir, line)
-        if not os.path.isfile(task_txt):
-            raise RuntimeError("missing task file: {}".format(task_txt))
-        task_dir = os.path.dirname(task_txt)
-        hints_txt = task_file(task_dir, 'hints.txt')
-        plain_txt = task_file(task_dir, 'plain.txt')
-        answer_txt = task_file(task_dir, 'answer.txt')
-    with open(task_txt, 'r') as f:
-        cipher_text = f.read().strip()
-    with open(hints_txt, 'r') as f:
-        hints = f.read().strip()
-    with open(plain_txt, 'r') as f:
-        plain_text = f.read().strip()
-    with open(answer_txt, 'r') as f:
-        answer = f.read().strip()
+    return corpus.get_task(index, choice)
+
+
+def parse_task(task_txt, read):
+    task_dir = os.path.dirname(task_txt)
+    hints_txt = task_file(task_dir, 'hints.txt')
+    plain_txt = task_file(task_dir, 'plain.txt')
+    answer_txt = task_file(task_dir, 'answer.txt')
+    cipher_text = read(task_txt).strip()
+    hints = read(hints_txt).strip()
+    plain_text = read(plain_txt).strip()
+    answer = read(answer_txt).strip()
     hints = re.sub("'(.)' ?\n?", '\\1', hints)
     answer_lines = answer.split('\n')
     while len(answer_lines[-1]) == 0:
@@ -52,6 +43,9 @@ def get_task(index, choice=None):
     }
 
 
+corpus = TaskCorpus(parse_task)
+
+
 def task_file(dir, name):
     full_path = os.path.join(dir, name)
     if not os.path.isfile(full_path):
@@ -6,7 +6,8 @@ window.opener.postMessage(${h.double_json({
   'dispatch': {
     'type': 'Login.Feedback',
     'user_id': user_id,
-    'csrf_token': csrf_token
+    'csrf_token': csrf_token,
+    'token': token
   }
 })}, window.location.origin);
 window.close();
@@ -0,0 +1,78 @@
+"""
+Rate limiting with fixed-window counters in redis.
+
+A counter counts the requests made in the current window (window
+seconds long); a request that takes a counter over its limit is
+answered with 429 Too Many Requests and a Retry-After header giving
+the time until the window ends.  All the counters that apply to a
+request are incremented in a single round trip.
+
+To count only some outcomes (such as failed logins), check the
+counters with check_limits before handling the request, and increment
+them with count_events afterwards.
+"""
+
+import time
+
+from pyramid.httpexceptions import HTTPTooManyRequests
+
+from alkindi.globals import app
+
+
+def throttle(name, counters, window):
+    """ Increment the named counters, given as a list of
+        (counter, limit) pairs, and raise HTTPTooManyRequests if any
+        of them has gone over its limit.
+    """
+    counts = count_events(name, [counter for counter, _ in counters], window)
+    raise_over_limit(name, counters, counts, window, lambda c, l: c > l)
+
+
+def check_limits(name, counters, window):
+    """ Raise HTTPTooManyRequests if any of the named counters, given as
+        a list of (counter, limit) pairs, has reached its limit.
+    """
+    keys = [
+        counter_key(name, counter, window) for counter, _ in counters
+    ]
+    counts = [int(value or 0) for value in app.redis.mget(keys)]
+    raise_over_limit(name, counters, counts, window, lambda c, l: c >= l)
+
+
+def count_events(name, counters, window):
+    """ Increment the named counters and return their new values.
+    """
+    keys = [counter_key(name, counter, window) for counter in counters]
+    with app.redis.pipeline(transaction=False) as pipe:
+        for key in keys:
+            pipe.incr(key)
+            pipe.expire(key, window)
+        results = pipe.execute()
+    return results[0::2]
+
+
+def counter_key(name, counter, window):
+    return 'throttle:{}:{}:{}'.format(
+        name, counter, int(time.time() // window))
+
+
+def raise_over_limit(name, counters, counts, window, is_over):
+    for (counter, limit), count in zip(counters, counts):
+        if is_over(count, limit):
+            print("throttle: {} {} over limit ({})".format(
+                name, counter, limit))
+            now = time.time()
+            retry_after = int((int(now // window) + 1) * window - now) + 1
+            raise HTTPTooManyRequests(
+                headers={'Retry-After': str(retry_after)})
+
+
+def get_client_ip(request):
+    """ Return the client's address.  The reverse proxy appends the
+        address of its peer to X-Forwarded-For; addresses before it are
+        set by the client and cannot be trusted.
+    """
+    forwarded_for = request.headers.get('X-Forwarded-For')
+    if forwarded_for:
+        return forwarded_for.split(',')[-1].strip()
+    return request.remote_addr
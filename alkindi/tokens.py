@@ -0,0 +1,186 @@
+"""
+Signed bearer tokens for API calls.
+
+When jwt_secret is configured, the login views return a short-lived
+JWT that carries the user id, their principals and the versions of the
+principals (see alkindi.principals).  The frontend sends it in an
+'Authorization: Bearer' header; such requests are authenticated from
+the token alone, without loading the session from redis.  Requests
+with a valid token are not subject to the CSRF check either, as
+browsers never add the header on their own.
+
+A token younger than jwt_check_after seconds (from its iat claim) is
+trusted without any redis round trip.  For an older token, the
+versions in its pv claim are compared with the current ones (one redis
+round trip):
+- if they match, a renewed token (same claims, new iat, same expiry)
+  is returned in the X-Alkindi-Token header, so that the client's next
+  requests are not checked again for a while;
+- if the user's principals have changed since the token was issued (a
+  teammate left, an admin flag was set by hand), the token's
+  principals are not used: they are read again, and a new token is
+  returned in the header, as it is by the requests that change the
+  user's principals.
+Principals changed by another user therefore take effect within
+jwt_check_after seconds for token requests.
+
+The session is still used for the OAuth tokens and the CSRF token, and
+by requests that do not send a token.
+"""
+
+import time
+
+from pyramid.authentication import SessionAuthenticationPolicy
+from pyramid.session import check_csrf_token
+
+from alkindi.globals import app
+from alkindi.model.users import get_user_principals
+from alkindi.principals import get_principals_version
+
+
+ALGORITHM = 'HS256'
+TOKEN_HEADER = 'X-Alkindi-Token'
+
+# Default token lifetime, in seconds.
+DEFAULT_TTL = 900
+
+# Default age (in seconds) from which a token's principals versions are
+# checked.
+DEFAULT_CHECK_AFTER = 60
+
+
+def includeme(config):
+    config.add_request_method(get_token_claims, 'token_claims', reify=True)
+    config.add_view_predicate('check_csrf_or_token', CsrfOrTokenPredicate)
+    config.add_route('token', '/token', request_method='POST')
+    config.add_view(
+        renew_token_view, route_name='token',
+        check_csrf_or_token=True, renderer='json')
+
+
+class TokenAuthenticationPolicy(SessionAuthenticationPolicy):
+    """ Authenticate requests that carry a bearer token from the token,
+        and other requests from the session.
+    """
+
+    def unauthenticated_userid(self, request):
+        if get_bearer_token(request) is None:
+            return super().unauthenticated_userid(request)
+        claims = request.token_claims
+        return None if claims is None else claims['sub']
+
+    def remember(self, request, userid, **kwargs):
+        if get_bearer_token(request) is not None:
+            return []
+        return super().remember(request, userid, **kwargs)
+
+    def forget(self, request):
+        if get_bearer_token(request) is not None:
+            return []
+        return super().forget(request)
+
+
+class CsrfOrTokenPredicate:
+    """ View predicate that accepts requests carrying a valid bearer
+        token, and other requests if they pass the CSRF check.
+    """
+
+    def __init__(self, val, config):
+        self.val = val
+
+    def text(self):
+        return 'check_csrf_or_token = {}'.format(self.val)
+
+    phash = text
+
+    def __call__(self, context, request):
+        if not self.val or request.token_claims is not None:
+            return True
+        return check_csrf_token(request, raises=False)
+
+
+def renew_token_view(request):
+    user_id = request.authenticated_userid
+    if user_id is None:
+        return {'success': False, 'error': 'not authenticated'}
+    return {'success': True, 'token': issue_token(request, user_id)}
+
+
+def issue_token(request, user_id):
+    """ Return a new token for the user, or None if tokens are not
+        enabled.  The principals are read from the database, so that
+        changes made by the current request are included.
+    """
+    secret = app.get('jwt_secret')
+    if not secret:
+        return None
+    principals = get_user_principals(request.db, user_id)
+    now = int(time.time())
+    claims = {
+        'sub': str(user_id),
+        'principals': principals,
+        'pv': get_principals_version(user_id, principals),
+        'iat': now,
+        'exp': now + int(app.get('jwt_ttl', DEFAULT_TTL)),
+    }
+    return encode_token(claims, secret)
+
+
+def encode_token(claims, secret):
+    import jwt
+    token = jwt.encode(claims, secret, algorithm=ALGORITHM)
+    if isinstance(token, bytes):
+        token = token.decode('ascii')
+    return token
+
+
+def reissue_token(request):
+    """ If the request was authenticated by a token, return a token
+        with the user's current principals in the response headers.
+    """
+    if request.token_claims is None:
+        return
+    token = issue_token(request, request.token_claims['sub'])
+    if token is not None:
+        request.response.headers[TOKEN_HEADER] = token
+
+
+def get_token_claims(request):
+    """ Return the verified claims of the request's bearer token, or
+        None if it has no valid token.  The claims' 'stale' key is true
+        if the principals they carry are out of date; a checked token
+        that is current is renewed.
+    """
+    token = get_bearer_token(request)
+    if token is None:
+        return None
+    secret = app.get('jwt_secret')
+    if not secret:
+        return None
+    import jwt
+    try:
+        claims = jwt.decode(token, secret, algorithms=[ALGORITHM])
+    except jwt.InvalidTokenError as ex:
+        print("rejected token: {}".format(ex))
+        return None
+    claims['stale'] = False
+    check_after = int(app.get('jwt_check_after', DEFAULT_CHECK_AFTER))
+    now = int(time.time())
+    if now - claims.get('iat', 0) < check_after:
+        return claims
+    version = get_principals_version(claims['sub'], claims['principals'])
+    if claims.get('pv') != version:
+        claims['stale'] = True
+        return claims
+    renewed = dict(claims, iat=now)
+    del renewed['stale']
+    request.response.headers[TOKEN_HEADER] = encode_token(renewed, secret)
+    return claims
+
+
+def get_bearer_token(request):
+    authorization = request.headers.get('Authorization', '')
+    scheme, _, token = authorization.partition(' ')
+    if scheme.lower() != 'bearer' or token == '':
+        return None
+    return token.strip()
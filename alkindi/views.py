@@ -18,6 +18,7 @@ from alkindi.model.attempts import (
     load_participation_attempts, get_user_current_attempt_id)
 from alkindi.model.access_codes import load_unlocked_access_codes
 from alkindi.model.task_instances import load_user_task_instance
+from alkindi.model.hints import load_hint_queries
 from alkindi.model.answers import load_limited_attempt_answers
 from alkindi.model.workspace_revisions import (
     load_user_latest_revision_id, load_attempt_revisions)
@@ -211,7 +212,12 @@ def view_requesting_user(
             if countdown < now:
                 return view
 
-    view['team_data'] = task_instance['team_data']
+    team_data = task_instance['team_data']
+    if 'hint_ledger' in team_data:
+        # The task frontend displays the hint queries, which adfgx no
+        # longer lists in team_data.
+        team_data['hint_queries'] = load_hint_queries(db, attempt_id)
+    view['team_data'] = team_data
 
     # Add a list of the workspace revisions for this attempt.
     add_revisions(db, view, attempt_id)
@@ -409,6 +415,9 @@ def view_answer(answer, hide_scores):
         cols.append('is_full_solution')
     for col in cols:
         view[col] = answer[col]
+    view['is_failed'] = answer['grading_failed_at'] is not None
+    view['is_pending'] = answer['graded_at'] is None and \
+        not view['is_failed']
     return view
 
 
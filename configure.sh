@@ -38,3 +38,86 @@ redis-cli set requested_badge 'https://badges.concours-alkindi.fr/qualification_
 
 # redis-cli set add_badge_uri 'http://www.france-ioi.org/alkindi/apiQualificationAlkindi.php'
 redis-cli set add_badge_uri 'https://login.home.epixode.fr/addBadge.php'
+
+# Admins can profile a request by passing the X-Alkindi-Profile header
+# or the profile=1 query parameter.  Optional settings: the sampling
+# interval and how long profiles are kept (both in seconds).
+# redis-cli set profiler_interval 0.005
+# redis-cli set profiler_ttl 86400
+
+# Time budget (in seconds) for a request, including database statements
+# and calls to the task backends and the identity provider.  Requests
+# that run out of time fail with a 'deadline exceeded' error.
+redis-cli set request_deadline 30
+
+# Concurrency limits per API view (the last element of the /api/ path,
+# "start" is the start attempt action), shared by all workers; pages
+# are not limited.  Requests beyond the limit wait up to admission_wait
+# seconds for a slot, then get a 429 response with a Retry-After header
+# (in seconds).
+redis-cli set admission_limits '{"start":20,"create_attempt":20,"answer":40,"get_hint":40}'
+redis-cli set admission_wait 2
+redis-cli set admission_retry_after 5
+
+# Outbound HTTP calls (identity provider, badges, task backends) keep
+# connections alive, with a pool of http_pool_size connections per
+# host.  Timeouts (in seconds) are set globally and per host, and are
+# bounded by the request deadline.  Changes to the pool size and the CA
+# bundle take effect when the workers restart.
+redis-cli set http_timeouts '{"connect":3.05,"read":30,"hosts":{}}'
+# redis-cli set http_pool_size 10
+# redis-cli set ca_bundle /etc/ssl/certs/ca-certificates.crt
+
+# Principals are cached in redis for all sessions; entries unused for
+# principals_ttl seconds are dropped.
+# redis-cli set principals_ttl 86400
+
+# Optional: API calls can be authenticated by short-lived signed tokens
+# (returned by the login views and renewed at /token) instead of the
+# session.  Tokens are disabled when jwt_secret is not set.
+# redis-cli set jwt_secret $(openssl rand -hex 32)
+# redis-cli set jwt_ttl 900
+# Tokens younger than jwt_check_after seconds are trusted as they are;
+# older ones are checked against the principals versions in redis, and
+# renewed if they are still current.  Principals changed by another
+# user or by hand therefore take effect within jwt_check_after seconds.
+# redis-cli set jwt_check_after 60
+
+# Profiles returned by the identity provider are cached for profile_ttl
+# seconds, then revalidated with conditional requests.
+# redis-cli set profile_ttl 300
+
+# Limit on logins with a participation code: failed attempts per client
+# address, in a window of the given length.
+# redis-cli set code_login_limits '{"window":300,"ip_failures":50}'
+
+# Timeouts (in seconds) of the calls to the task backends, settings of
+# their circuit breakers (see alkindi/breakers.py), how long a failing
+# endpoint is left out when a task lists several (see alkindi/balancer.py)
+# and hedging of gradeAnswer calls, with per-task overrides.  Backends
+# that support protocol 2 receive task instances by reference and
+# compressed request bodies.
+redis-cli set task_backends '{"connect":3.05,"read":20,"protocol":1,"window":30,"min_requests":5,"error_rate":0.5,"open_for":30,"eject_for":10,"hedge":true,"hedge_delay":2,"hedge_min_delay":0.2,"tasks":{}}'
+
+# Answers are graded while the team waits, unless grading_mode is
+# "async": they are then stored as pending and graded by the workers
+# started with python -m alkindi.grader (see alkindi/grader.py).
+# redis-cli set grading_mode async
+# redis-cli set grading_workers '{"threads":16,"per_task":4,"retries":3,"retry_delay":10}'
+
+# Tasks whose backend_url is local:<module> (local:playfair, local:adfgx,
+# local:round4) run the modules in alkindi/tasks/ in a pool of processes
+# per worker (see alkindi/task_runtime.py), enabled by this setting.
+# redis-cli set task_runtime '{"processes":2}'
+
+# The round catalogue (rounds, round_tasks, tasks, regions, badges) is
+# shared by the workers through a file in shared memory.  Bump the
+# version after changing these tables so that the file is rebuilt.
+# The file's directory must be owned by the service user with mode 0700
+# (the default directory is created that way).
+# redis-cli set catalogue_path /dev/shm/alkindi-$(id -u)/catalogue
+redis-cli set catalogue_version $(date +%s)
+
+# Notify the running workers, they reload the configuration without a
+# restart.  Keep this at the end of the script.
+redis-cli publish config $(redis-cli incr config_version)
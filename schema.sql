@@ -728,3 +728,72 @@ UPDATE regions SET big_region_name = "Rennes" WHERE big_region_code = "rennes";
 
 ALTER TABLE teams DROP COLUMN rank;
 ALTER TABLE teams DROP COLUMN rank_region;
+
+-- Access codes held by more than one participation: the unique index
+-- below cannot be created while this returns rows.  Note the teams
+-- concerned, and drop the cached mappings of these codes from redis
+-- (redis-cli del participation_code:<code>).
+SELECT access_code, COUNT(*), GROUP_CONCAT(id ORDER BY id)
+    FROM participations
+    WHERE access_code IS NOT NULL
+    GROUP BY access_code HAVING COUNT(*) > 1;
+
+-- Keep each duplicated code on one participation (the one whose code
+-- was entered, or else the oldest), and give the others a new code by
+-- appending their id (codes are 8 characters, so the new ones cannot
+-- collide); tell their teams the new code.
+UPDATE participations p
+    JOIN participations q
+    ON q.access_code = p.access_code AND q.id <> p.id
+    AND (q.access_code_entered > p.access_code_entered OR
+         (q.access_code_entered = p.access_code_entered AND q.id < p.id))
+    SET p.access_code = CONCAT(p.access_code, p.id);
+
+CREATE UNIQUE INDEX ix_participations__access_code USING btree ON participations (access_code);
+
+-- Task instances generated ahead of the round, claimed by attempts as
+-- they start.
+CREATE TABLE `task_instance_pool` (
+  `id` bigint(20) NOT NULL AUTO_INCREMENT,
+  `round_task_id` bigint(20) NOT NULL,
+  `seed` varchar(64) NOT NULL,
+  `created_at` datetime NOT NULL,
+  `full_data` mediumtext NOT NULL,
+  `team_data` mediumtext NOT NULL,
+  `attempt_id` bigint(20) DEFAULT NULL,
+  `claimed_at` datetime DEFAULT NULL,
+  PRIMARY KEY (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+ALTER TABLE `task_instance_pool` ADD UNIQUE INDEX `ix_task_instance_pool__round_task_id_seed` (round_task_id, seed) USING BTREE;
+ALTER TABLE `task_instance_pool` ADD INDEX `ix_task_instance_pool__round_task_id_attempt_id` (round_task_id, attempt_id) USING BTREE;
+ALTER TABLE `task_instance_pool` ADD CONSTRAINT `fk_task_instance_pool__round_task_id`
+  FOREIGN KEY (`round_task_id`) REFERENCES `round_tasks` (`id`)
+  ON DELETE CASCADE ON UPDATE CASCADE;
+
+-- Answers graded asynchronously are stored as pending, with a NULL
+-- graded_at and grading, until the grading worker grades them.
+ALTER TABLE `answers` ADD COLUMN `graded_at` datetime DEFAULT NULL;
+UPDATE `answers` SET `graded_at` = `created_at`;
+ALTER TABLE `answers` MODIFY `grading` text NULL;
+ALTER TABLE `answers` MODIFY `score` decimal(6,0) NULL;
+ALTER TABLE `answers` MODIFY `is_solution` tinyint(1) NULL;
+ALTER TABLE `answers` MODIFY `is_full_solution` tinyint(1) NULL;
+
+-- History of the hints granted on each attempt's task instance, kept
+-- out of the instance's data, which is sent to the task backend on
+-- every grading.
+CREATE TABLE `hint_queries` (
+  `id` bigint(20) NOT NULL AUTO_INCREMENT,
+  `attempt_id` bigint(20) NOT NULL,
+  `created_at` datetime NOT NULL,
+  `query` text NOT NULL,
+  PRIMARY KEY (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+ALTER TABLE `hint_queries` ADD INDEX `ix_hint_queries__attempt_id` (attempt_id) USING BTREE;
+ALTER TABLE `hint_queries` ADD CONSTRAINT `fk_hint_queries__attempt_id`
+  FOREIGN KEY (`attempt_id`) REFERENCES `attempts` (`id`)
+  ON DELETE CASCADE ON UPDATE CASCADE;
+
+-- Answers that the grading worker gave up on (after its retries) are
+-- marked as failed instead of staying pending.
+ALTER TABLE `answers` ADD COLUMN `grading_failed_at` datetime DEFAULT NULL;
@@ -24,7 +24,7 @@ requires = [
     'pyramid >= 1.6b3',
     'pyramid_debugtoolbar >= 2.4.2',
     'pyramid-mako >= 1.0.2',
-    'pyramid_redis_sessions >= 1.0.1',
+    'redis >= 3.5.0',
     'requests >= 2.9.0',
     'sqlbuilder-0.7.9.53',
     'ua-parser >= 0.6.1',